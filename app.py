@@ -1,23 +1,111 @@
+from io import BytesIO
+from multiprocessing import parent_process
+import json
 import os
+import tempfile
+import zipfile
 from flask import (
-    flash, Flask, redirect, render_template, request, url_for
+    abort, flash, Flask, jsonify, redirect, render_template, request,
+    Response, send_file, stream_with_context, url_for
 )
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 from PIL import Image
-from imgfilter import ImgFilter
+from imgfilter import Optimizer, hashPipeline, normalizeText, parseProgram
+from jobs import Job, JobQueue, QueueFullError, errorMessage
+from storage import (
+    Encoding, ResultCache, SourceCache, UploadError, saveUpload
+)
+from workers import WorkerPool
 
 # Load .env file
 load_dotenv()
 
 # Restraints and paths for image uploads
 UPLOAD_FOLDER = 'static/images/source'
-ALLOWED_EXTENSIONS = {'png'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
+# Where filtered images are cached, and how many bytes they can use
+RESULTS_FOLDER = 'static/images/results'
+RESULTS_MAX_BYTES = int(os.getenv('RESULTS_MAX_BYTES', 256 * 1024 * 1024))
+# How many bytes of the newest results are also kept in memory
+RESULTS_MEMORY_BYTES = int(
+    os.getenv('RESULTS_MEMORY_BYTES', 64 * 1024 * 1024)
+)
+# How many bytes of decoded source images are kept in memory
+SOURCES_MAX_BYTES = int(os.getenv('SOURCES_MAX_BYTES', 256 * 1024 * 1024))
 
 # initialize the app and configure the upload folder
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.secret_key = os.getenv('FLASK_SECRET_KEY')
+# which of ImgFilter.ENGINES runs the user's code
+app.config['FILTER_ENGINE'] = os.getenv('FILTER_ENGINE', 'python')
+# how many processes can split filters into tiles, which are shared by
+# the worker processes, see WorkerPool.tileWorkers
+app.config['FILTER_WORKERS'] = int(
+    os.getenv('FILTER_WORKERS', os.cpu_count() or 1)
+)
+# how many steps and seconds a filter can take before it is stopped
+app.config['FILTER_MAX_STEPS'] = int(
+    os.getenv('FILTER_MAX_STEPS', 50_000_000)
+)
+app.config['FILTER_TIMEOUT'] = float(os.getenv('FILTER_TIMEOUT', 60))
+# the longest side of previews, which filters are ran on until the full
+# image is asked for
+app.config['FILTER_PREVIEW_SIZE'] = int(os.getenv('FILTER_PREVIEW_SIZE', 512))
+# whether filters can be profiled, which is always allowed when debugging
+app.config['FILTER_PROFILE'] = os.getenv('FILTER_PROFILE', '0') == '1'
+# how results are saved when the request doesn't say, see Encoding
+app.config['RESULT_FORMAT'] = os.getenv('RESULT_FORMAT', 'png')
+app.config['RESULT_QUALITY'] = (
+    int(os.environ['RESULT_QUALITY']) if os.getenv('RESULT_QUALITY')
+    else None
+)
+# images with at least this many pixels are filtered a strip at a time
+# when their filter allows it, so they never have to fit in memory
+app.config['FILTER_STREAM_PIXELS'] = int(
+    os.getenv('FILTER_STREAM_PIXELS', 16 * 1024 * 1024)
+)
+# how many images one filter can be ran on at once, see batch_submit,
+# which have to fit in the job queue
+app.config['BATCH_MAX_IMAGES'] = int(os.getenv('BATCH_MAX_IMAGES', 32))
+
+# how many worker processes filters are ran by, see WorkerPool, or 0 to
+# run them in the web app's threads
+app.config['FILTER_PROCESSES'] = int(os.getenv('FILTER_PROCESSES', 2))
+# how many bytes of memory each worker process can use, or 0 for no limit
+app.config['FILTER_PROCESS_MEMORY'] = int(
+    os.getenv('FILTER_PROCESS_MEMORY', 0)
+)
+# how many filters a worker process runs before it's replaced, or 0 to
+# keep it for good
+app.config['FILTER_PROCESS_TASKS'] = int(os.getenv('FILTER_PROCESS_TASKS', 0))
+
+# filtered images, by the source image and the filter's program
+results = ResultCache(RESULTS_FOLDER, RESULTS_MAX_BYTES, RESULTS_MEMORY_BYTES)
+# source images, with their size and hash, so they're only decoded once
+sources = SourceCache(SOURCES_MAX_BYTES)
+
+# filters are ran by worker processes that are started with the app, so
+# they're ready before the first filter
+renderers = WorkerPool(
+    app.config['FILTER_PROCESSES'], app.config['FILTER_ENGINE'],
+    SOURCES_MAX_BYTES, app.config['FILTER_PROCESS_MEMORY'] or None,
+    app.config['FILTER_PROCESS_TASKS'] or None
+)
+# The worker processes import this file too, and mustn't start their own
+if parent_process() is None and app.config['FILTER_PROCESSES']:
+    renderers.start()
+
+# filters are ran by a few threads, instead of by the request
+# and are cancelled once the page waiting on them stops asking
+jobs = JobQueue(
+    int(os.getenv('JOB_WORKERS', 2)), int(os.getenv('JOB_QUEUE_SIZE', 32)),
+    abandonAfter=float(os.getenv('JOB_ABANDON_AFTER', 30))
+)
+# How many seconds an event stream can go without sending anything, see
+# job_events, which has to be less than JOB_ABANDON_AFTER
+EVENTS_KEEPALIVE = 10
 
 
 # check if file is correct type
@@ -30,12 +118,35 @@ def source_path(filename):
     return f'{app.config["UPLOAD_FOLDER"]}/{filename}'
 
 
+def can_profile():
+    return app.debug or app.config['FILTER_PROFILE']
+
+
+def request_encoding():
+    """Returns the Encoding asked for by the format and quality fields,
+    which are RESULT_FORMAT and RESULT_QUALITY if not given. Raises a
+    ValueError if it isn't one."""
+
+    format = request.form.get('format') or app.config['RESULT_FORMAT']
+    quality = request.form.get('quality')
+
+    # The default quality is only for the default format
+    if quality:
+        quality = int(quality)
+    elif format == app.config['RESULT_FORMAT']:
+        quality = app.config['RESULT_QUALITY']
+    else:
+        quality = None
+
+    return Encoding(format, quality)
+
+
 @app.route('/', methods=['GET', 'POST'])
 def landing():
     if request.method == 'POST':
         # check if the post request has the file part
         if 'file' not in request.files:
-            flash('Must be a .png file.')
+            flash('Must be a PNG, JPEG or WebP file.')
             return redirect('/')
         
         # get POSTed file
@@ -48,8 +159,15 @@ def landing():
         
         # check that there is a file and is allowed type
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file.save(source_path(filename))
+            # saved by the hash of its bytes, so it's only saved once
+            try:
+                filename = saveUpload(
+                    file.stream, app.config['UPLOAD_FOLDER']
+                )
+            except UploadError as e:
+                flash(str(e))
+                return redirect('/')
+
             return redirect(url_for(
                 'filter_page',
                 filename=filename
@@ -71,8 +189,7 @@ def filter_noargs():
 def filter_page(filename):
     height, width = 0,0
     try:
-        with Image.open(source_path(filename)) as img:
-            width, height = img.size
+        width, height = sources.size(source_path(filename))
     except:
         flash(f'Could not open {filename}')
         return redirect('/')
@@ -82,41 +199,454 @@ def filter_page(filename):
     height *= factor
 
     return render_template(
-        'filter.html', path=filename, height=height, width=width
+        'filter.html', path=filename, height=height, width=width,
+        profile=can_profile()
     )
     
 
+def run_filter(job, filename, filter_texts, engine, workers, profile=False,
+               preview=None, optimized=None, encoding=None):
+    """Filters an image with each of the programs in filter_texts, one
+    after the other, and only saves the last image. Returns the path of
+    the result and its size, and with profile, where the filter spent
+    its time. With preview, the filter runs on a copy of the image no
+    bigger than preview pixels across, and width and height are the size
+    of that copy. This is ran by the job queue, and stops once the job
+    is cancelled.
+
+    The filter itself is ran by one of the worker processes, see
+    WorkerPool, while this thread waits for it.
+
+    optimized is the programs already ran through the Optimizer, which
+    batches do once for all of their images, see batch_submit. The
+    result is saved with encoding, or as a default PNG."""
+
+    encoding = encoding or Encoding()
+    path = source_path(filename)
+
+    imageHash = sources.hash(path)
+    stages = [parseProgram(text) for text in filter_texts]
+
+    # Images that are already small enough aren't shrunk for previews
+    if preview and max(sources.size(path)) <= preview:
+        preview = None
+    variant = ':'.join(filter(None, (
+        f'preview{preview}' if preview else '', encoding.variant
+    )))
+
+    # If this image was already filtered by this program, the saved
+    # result is used instead of running the filter again, unless it
+    # has to run to be profiled
+    key = results.key(
+        imageHash, hashPipeline(stages), variant, encoding.extension
+    )
+    result = None if profile else results.get(key)
+
+    if result is not None:
+        with Image.open(result) as img:
+            width, height = img.size
+
+        return {
+            'key': key, 'path': result, 'width': width, 'height': height,
+            'profile': None, 'preview': bool(preview)
+        }
+
+    task = {
+        'path': path,
+        'dest': results.temp(key),
+        'texts': filter_texts,
+        'optimized': optimized,
+        'engine': engine,
+        'workers': workers,
+        'profile': profile,
+        'preview': preview,
+        'encoding': encoding,
+        'steps': app.config['FILTER_MAX_STEPS'],
+        'seconds': app.config['FILTER_TIMEOUT'],
+        'streamPixels': app.config['FILTER_STREAM_PIXELS'],
+    }
+
+    try:
+        rendered = renderers.run(task, job.cancelled, job.report)
+        result = results.move(key, task['dest'])
+    finally:
+        # Left behind by a filter that failed
+        if os.path.exists(task['dest']):
+            os.remove(task['dest'])
+
+    return {'key': key, 'path': result, **rendered}
+
+
+def submit_filter(filename, filter_texts, profile, preview, encoding):
+    "Queues a filter to run, returns its job or None if the queue is full."
+
+    try:
+        return jobs.submit(
+            run_filter, filename, filter_texts,
+            app.config['FILTER_ENGINE'], app.config['FILTER_WORKERS'],
+            profile, preview, None, encoding
+        )
+    except QueueFullError as e:
+        flash(str(e))
+        return None
+
+
+def job_response(job):
+    "Sends API clients the state of a new job, and everyone else its page."
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job.toDict()), 202
+
+    return redirect(url_for('job_page', job_id=job.id))
+
+
 @app.route('/filtered', methods=['POST'])
 def filtered_page():
-    filter_text = request.form.get('filter-text')
+    # API clients can send more than one filter, which are ran one after
+    # the other as a pipeline
+    filter_texts = request.form.getlist('filter-text')
     filename = request.form.get('filename')
 
-    if filter_text == '':
+    if not filter_texts or '' in filter_texts:
         flash('No filter provided')
         return redirect(url_for(
             'filter_page', filename=filename
         ))
     
-    filter_text = filter_text.replace('\r', '\n')
+    filter_texts = [normalizeText(text) for text in filter_texts]
     # print(filter_text)
     # splittee = filter_text.split('\n')
     # for x in range(len(splittee)):
     #     for y in range(len(splittee[x])):
     #         print(x + y, splittee[x][y], ord(splittee[x][y]))
-    
-    imgFilter = ImgFilter(filename)
-    imgFilter(filter_text)
 
-    height = imgFilter.height
-    width = imgFilter.width
-    
-    factor = 750 / max(width, height)
-    width *= factor
-    height *= factor
-    
-    return render_template(
-        'filtered.html', path=filename, width=width, height=height
+    if not os.path.isfile(source_path(filename)):
+        flash(f'Could not open {filename}')
+        return redirect('/')
+
+    # Profiling is only for debugging, as it makes filters slower
+    profile = can_profile() and bool(request.form.get('profile'))
+
+    try:
+        encoding = request_encoding()
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for('filter_page', filename=filename))
+
+    # Filters are previewed first, as the code is usually changed a few
+    # times before the full image is wanted
+    preview = (
+        None if request.form.get('full')
+        else app.config['FILTER_PREVIEW_SIZE']
+    )
+
+    job = submit_filter(filename, filter_texts, profile, preview, encoding)
+    if job is None:
+        return redirect(url_for('filter_page', filename=filename))
+
+    # API clients get the id of the job instead of a page
+    return job_response(job)
+
+
+@app.route('/filtered/<job_id>')
+def job_page(job_id):
+    if jobs.get(job_id) is None:
+        flash('That filter could not be found')
+        return redirect('/')
+
+    return render_template('filtered.html', job_id=job_id)
+
+
+def job_state(job):
+    "Returns the state of a job, with its result once it's done."
+
+    status = job.toDict()
+    if job.state == Job.DONE:
+        status['result'] = url_for('result_file', key=job.result['key'])
+        status['width'] = job.result['width']
+        status['height'] = job.result['height']
+        status['preview'] = job.result['preview']
+
+        if job.result['preview']:
+            status['render'] = url_for('job_render', job_id=job.id)
+
+        if job.result['profile']:
+            status['debug'] = {'profile': job.result['profile']}
+
+    # What the running filter has done so far
+    elif job.state == Job.RUNNING and job.snapshot is not None:
+        status['snapshot'] = url_for(
+            'job_snapshot', job_id=job.id, number=job.snapshots
+        )
+
+    return status
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+
+    return jsonify(job_state(job))
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Streams the state of a job as Server-Sent Events, a 'progress'
+    event whenever it changes while it's queued or running, and a 'done'
+    event once it has finished running, after which the stream ends.
+    Both are the same as /jobs/<job_id>."""
+
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+
+    def events():
+        sent = None
+        while True:
+            version = job.waitForChange(sent, EVENTS_KEEPALIVE)
+
+            # The job is still wanted while someone is listening
+            jobs.get(job_id)
+
+            if version == sent:
+                # Comments keep the connection from timing out
+                yield ': waiting\n\n'
+                continue
+            
+            sent = version
+            finished = job.finishedRunning()
+            event = 'done' if finished else 'progress'
+            yield f'event: {event}\ndata: {json.dumps(job_state(job))}\n\n'
+
+            if finished:
+                return
+
+    return Response(
+        stream_with_context(events()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'}
+    )
+
+
+@app.route('/jobs/<job_id>/snapshot')
+def job_snapshot(job_id):
+    "Sends the last snapshot of a running job."
+
+    job = jobs.get(job_id)
+    if job is None or job.snapshot is None:
+        abort(404)
+
+    return send_file(BytesIO(job.snapshot), mimetype='image/jpeg')
+
+
+@app.route('/jobs/<job_id>/render', methods=['POST'])
+def job_render(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+
+    # Runs the same filter on the full image
+    filename, filter_texts, _, _, profile, _, _, encoding = job.args
+    full = submit_filter(filename, filter_texts, profile, None, encoding)
+    if full is None:
+        return redirect(url_for('job_page', job_id=job_id))
+
+    return job_response(full)
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    job = jobs.cancel(job_id)
+    if job is None:
+        abort(404)
+
+    return jsonify(job.toDict())
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+
+    # The result isn't there yet, or never will be
+    if job.state != Job.DONE:
+        return jsonify(job.toDict()), 409
+
+    return redirect(url_for('result_file', key=job.result['key']))
+
+
+@app.route('/results/<key>')
+def result_file(key):
+    """Sends a saved result, from memory if it's still there. Results are
+    named by what made them, so they never change, and can be cached by
+    the browser for as long as it likes."""
+
+    path = results.get(key)
+    if path is None:
+        abort(404)
+
+    data = results.read(key)
+    return send_file(
+        path if data is None else BytesIO(data),
+        mimetype=Encoding.mimetypeOf(key), etag=key, max_age=365 * 24 * 3600
     )
 
+
+
+@app.route('/batches', methods=['POST'])
+def batch_submit():
+    """Runs one filter on many images, the source images named by the
+    filename fields and the images uploaded as file fields. The program
+    is only parsed and optimized once, and each image is filtered by its
+    own job, so they run side by side. Like /filtered, more than one
+    filter can be sent, which are ran as a pipeline."""
+
+    filter_texts = [
+        normalizeText(text) for text in request.form.getlist('filter-text')
+    ]
+    if not filter_texts or any(text.strip() == '' for text in filter_texts):
+        return jsonify({'error': 'No filter provided'}), 400
+
+    filenames = request.form.getlist('filename')
+    uploads = request.files.getlist('file')
+    if not filenames and not uploads:
+        return jsonify({'error': 'No images provided'}), 400
+    if len(filenames) + len(uploads) > app.config['BATCH_MAX_IMAGES']:
+        return jsonify({'error': (
+            f'Only {app.config["BATCH_MAX_IMAGES"]} images can be '
+            'filtered at once'
+        )}), 400
+
+    # Names that secure_filename would change can't be source images
+    for filename in filenames:
+        if filename != secure_filename(filename) \
+                or not os.path.isfile(source_path(filename)):
+            return jsonify({'error': f'Could not open {filename}'}), 400
+
+    for file in uploads:
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file type.'}), 400
+
+    try:
+        encoding = request_encoding()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        optimized = [
+            Optimizer().optimize(parseProgram(text)) for text in filter_texts
+        ]
+    except Exception as e:
+        return jsonify({'error': errorMessage(e)}), 400
+
+    for file in uploads:
+        try:
+            filenames.append(
+                saveUpload(file.stream, app.config['UPLOAD_FOLDER'])
+            )
+        except UploadError as e:
+            return jsonify({'error': str(e)}), 400
+
+    try:
+        batch = jobs.submitBatch(run_filter, [
+            (
+                filename, filter_texts, app.config['FILTER_ENGINE'],
+                app.config['FILTER_WORKERS'], False, None, optimized,
+                encoding
+            )
+            for filename in filenames
+        ])
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+
+    return jsonify(batch_manifest(batch)), 202
+
+
+def batch_manifest(batch):
+    "Returns the state of a batch, with where to find each result."
+
+    manifest = batch.toDict()
+    manifest['archive'] = url_for('batch_archive', batch_id=batch.id)
+
+    for job, status in zip(batch.jobs, manifest['jobs']):
+        status['filename'] = job.args[0]
+
+        if job.state == Job.DONE:
+            status['result'] = url_for('result_file', key=job.result['key'])
+            status['width'] = job.result['width']
+            status['height'] = job.result['height']
+
+    return manifest
+
+
+@app.route('/batches/<batch_id>')
+def batch_status(batch_id):
+    batch = jobs.getBatch(batch_id)
+    if batch is None:
+        abort(404)
+
+    return jsonify(batch_manifest(batch))
+
+
+@app.route('/batches/<batch_id>/cancel', methods=['POST'])
+def batch_cancel(batch_id):
+    batch = jobs.cancelBatch(batch_id)
+    if batch is None:
+        abort(404)
+
+    return jsonify(batch_manifest(batch))
+
+
+@app.route('/batches/<batch_id>/archive')
+def batch_archive(batch_id):
+    """Sends a zip of every filtered image of a finished batch, named
+    after its source image, along with the batch's manifest.json."""
+
+    batch = jobs.getBatch(batch_id)
+    if batch is None:
+        abort(404)
+
+    # Not every image has been filtered yet
+    if not batch.finishedRunning():
+        return jsonify(batch_manifest(batch)), 409
+
+    manifest = batch_manifest(batch)
+
+    # The results can be huge, so the zip is kept on disk, and as images
+    # are already compressed, they're stored as they are
+    archive = tempfile.TemporaryFile()
+    with zipfile.ZipFile(archive, 'w') as zipFile:
+        added = set()
+        for job, status in zip(batch.jobs, manifest['jobs']):
+            if job.state != Job.DONE:
+                continue
+
+            # Named after the source image, with the result's extension
+            name = (
+                os.path.splitext(status['filename'])[0]
+                + os.path.splitext(job.result['key'])[1]
+            )
+            if name in added:
+                continue
+
+            try:
+                zipFile.write(job.result['path'], name)
+            except FileNotFoundError:
+                # The cache made room for newer results
+                status['error'] = 'The result is no longer saved'
+                continue
+            added.add(name)
+
+        zipFile.writestr('manifest.json', json.dumps(manifest, indent=2))
+
+    archive.seek(0)
+    return send_file(
+        archive, mimetype='application/zip', as_attachment=True,
+        download_name=f'{batch_id}.zip'
+    )
+
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port='7272')
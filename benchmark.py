@@ -0,0 +1,241 @@
+"""Benchmarks for the filter language. The results are printed as JSON,
+so that runs can be compared with each other.
+
+    python benchmark.py --sizes 4 16 64 --repeat 5
+    python benchmark.py --engines closure python --resolutions 64 256
+
+The preset filters are ran on the images in static/examples and on
+made up images of each resolution, timing how long they take to
+tokenize, parse and run. Along with the times, every result has a hash
+of the filtered pixels, so runs can also be checked to filter the same.
+"""
+
+from io import BytesIO
+from PIL import Image, ImageChops
+import argparse
+import glob
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import time
+from imgfilter import ImgFilter, Parser, Tokenizer, loadPresets
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def tokenize(text: str) -> int:
+    "Tokenizes text, returns the number of tokens."
+
+    tokenizer = Tokenizer(text)
+    count = 0
+    while tokenizer.next() is not None:
+        count += 1
+
+    return count
+
+
+def benchTokenizer(presets: dict, sizes: list, repeat: int) -> list:
+    """Tokenizes programs of about each size in kilobytes, made by
+    repeating the presets, and returns the best time for each."""
+
+    source = '\n'.join(presets.values()) + '\n'
+    results = []
+
+    for kb in sizes:
+        text = source * max(1, round(kb * 1024 / len(source)))
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            tokens = tokenize(text)
+            times.append(time.perf_counter() - start)
+
+        best = min(times)
+        results.append({
+            'bytes': len(text),
+            'tokens': tokens,
+            'seconds': best,
+            'bytesPerSecond': len(text) / best,
+            'tokensPerSecond': tokens / best,
+        })
+
+    return results
+
+
+def best(func, repeat: int) -> tuple:
+    "Calls func repeat times, returns the best time and the last result."
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+
+def loadImages(folder: str = 'static/examples') -> dict:
+    "Returns the images in folder, by name."
+
+    images = {}
+    for path in sorted(glob.glob(os.path.join(folder, '*.png'))):
+        with Image.open(path) as img:
+            images[os.path.basename(path)] = img.convert('RGB')
+
+    return images
+
+
+def makeImage(size: int) -> Image.Image:
+    """Returns a square image of size pixels across, which is always
+    the same, with a different gradient in each color."""
+
+    gradient = Image.linear_gradient('L').resize((size, size))
+    return Image.merge('RGB', (
+        gradient.rotate(90),
+        gradient,
+        ImageChops.invert(Image.radial_gradient('L').resize((size, size))),
+    ))
+
+
+def filterImage(tokens, img, engine: str, vectorize: bool,
+                workers: int) -> Image.Image:
+    "Runs the parsed program on a copy of img, returns the result."
+
+    imgFilter = ImgFilter.fromImage(
+        img, engine, vectorize=vectorize, workers=workers
+    )
+    imgFilter.run(tokens)
+    return imgFilter.img
+
+
+def encode(img) -> int:
+    "Saves img as a PNG like the web app does, returns its size."
+
+    buffer = BytesIO()
+    img.save(buffer, 'PNG')
+    return buffer.tell()
+
+
+def benchFilters(presets: dict, images: dict, engines: list,
+                 vectorize: bool, workers: int, repeat: int) -> list:
+    """Runs every preset on every image with every engine, and returns
+    the best time of each step."""
+
+    results = []
+
+    for name, text in presets.items():
+        tokenizeTime, _ = best(lambda : tokenize(text), repeat)
+        # The Parser is used directly, as parseProgram is cached
+        parseTime, tokens = best(lambda : Parser(text).tokens, repeat)
+
+        for imageName, img in images.items():
+            pixels = img.size[0] * img.size[1]
+
+            for engine in engines:
+                runTime, result = best(
+                    lambda : filterImage(
+                        tokens, img, engine, vectorize, workers
+                    ),
+                    repeat
+                )
+                encodeTime, size = best(lambda : encode(result), repeat)
+
+                results.append({
+                    'program': name,
+                    'image': imageName,
+                    'width': img.size[0],
+                    'height': img.size[1],
+                    'engine': engine,
+                    'tokenizeSeconds': tokenizeTime,
+                    'parseSeconds': parseTime,
+                    'runSeconds': runTime,
+                    'encodeSeconds': encodeTime,
+                    'pixelsPerSecond': pixels / runTime,
+                    'pngBytes': size,
+                    'output': hashlib.sha256(result.tobytes()).hexdigest(),
+                })
+
+    return results
+
+
+def describeEnvironment() -> dict:
+    "Returns what the results depend on, besides the options."
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'pillow': Image.__version__,
+        'numpy': np.__version__ if np is not None else None,
+        'time': time.time(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[4, 16, 64],
+        help='sizes of the tokenized programs, in kilobytes'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='times each benchmark is ran, the best time is kept'
+    )
+    parser.add_argument(
+        '--programs', nargs='+', default=['grayscale', 'sepia', 'sobel'],
+        help='presets from static/js/filtered.js that are ran'
+    )
+    parser.add_argument(
+        '--engines', nargs='+', choices=ImgFilter.ENGINES,
+        default=list(ImgFilter.ENGINES), help='engines the presets run with'
+    )
+    parser.add_argument(
+        '--resolutions', type=int, nargs='*', default=[64, 256],
+        help='sizes of the made up square images, in pixels'
+    )
+    parser.add_argument(
+        '--no-examples', action='store_true',
+        help="don't run the presets on the images in static/examples"
+    )
+    parser.add_argument(
+        '--no-vectorize', action='store_true',
+        help='run every preset with the engine, see Vectorizer'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='processes that tiles are split between, see TilePlan'
+    )
+    args = parser.parse_args()
+
+    presets = loadPresets()
+    unknown = set(args.programs) - set(presets)
+    if unknown:
+        parser.error(f'unknown programs {", ".join(sorted(unknown))}')
+    programs = {name: presets[name] for name in args.programs}
+
+    images = {} if args.no_examples else loadImages()
+    for size in args.resolutions:
+        images[f'{size}x{size}'] = makeImage(size)
+
+    print(json.dumps({
+        'environment': describeEnvironment(),
+        'options': vars(args),
+        'tokenizer': benchTokenizer(presets, args.sizes, args.repeat),
+        'filters': benchFilters(
+            programs, images, args.engines, not args.no_vectorize,
+            args.workers, args.repeat
+        ),
+    }, indent=2))
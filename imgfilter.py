@@ -1,6 +1,25 @@
 from PIL import Image
+from collections import OrderedDict
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+from multiprocessing import get_context, shared_memory
+import argparse
+import gc
+import hashlib
 import math
+import operator
 import re
+import sys
+import threading
+import time
+from pngstream import PngReader, PngWriter
+from storage import upright
+
+# NumPy is only needed to vectorize filters, without it every filter
+# is ran by the selected engine
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class InputStream:
     """This is the Input Stream. This will give us operations to read 
@@ -41,6 +60,19 @@ class InputStream:
         return ch
     
 
+    def skip(self, text: str) -> None:
+        """Moves the stream past text, which must be the next characters
+        in the stream."""
+
+        self.pos += len(text)
+        newlines = text.count('\n')
+        if newlines:
+            self.line += newlines
+            self.col = len(text) - text.rindex('\n') - 1
+        else:
+            self.col += len(text)
+    
+
     def eof(self) -> bool:
         "Returns true if at the end of the file"
 
@@ -66,7 +98,11 @@ class InputStream:
 
 class Token:
     """This is a token. This defines the chunks of data with the type
-    and the value."""
+    and the value, and where in the text it starts, if known."""
+
+    # The line and column of the InputStream where the token starts
+    line = None
+    col = None
 
     def __init__(self, tType: str, value):
         self.type = tType
@@ -173,6 +209,10 @@ class ForToken:
     """This is a for token. It defines a for loop, its initialization,
     its condition, and its increment condition."""
 
+    # See Token
+    line = None
+    col = None
+
     def __init__(self, tType: str, init, cond, incr, body):
         self.type = tType
         self.init = init
@@ -192,8 +232,25 @@ class Tokenizer:
     """This is the tokenizer. Utilizing the InputStream, it converts
     data read in from the input into Tokens that define the data."""
 
+    # Every kind of token is a group of one pattern, which is matched
+    # through the whole text in one pass. The groups are tried in order,
+    # and any character that isn't part of a token matches error.
+    PATTERN = re.compile(r'''
+          (?P<space>[ \t\n]+)
+        | (?P<comment>\#[^\n]*\n?)
+        | (?P<num>[0-9]+(?:\.[0-9]*)?)
+        | (?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+        | (?P<punc>[,;(){}\[\]])
+        | (?P<op>[-+*/%=&|<>!]+)
+        | (?P<error>.)
+    ''', re.VERBOSE | re.DOTALL)
+
+    KEYWORDS = frozenset(('if', 'else', 'lambda', 'true', 'false', 'for'))
+
     def __init__(self, text : str):
+        # The stream keeps track of where the tokenizer is, for errors
         self.stream = InputStream(text)
+        self.matches = self.PATTERN.finditer(text)
 
         # Because self.next doesn't always call self.readNext,
         # a current variable is needed to keep track of peeked tokens.
@@ -203,154 +260,44 @@ class Tokenizer:
     def isKeyword(self, x) -> bool:
         "Returns true if x is a keyword."
 
-        # To ensure that keywords aren't searched for in the middle of
-        # other keywords, all the keywords are surrounded with spaces
-        return " if else lambda true false for ".find(
-            ' ' + x + ' '
-        ) >= 0
-    
-
-    def isDigit(self, ch) -> bool:
-        "Returns true if ch is a digit 0-9"
-
-        return re.search('[0-9]', ch)
-    
-
-    def isIdStart(self, ch) -> bool:
-        """Returns true if ch is a character that can be at the
-        beginning of id names. Valid characters are any letter
-        regardless of case and underscores."""
-
-        return re.search('[A-Za-z_]', ch)
-    
-    
-    def isId(self, ch) -> bool:
-        """Returns true if ch is a character that can be at the
-        beginning of a keyword (see self.isIdStart) or a digit,
-        which can be in the middle or end of id names."""
-
-        return self.isIdStart(ch) or re.search("[0-9]", ch)
-    
-
-    def isOpChar(self, ch) -> bool:
-        "Returns true if ch is an operator character."
-
-        return '+-*/%=&|<>!'.find(ch) >= 0
-    
-
-    def isPunc(self, ch) -> bool:
-        "Returns true if ch is a punctuation character."
-
-        return ',;(){}[]'.find(ch) >= 0
-    
-
-    def isWhitespace(self, ch) -> bool:
-        "Returns true if ch is a space, tab, or newline character."
-
-        return ' \t\n'.find(ch) >= 0
-    
-
-    def readWhile(self, predicate) -> str:
-        """Input a boolean returning function (predicate), and readWhile
-        will return a string of the next characters in the InputStream
-        that conform to the predicate."""
-
-        text = ''
-        # Loops while not end of file and passes the predicate.
-        while not self.stream.eof() and predicate(self.stream.peek()):
-            text += self.stream.next()
-        return text
-
-
-    def isNum(self, ch) -> bool:
-        """Returns true if ch is a valid digit for a number, and is not
-        a repeating decimal point."""
-
-        # If '.', then either return False signifying that a decimal has
-        # already been read in or return True and mark the decimal as
-        # having been read in
-        if ch == '.':
-            if self._hasDot:
-                return False
-            self._hasDot = True
-            return True
-        # Else return True if ch is a valid digit
-        return self.isDigit(ch)
-    
-
-    def readNumber(self) -> Token:
-        "Reads a number and converts it into a Token(type: 'num')"
+        return x in self.KEYWORDS
 
-        # Marks the number as not yet containing a decimal point
-        self._hasDot = False
 
-        # Passes the self.isNum predicate into readWhile to get the
-        # number from the InputStream
-        num = self.readWhile(self.isNum)
+    def readNext(self) -> Token:
+        "Validates and tokenizes all the characters in the InputStream"
 
-        # Converts the string of the number into an integer or float
-        if self._hasDot:
-            num = float(num)
-        else:
-            num = int(num)
-        
-        return Token('num', num)
+        for match in self.matches:
+            kind = match.lastgroup
+            text = match.group()
 
-        
-    def readIdent(self) -> Token:
-        """Reads an identity token and determine whether it is
-        type 'kw' (keyword) or type 'var'."""
+            # Throws SyntaxError if the character doesn't fit into any
+            # group, with the stream still pointing at it
+            if kind == 'error':
+                self.stream.throw(f'Unexpected character "{text}"')
 
-        # Reads the identity from the InputStream using self.isId pred
-        id = self.readWhile(self.isId)
+            line, col = self.stream.line, self.stream.col
+            self.stream.skip(text)
 
-        # Returns the Token while also determining whether it is a
-        # keyword or a variable
-        return Token('kw' if self.isKeyword(id) else 'var', id)
-    
+            # Skip over whitespace and comments
+            if kind == 'space' or kind == 'comment':
+                continue
 
-    def skipComment(self) -> None:
-        "Skips over all the commented line in the InputStream"
+            # Converts the string of the number into an integer or float
+            if kind == 'num':
+                token = Token('num', float(text) if '.' in text else int(text))
 
-        # Continue while ch is not a new line
-        self.readWhile(lambda ch : ch != '\n')
-        self.stream.next()
+            # Determines whether it is a keyword or a variable
+            elif kind == 'ident':
+                token = Token('kw' if self.isKeyword(text) else 'var', text)
 
-    
-    def readNext(self) -> Token:
-        "Validates and tokenizes all the characters in the InputStream"
+            else:
+                token = Token(kind, text)
 
-        # Skip over whitespace and end when end of file
-        self.readWhile(self.isWhitespace)
-        if self.stream.eof():
-            return None
-        
-        # Look at next char in InputStream to validate and Tokenize
-        ch = self.stream.peek()
+            token.line, token.col = line, col
+            return token
 
-        # Checks if comment
-        if ch == '#':
-            self.skipComment()
-            return self.readNext()
-        
-        # checks if number
-        if self.isDigit(ch):
-            return self.readNumber()
-        
-        # checks if keyword or variable name
-        if self.isIdStart(ch):
-            return self.readIdent()
-        
-        # checks if punctuation
-        if self.isPunc(ch):
-            return Token('punc', self.stream.next())
-        
-        # checks if operator
-        if self.isOpChar(ch):
-            return Token('op', self.readWhile(self.isOpChar))
-        
-        # Throws SyntaxError if ch doesn't fit into any group
-        self.stream.throw(f'Unexpected character "{ch}"')
+        # End of file
+        return None
 
     
     def peek(self):
@@ -522,6 +469,16 @@ class Parser:
         self.input.throw(f'Unexpected Token: {token}')
 
 
+    def mark(self, token, start):
+        """Saves the position of start as where token starts, unless
+        that is already known, and returns token."""
+
+        if token is not None and start and token.line is None:
+            token.line, token.col = start.line, start.col
+
+        return token
+
+
     def maybeBinary(self, left, prec):
         """Checks if the next token is a binary operator as opposed to a
         unary one, and returns a BinaryToken if so. Otherwise, returns 
@@ -543,13 +500,14 @@ class Parser:
 
                 # Return a BinaryToken, while potentially filling it
                 # with more operations
+                # Operations start where their left side starts
                 return self.maybeBinary(
-                    BinaryToken(
+                    self.mark(BinaryToken(
                         'assign' if token.value == '=' else 'binary',
                         token.value,
                         left,
                         self.maybeBinary(self.parseAtom(), valPrec)
-                    ),
+                    ), left),
                     prec
                 )
         
@@ -599,22 +557,22 @@ class Parser:
         """Parses a function call, returns a CallToken containing the
         function and its parameters."""
 
-        return CallToken(
+        return self.mark(CallToken(
             'call',
             func,
             self.delimited('(', ')', ',', self.parseExpression)
-        )
+        ), func)
     
 
     def parseIndex(self, var):
         """Parses an indice, returns a IndexToken containing the
         variable name and its index."""
 
-        return IndexToken(
+        return self.mark(IndexToken(
             'index',
             var,
             self.delimited('[', ']', ',', self.parseExpression)
-        )
+        ), var)
     
 
     def parseVarName(self) -> str:
@@ -767,7 +725,11 @@ class Parser:
         """Parses the next collection of Tokens, while also checking if
         is a function call or an index."""
 
-        return self.maybeAccess(self._parseAtomHelper)
+        # Keywords and braces are where the tokens made from them start
+        start = self.input.peek()
+        return self.maybeAccess(
+            lambda : self.mark(self._parseAtomHelper(), start)
+        )
     
 
     def parseTopLevel(self):
@@ -786,25 +748,28 @@ class Parser:
             if not self.input.eof():
                 self.skipPunc(';')
 
-        return Token('prog', prog)
+        prog = Token('prog', prog)
+        prog.line, prog.col = 1, 0
+        return prog
     
 
     def parseProg(self):
         "Parses code in between {}, returns a Token of type 'prog'."
 
         # Parses all the code in between the {}s
+        start = self.input.peek()
         prog = self.delimited('{', '}', ';', self.parseExpression)
 
         # If there were no Tokens in between the {}s,
         # return a False Token
         if len(prog) == 0:
-            return Token('bool', False)
+            return self.mark(Token('bool', False), start)
         # Or if there was only one expression in the braces,
         # just return the expression
         if len(prog) == 1:
             return prog[0]
         
-        return Token('prog', prog)
+        return self.mark(Token('prog', prog), start)
     
 
     def _parseExprHelper(self):
@@ -829,39 +794,25 @@ class Environment:
     scope by giving it another instance of Environment via parent."""
 
 
-    def __init__(self, vars : dict = dict(), parent = None):
-        # dictionary of variables in scope
-        self.vars = vars
+    def __init__(self, vars : dict = None, parent = None):
+        # dictionary of variables in scope, every scope gets its own
+        # dictionary so that variables don't leak between scopes
+        self.vars = {} if vars is None else vars
         # parent Environment instance, used to simiulate scope
         self.parent : Environment = parent
 
 
-    def _lookup(self, key):
-        "Checks to see if key is in scope or parent's scope."
-
-        # Checks own scope
-        if key in self.vars:
-            return True
-        
-        # Checks if there is a parent
-        if not self.parent:
-            return False
-
-        # Checks parent's scope
-        return self.parent._lookup(key)
-
-    
     def __getitem__(self, key):
         "Gets item from either own scope or parent's scope."
 
-        # If key in scope, return value
-        if key in self.vars:
-            return self.vars[key]
-        
-        # If key in parent, return value
-        if self.parent and self.parent._lookup(key):
-            return self.parent[key]
-        
+        # Walks up through the scopes once, from own scope to the
+        # outermost one, returning the first value found
+        env = self
+        while env is not None:
+            if key in env.vars:
+                return env.vars[key]
+            env = env.parent
+
         # KeyError, key not found
         raise KeyError(key)
     
@@ -872,268 +823,3902 @@ class Environment:
         self.vars[key] = value
 
 
-# This could also be made into a function, or we could apply multiple
-# filters to one image, which is an interesting idea
-class ImgFilter:
-    """The ImgFilter class will take the given image and open it, and
-    also evaluate the written code, giving it ways to access and filter
-    the given image."""
+class Resolver:
+    """The Resolver walks through the tokens once before they are ran,
+    and gives every variable of a for loop or a lambda a numbered slot
+    in that scope, so that running the program indexes into a list
+    instead of searching through the dictionaries of an Environment.
 
-    def __init__(self, imgname):
-        self.imgname = imgname
-        # Opens the image and saves it to the class
-        with Image.open(f'static/images/source/{imgname}') as self.img:
-            if self.img.mode != 'RGB':
-                self.img = self.img.convert('RGB')
-            # Also saves the pixels, which is what we can edit to change
-            # the photo
-            self.pixels = self.img.load()
+    Each time a for loop or lambda runs, it makes a frame, which is a
+    list laid out like [parent frame, globals, slot 2, slot 3, ...].
+    The globals are the dictionary of ImgFilter.env, shared by every
+    frame, and the outermost frame is just [None, globals].
 
-        # Saves the dimensions for use in the user's code
-        self.width = self.img.size[0]
-        self.height = self.img.size[1]
+    Assignment always saves to the current scope, so every assignment
+    knows its slot, or None when it saves to the globals. A variable is
+    read from the first scope around it that has it assigned, which can
+    depend on what has ran so far, so reading a variable gives a tuple
+    of (depth, slot) addresses, nearest first, that are tried in order
+    before the globals. Slots that weren't assigned yet hold UNSET."""
 
-        # Saves variables accessible to the user
-        self.env = Environment({
-            'pixels': self.pixels,
-            'width': self.width,
-            'height': self.height,
-            'rgb': lambda r, g, b : (int(r), int(g), int(b)),
-            'loadColor': lambda x, y : self.loadColor(x, y),
-            'makeRef': self.makeRef,
-            'loadRef': lambda x, y : self.loadRef(x, y),
-            'sqrt': lambda x : math.sqrt(x)
-        })
+    UNSET = object()
 
+    # Each frame starts with its parent frame and the globals
+    FIRST_SLOT = 2
 
-    def evaluate(self, token: Token, env):
-        """Reads tokens and returns and saves them in a way usable by
-        Python."""
+    def __init__(self, tokens):
+        # Kept so that the ids of the tokens stay unique
+        self.tokens = tokens
 
-        # Gets the type of the given token
-        typ = token.type
+        # The addresses of each variable read, by id of its Token
+        self.reads = {}
+        # The slot of each assignment, by id of its Token
+        self.writes = {}
+        # The slots of each lambda's parameters, by id of its Token
+        self.params = {}
+        # The size of the frame of each for loop and lambda
+        self.sizes = {}
 
-        # If number or boolean, return the value as int, float, or bool
-        if typ in ('num', 'bool'):
-            return token.value
-        
-        # If the name of a variable, return the value of the variable
-        if typ == 'var':
-            return env[token.value]
-        
-        # If assignment token, then save the variable to the environment
-        if typ == 'assign':
-            # If the token that is to be saved is an index
-            if token.left.type == 'index':
-                if token.left.var.value != 'pixels':
-                    raise SyntaxError(f'Cannot assign to {token.left}')
-                if len(token.left.index) != 2:
-                    raise SyntaxError(f'index must include x and y')
-                if token.right.value.value != 'rgb':
-                    raise SyntaxError(
-                        f'rgb function must be used to save to pixels'
-                    )
-                
-                x = self.evaluate(token.left.index[0], env)
-                y = self.evaluate(token.left.index[1], env)
+        # Scopes are (slots by name, parent scope), and the globals are
+        # None. Reads wait until every scope knows all of its names.
+        self.scopes = {}
+        self.pending = []
+        self.visit(tokens, None)
 
-                color = self.evaluate(token.right, env)
-                env[token.left.var.value][x, y] = color
+        for token, scope in self.pending:
+            self.reads[id(token)] = self.addresses(token.value, scope)
 
-                return color
+        for key, names in self.scopes.items():
+            self.sizes[key] = self.FIRST_SLOT + len(names)
 
-            # If the token that is supposed to be saved to isn't a
-            # variable name, then throw an error
-            if token.left.type != 'var':
-                raise SyntaxError(f'Cannot assign to {token.left}')
-            # Otherwise, evaluate the tokens that are supposed to be
-            # assigned to the variable
-            value = self.evaluate(token.right, env)
-            # And then save it to the environment
-            env[token.left.value] = value
-            # And return the value that was saved
-            return value
-        
-        # If it is a BinaryToken, then apply the operation
-        # and return the value
-        if typ == 'binary':
-            return self.applyOp(
-                # First give the operator
-                op = token.value,
-                # Then the numbers that are being operated on
-                a  = self.evaluate(token.left, env),
-                b  = self.evaluate(token.right, env)
-            )
+        del self.pending
+        del self.scopes
 
-        # If it is a lambda token, then call makeLambda, a functino
-        # used for Interpreting functions and making them callable
-        if typ == 'lambda':
-            return self.makeLambda(token, env) 
+
+    def declare(self, name, scope):
+        "Returns the slot of name in scope, giving it one if needed."
+
+        if scope is None:
+            return None
         
-        # If it is an IfToken
-        if typ == 'if':
-            # Evaluate the if condition
-            cond = self.evaluate(token.value, env)
+        names = scope[0]
+        if name not in names:
+            names[name] = self.FIRST_SLOT + len(names)
+        return names[name]
+    
 
-            # If a condition is true,
-            # evaluate the then part of the IfToken
-            # else, evaluate otherwise of IfToken
-            # Finally return False if there was no condition
-            # and there was no otherwise statement
-            if cond:
-                return self.evaluate(token.then, env)
-            elif token.otherwise:
-                return self.evaluate(token.otherwise, env)
-            else:
-                return False
-            
-        # If type 'prog', go through all the contained tokens
-        # and evaluate them, returning the value of the final token
-        if typ == 'prog':
-            val = False
-            for expr in token.value:
-                val = self.evaluate(expr, env)
-            return val
+    def addresses(self, name, scope) -> tuple:
+        "Returns every (depth, slot) that name could be read from."
 
-        # If the Token is calling a function
-        if typ == 'call':
-            # Get the function saved in memory by evaluating the name
-            # of the function
-            func = self.evaluate(token.value, env)
+        found = []
+        depth = 0
+        while scope is not None:
+            if name in scope[0]:
+                found.append((depth, scope[0][name]))
+            scope = scope[1]
+            depth += 1
 
-            # And then apply the saved args to the function using the
-            # splat operator to unpack it into the function
-            return func(
-                *[self.evaluate(arg, env) for arg in token.args]
-            )
-        
-        # If the Token is a for loop
-        if typ == 'for':
-            return self.forEval(token, env)
-        
-        # Raise an error if the token isn't recognized
-        raise SyntaxError(f'Unable to evaluate {token}')
+        return tuple(found)
     
 
-    def applyOp(self, op, a, b):
-        """The applyOp function will perform the given operation (op)
-        on a and b."""
+    def newScope(self, token, scope):
+        "Makes the scope of a for loop or lambda."
 
-        def num(x):
-            "This will ensure that x is operable."
+        inner = ({}, scope)
+        self.scopes[id(token)] = inner[0]
+        return inner
 
-            # If it's not an int or a float, throw an error
-            if type(x) != int and type(x) != float:
-                raise TypeError(
-                    f'Expected int of float, got {x}, type {type(x)}'
-                )
-            return x
-        
-        def div(x):
-            """This will ensure that x is both not zero (so that other
-            numbers can be divided by it), and is operable."""
 
-            if num(x) == 0:
-                raise ZeroDivisionError('division by zero')
-            return x
-        
-        # Applies the operator
-        if op == '+' : return num(a) + num(b)
-        if op == '-' : return num(a) - num(b)
-        if op == '*' : return num(a) * num(b)
-        if op == '/' : return num(a) / div(b)
-        if op == '%' : return num(a) % div(b)
-        if op == '&&': return a != False and b
-        if op == '||': return a if a != False else b
-        if op == '<' : return num(a) < num(b)
-        if op == '>' : return num(a) > num(b)
-        if op == '<=': return num(a) <= num(b)
-        if op == '>=': return num(a) >= num(b)
-        if op == '==': return a == b
-        if op == '!=': return a != b
-        if op == '//': return num(a) // div(b)
+    def visit(self, token, scope):
+        "Gives slots to the variables in token, which runs in scope."
 
-        # Throw an error if unrecognized operator
-        raise SyntaxError(f'Unrecognized operator {op}')
-    
+        typ = token.type
 
-    def makeLambda(self, token, env):
-        """The makeLambda function will return a function that will
-        evaluate tokens and run them when called."""
+        if typ == 'var':
+            self.pending.append((token, scope))
+
+        elif typ == 'assign':
+            left = token.left
+            if left.type == 'var':
+                self.visit(token.right, scope)
+                self.writes[id(token)] = self.declare(left.value, scope)
+            elif left.type == 'index':
+                self.visit(left.var, scope)
+                for expr in left.index:
+                    self.visit(expr, scope)
+                self.visit(token.right, scope)
+
+        elif typ == 'binary':
+            self.visit(token.left, scope)
+            self.visit(token.right, scope)
+
+        elif typ == 'if':
+            self.visit(token.value, scope)
+            self.visit(token.then, scope)
+            if token.otherwise:
+                self.visit(token.otherwise, scope)
+
+        elif typ == 'prog':
+            for expr in token.value:
+                self.visit(expr, scope)
 
-        # The function to be returned, this will
-        # usually be saved to the environment
-        def func(*argv):
-            # Read the variable names given by the lambda token
-            names = token.vars
+        elif typ == 'call':
+            self.visit(token.value, scope)
+            for arg in token.args:
+                self.visit(arg, scope)
 
-            # Create a new environment that will simulate scope,
-            # ensuring that variables saved in the function will not
-            # be accessible from outside of the function
-            scope = Environment(parent=env)
+        elif typ == 'lambda':
+            inner = self.newScope(token, scope)
+            self.params[id(token)] = [
+                self.declare(name, inner) for name in token.vars
+            ]
+            self.visit(token.body, inner)
 
-            # Saves the given parameters in *argv to the names given
-            # to the function inside the local scope
-            for i in range(len(names)):
-                # If a position arg wasn't given, save it as False
-                scope[names[i]] = argv[i] if i < len(argv) else False
+        elif typ == 'for':
+            inner = self.newScope(token, scope)
+            for part in (token.init, token.cond, token.incr, token.body):
+                self.visit(part, inner)
+
+
+    def frame(self, token, parent) -> list:
+        "Returns a new frame for a for loop or lambda."
+
+        return [parent, parent[1]] + [self.UNSET] * (
+            self.sizes[id(token)] - self.FIRST_SLOT
+        )
+    
+
+    @staticmethod
+    def lookup(frame, name, addresses):
+        """Returns the value of a variable, from the first of its
+        addresses that was assigned, or otherwise from the globals."""
+
+        unset = Resolver.UNSET
+        for depth, slot in addresses:
+            scope = frame
+            for _ in range(depth):
+                scope = scope[0]
             
-            # Returns the last read value
-            return self.evaluate(token.body, scope)
+            value = scope[slot]
+            if value is not unset:
+                return value
         
-        # Returns the generated function
-        return func
+        # KeyError, key not found
+        return frame[1][name]
     
 
-    def forEval(self, token, env):
-        "Loops through for loop while its condition is true."
+def checkNum(x):
+    "This will ensure that x is operable."
 
-        scope = Environment(parent=env)
+    # If it's not an int or a float, throw an error
+    if type(x) != int and type(x) != float:
+        raise TypeError(
+            f'Expected int of float, got {x}, type {type(x)}'
+        )
+    return x
+
+
+def checkDiv(x):
+    """This will ensure that x is both not zero (so that other
+    numbers can be divided by it), and is operable."""
+
+    if checkNum(x) == 0:
+        raise ZeroDivisionError('division by zero')
+    return x
+
+
+# The operations that BinaryTokens can apply, looked up by operator.
+# Both sides are always evaluated before the operation is applied,
+# so && and || don't short circuit.
+OPERATORS = {
+    '+' : lambda a, b : checkNum(a) + checkNum(b),
+    '-' : lambda a, b : checkNum(a) - checkNum(b),
+    '*' : lambda a, b : checkNum(a) * checkNum(b),
+    '/' : lambda a, b : checkNum(a) / checkDiv(b),
+    '%' : lambda a, b : checkNum(a) % checkDiv(b),
+    '&&': lambda a, b : a != False and b,
+    '||': lambda a, b : a if a != False else b,
+    '<' : lambda a, b : checkNum(a) < checkNum(b),
+    '>' : lambda a, b : checkNum(a) > checkNum(b),
+    '<=': lambda a, b : checkNum(a) <= checkNum(b),
+    '>=': lambda a, b : checkNum(a) >= checkNum(b),
+    '==': lambda a, b : a == b,
+    '!=': lambda a, b : a != b,
+    '//': lambda a, b : checkNum(a) // checkDiv(b),
+}
+
+
+def dumpToken(token):
+    """Returns nested tuples describing a token and all the tokens it
+    contains, which can be compared or hashed."""
+
+    # Lists of tokens, like the body of a program or function arguments
+    if isinstance(token, list):
+        return tuple(dumpToken(t) for t in token)
+    
+    # Plain values, like numbers, names, or a missing else statement
+    if not isinstance(token, (Token, ForToken)):
+        return token
+    
+    typ = token.type
 
-        self.evaluate(token.init, scope)
+    if typ == 'for':
+        return (
+            typ, dumpToken(token.init), dumpToken(token.cond),
+            dumpToken(token.incr), dumpToken(token.body)
+        )
+    if typ == 'lambda':
+        return (typ, tuple(token.vars), dumpToken(token.body))
+    if typ == 'index':
+        return (typ, dumpToken(token.var), dumpToken(token.index))
+    if typ == 'if':
+        return (
+            typ, dumpToken(token.value), dumpToken(token.then),
+            dumpToken(token.otherwise)
+        )
+    if typ == 'call':
+        return (typ, dumpToken(token.value), dumpToken(token.args))
+    if isinstance(token, BinaryToken):
+        return (
+            typ, token.value, dumpToken(token.left),
+            dumpToken(token.right)
+        )
+    
+    # Numbers, booleans, variable names and programs
+    return (typ, dumpToken(token.value))
+
+
+def hashProgram(token) -> str:
+    """Returns a hash of a parsed program, programs that parse to the
+    same tokens will always have the same hash."""
+
+    # repr keeps 1 and 1.0 apart, unlike comparing the tuples
+    return hashlib.sha256(repr(dumpToken(token)).encode()).hexdigest()
+
+
+def hashPipeline(stages) -> str:
+    """Returns a hash of parsed programs that are ran one after the
+    other, see ImgFilter.runPipeline. A single program has the same hash
+    as it does with hashProgram."""
+
+    if len(stages) == 1:
+        return hashProgram(stages[0])
+
+    hashes = ' '.join(hashProgram(tokens) for tokens in stages)
+    return hashlib.sha256(hashes.encode()).hexdigest()
+
+
+def formatToken(token) -> str:
+    """Returns code that would parse into token, which is used to
+    describe tokens in messages. Programs, loops and lambdas are only
+    described by their type."""
+
+    typ = token.type
+
+    if typ == 'num':
+        return repr(token.value)
+    if typ == 'bool':
+        return 'true' if token.value else 'false'
+    if typ == 'var':
+        return token.value
+    if isinstance(token, BinaryToken):
+        # Nested operations are wrapped, so the order stays clear
+        left, right = [
+            f'({formatToken(t)})' if isinstance(t, BinaryToken)
+            else formatToken(t)
+            for t in (token.left, token.right)
+        ]
+        return f'{left} {token.value} {right}'
+    if typ == 'call':
+        args = ', '.join(formatToken(arg) for arg in token.args)
+        return f'{formatToken(token.value)}({args})'
+    if typ == 'index':
+        index = ', '.join(formatToken(i) for i in token.index)
+        return f'{formatToken(token.var)}[{index}]'
+    if typ == 'if':
+        return f'if ({formatToken(token.value)})'
+    
+    return typ
 
-        while self.evaluate(token.cond, scope):
-            self.evaluate(token.body, scope)
-            self.evaluate(token.incr, scope)
+
+class LRUCache:
+    """A thread safe dictionary that only keeps the most recently used
+    items, forgetting the least recently used item once it is full. It
+    keeps count of how many times items were found (hits) or not found
+    (misses)."""
+
+    # Used to tell apart missing items and items that are None
+    MISSING = object()
+
+    def __init__(self, size: int):
+        # The most items that are kept
+        self.size = size
+        # Items are kept in order from least to most recently used
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key, default = None):
+        "Returns the item, or default if it isn't cached."
+
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
         
-        return None
-    
 
-    def loadColor(self, x, y):
-        r, g, b = self.pixels[x, y]
+    def put(self, key, value):
+        "Saves an item, forgetting the least recently used if full."
 
-        self.env['r'] = r
-        self.env['g'] = g
-        self.env['b'] = b
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
 
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+    
 
-    def makeRef(self):
-        self.ref = self.img.copy().load()
+    def getOrCreate(self, key, create):
+        """Returns the item, or calls create to make it and saves it.
+        create is called outside of the lock, so two threads might
+        both create the same item."""
 
+        value = self.get(key, self.MISSING)
+        if value is self.MISSING:
+            value = create()
+            self.put(key, value)
+        return value
+    
 
-    def loadRef(self, x, y):
-        r, g, b = self.ref[x, y]
+    def clear(self):
+        "Forgets every item and resets the counts."
 
-        self.env['r'] = r
-        self.env['g'] = g
-        self.env['b'] = b
+        with self.lock:
+            self.items.clear()
+            self.hits = 0
+            self.misses = 0
     
 
-    def __call__(self, text):
-        """When an initiated ImgFilter class is called and given code
-        to read, it will run that code."""
+    def stats(self) -> dict:
+        "Returns the size and hit and miss counts of the cache."
 
-        parser = Parser(text)
+        with self.lock:
+            return {
+                'size': len(self.items),
+                'maxSize': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+    
 
-        self.evaluate(parser.tokens, self.env)
-        self.img.save(f'static/images/filtered/{self.imgname}')
+    def __len__(self):
+        return len(self.items)
 
 
-if __name__ == '__main__':
-    with open('filters/grayscale.txt', 'r') as file:
+def normalizeText(text: str) -> str:
+    """Normalizes the code of a filter, so that the same code with
+    different line endings or trailing whitespace is cached once."""
+
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return '\n'.join(line.rstrip() for line in text.split('\n')).rstrip()
+
+
+def loadPresets(path: str = 'static/js/filtered.js') -> dict:
+    "Returns the preset programs of the editor, by name."
+
+    with open(path, 'r') as file:
         text = file.read()
 
-    img = ImgFilter('cad.png')
-    img.env['print'] = lambda x : print(x)
+    return {
+        name.lower(): normalizeText(body)
+        for name, body in re.findall(r'const (\w+) = `(.*?)`;', text, re.S)
+    }
 
-    img(text)
+
+# Parsed programs by the hash of their normalized code
+PARSE_CACHE = LRUCache(256)
+
+
+def parseProgram(text: str) -> Token:
+    """Parses code into tokens, reusing the tokens if the same code was
+    parsed before. The same tokens are shared by everyone who parses the
+    same code, so nothing that runs them is allowed to change them."""
+
+    text = normalizeText(text)
+    key = hashlib.sha256(text.encode()).hexdigest()
+
+    return PARSE_CACHE.getOrCreate(key, lambda : Parser(text).tokens)
+
+
+class Optimizer:
+    """The Optimizer runs between the Parser and the engines, and
+    returns new tokens that do the same thing with less work. Every
+    change is described in self.removed. The parsed tokens are shared,
+    see parseProgram, so they are never changed.
+
+    It folds operations on literals into a single literal, simplifies
+    operations like 1 * r into r, replaces if statements with a literal
+    condition by the branch that would run, and drops assignments to
+    variables that are never read. Anything that would throw an error,
+    like dividing by a literal 0, is left to throw when it runs."""
+
+    # Operators that always give back a number
+    ARITHMETIC = ('+', '-', '*', '/', '%', '//')
+
+    # Operators that throw an error if either side isn't a number
+    CHECKED = ARITHMETIC + ('<', '>', '<=', '>=')
+
+    def __init__(self):
+        self.removed = []
+
+        # The names of every variable read by the program, assignments
+        # are only dropped once they are known
+        self.reads = None
+
+
+    def optimize(self, tokens):
+        "Returns the optimized tokens of a program."
+
+        # Dropping an assignment can stop other variables from being
+        # read, so this runs until nothing else is dropped
+        while True:
+            count = len(self.removed)
+            self.reads = set()
+            self.findReads(tokens)
+
+            tokens = self.visit(tokens, True, False)
+            if len(self.removed) == count:
+                return tokens
+    
+
+    def findReads(self, token):
+        "Adds the name of every variable read in token to self.reads."
+
+        if isinstance(token, list):
+            for t in token:
+                self.findReads(t)
+            return
+        
+        if not isinstance(token, (Token, ForToken)):
+            return
+
+        typ = token.type
+
+        if typ == 'var':
+            self.reads.add(token.value)
+        elif typ == 'for':
+            self.findReads([token.init, token.cond, token.incr, token.body])
+        elif typ == 'lambda':
+            self.findReads(token.body)
+        elif typ == 'index':
+            self.findReads([token.var] + token.index)
+        elif typ == 'if':
+            self.findReads([token.value, token.then, token.otherwise])
+        elif typ == 'call':
+            self.findReads([token.value] + token.args)
+        elif typ == 'assign' and token.left.type == 'var':
+            # Saving to a variable isn't reading it
+            self.findReads(token.right)
+        elif isinstance(token, BinaryToken):
+            self.findReads([token.left, token.right])
+        elif typ == 'prog':
+            self.findReads(token.value)
+    
+
+    def isLiteral(self, token) -> bool:
+        "Returns true if token is a number or boolean."
+
+        return token.type in ('num', 'bool')
+    
+
+    def isInt(self, token, value) -> bool:
+        "Returns true if token is the integer value."
+
+        return (
+            token.type == 'num' and type(token.value) == int
+            and token.value == value
+        )
+    
+
+    def isNumber(self, token) -> bool:
+        "Returns true if token always gives back a number."
+
+        return token.type == 'num' or (
+            token.type == 'binary' and token.value in self.ARITHMETIC
+        )
+    
+
+    def literal(self, value) -> Token:
+        "Returns a Token holding value."
+
+        return Token('bool' if type(value) == bool else 'num', value)
+    
+
+    def visit(self, token, used, checked):
+        """Returns the optimized token. If used is false, the value of
+        the token isn't needed, and None is returned if it does nothing.
+        If checked is true, the value must be a number, or the operation
+        that uses it will throw an error.
+
+        New tokens start where the token they replace started, so they
+        can still be found in the text, see Profiler."""
+
+        new = self.visitToken(token, used, checked)
+
+        if new is not None and new.line is None:
+            new.line, new.col = token.line, token.col
+        
+        return new
+    
+
+    def visitToken(self, token, used, checked):
+        "Returns the optimized token, see self.visit."
+
+        typ = token.type
+
+        if typ == 'assign':
+            return self.visitAssign(token, used)
+        if typ == 'binary':
+            return self.visitBinary(token, checked)
+        if typ == 'if':
+            return self.visitIf(token, used, checked)
+
+        if typ == 'prog':
+            exprs = []
+            for i, expr in enumerate(token.value):
+                last = i == len(token.value) - 1
+                expr = self.visit(expr, used and last, False)
+
+                # Values that aren't used and do nothing are dropped
+                if expr is None or (
+                    not (used and last)
+                    and (self.isLiteral(expr) or expr.type == 'lambda')
+                ):
+                    continue
+                exprs.append(expr)
+            
+            return Token('prog', exprs)
+        
+        if typ == 'call':
+            return CallToken(
+                'call', self.visit(token.value, True, False),
+                [self.visit(arg, True, False) for arg in token.args]
+            )
+        
+        if typ == 'lambda':
+            return FuncToken(
+                'lambda', token.vars, self.visit(token.body, True, False)
+            )
+        
+        if typ == 'for':
+            # A body that does nothing is replaced with False, like the
+            # branches of an if statement
+            return ForToken(
+                'for',
+                init = self.visit(token.init, True, False),
+                cond = self.visit(token.cond, True, False),
+                incr = self.visit(token.incr, True, False),
+                body = (
+                    self.visit(token.body, False, False)
+                    or Token('bool', False)
+                )
+            )
+        
+        # Numbers, booleans, variables, and tokens that will throw an
+        # error when they are reached
+        return token
+    
+
+    def visitAssign(self, token, used):
+        "Returns an optimized assignment."
+
+        left = token.left
+
+        if left.type == 'index':
+            index = IndexToken(
+                'index', self.visit(left.var, True, False),
+                [self.visit(i, True, False) for i in left.index]
+            )
+            index.line, index.col = left.line, left.col
+            return BinaryToken(
+                'assign', token.value, index,
+                self.visit(token.right, True, False)
+            )
+        
+        # Throws an error when it is reached
+        if left.type != 'var':
+            return token
+
+        right = self.visit(token.right, True, False)
+
+        # The value is still evaluated, in case it does something
+        if left.value not in self.reads:
+            self.removed.append(f'assignment to {left.value}')
+            return right if used or not self.isLiteral(right) else None
+        
+        return BinaryToken('assign', token.value, left, right)
+    
+
+    def visitBinary(self, token, checked):
+        "Returns an optimized operation."
+
+        op = token.value
+        check = op in self.CHECKED
+        left = self.visit(token.left, True, check)
+        right = self.visit(token.right, True, check)
+
+        # Operations on literals are done right away, unless they
+        # throw an error
+        if op in OPERATORS and self.isLiteral(left) and self.isLiteral(right):
+            try:
+                value = OPERATORS[op](left.value, right.value)
+            except Exception:
+                pass
+            else:
+                folded = BinaryToken('binary', op, left, right)
+                self.removed.append(
+                    f'{formatToken(folded)}, folded into {value!r}'
+                )
+                return self.literal(value)
+
+        # 1 * x, x * 1, 0 + x, x + 0, and x - 0 are just x, as long as
+        # x is still checked to be a number
+        other = None
+        if op == '*' and self.isInt(left, 1):
+            other = right
+        elif op == '*' and self.isInt(right, 1):
+            other = left
+        elif op == '+' and self.isInt(left, 0):
+            other = right
+        elif op in ('+', '-') and self.isInt(right, 0):
+            other = left
+        
+        if other is not None and (checked or self.isNumber(other)):
+            simplified = BinaryToken('binary', op, left, right)
+            self.removed.append(
+                f'{formatToken(simplified)}, simplified to '
+                f'{formatToken(other)}'
+            )
+            return other
+
+        return BinaryToken('binary', op, left, right)
+    
+
+    def visitIf(self, token, used, checked):
+        "Returns an optimized if statement."
+
+        cond = self.visit(token.value, True, False)
+
+        # Only one branch can run when the condition is a literal
+        if self.isLiteral(cond):
+            branch = token.then if cond.value else token.otherwise
+            self.removed.append(
+                f'if ({formatToken(cond)}), '
+                f'{"else" if cond.value else "then"} branch'
+            )
+
+            if branch is None:
+                return Token('bool', False) if used else None
+            return self.visit(branch, used, checked)
+        
+        # Branches can't be dropped, so they are replaced with False
+        then = self.visit(token.then, used, checked) or Token('bool', False)
+        otherwise = token.otherwise and (
+            self.visit(token.otherwise, used, checked)
+            or Token('bool', False)
+        )
+
+        return IfToken('if', cond, then, otherwise)
+
+
+class Compiler:
+    """The Compiler class walks through the tokens made by the Parser
+    a single time, and turns every token into a Python closure. Each
+    closure already knows what kind of token it was made from, so when
+    the program runs, it doesn't have to check the type of every token
+    over and over again for every pixel, like ImgFilter.evaluate does.
+    
+    Variables are read from and saved to the frames of the Resolver, so
+    every closure that uses a variable already knows its slot.
+    
+    Compiling gives back a function that takes an Environment, and
+    running that function behaves exactly like evaluating the tokens
+    with ImgFilter.evaluate. With a Profiler, every closure is measured
+    as the token it was made from."""
+
+    def __init__(self, profiler = None):
+        self.profiler = profiler
+
+        # Maps each type of token to the method that compiles it
+        self.compilers = {
+            'num': self.compileLiteral,
+            'bool': self.compileLiteral,
+            'var': self.compileVar,
+            'assign': self.compileAssign,
+            'binary': self.compileBinary,
+            'lambda': self.compileLambda,
+            'if': self.compileIf,
+            'prog': self.compileProg,
+            'call': self.compileCall,
+            'for': self.compileFor,
+        }
+
+
+    def compile(self, tokens):
+        """Compiles a program, returns a function that takes the global
+        Environment and runs the program."""
+
+        self.resolver = Resolver(tokens)
+        run = self.compileToken(tokens)
+
+        return lambda env : run([None, env.vars])
+    
+
+    def compileToken(self, token):
+        """Compiles a token and all the tokens it contains, returns a
+        function that takes a frame and runs the token."""
+
+        # Gets the method that compiles this type of token
+        compiler = self.compilers.get(token.type)
+
+        # Tokens that can't be evaluated only throw an error when they
+        # are reached, just like they would in ImgFilter.evaluate
+        if compiler is None:
+            return self.compileError(
+                SyntaxError, f'Unable to evaluate {token}'
+            )
+        
+        if self.profiler:
+            return self.profiler.wrap(compiler(token), token)
+        
+        return compiler(token)
+    
+
+    def compileError(self, error, msg):
+        "Returns a function that throws an error when ran."
+
+        def run(frame):
+            raise error(msg)
+        
+        return run
+    
+
+    def compileLiteral(self, token):
+        "Compiles a number or boolean, which always returns its value."
+
+        value = token.value
+        return lambda frame : value
+    
+
+    def compileVar(self, token):
+        "Compiles a variable name, which looks up the variable."
+
+        name = token.value
+        addresses = self.resolver.reads[id(token)]
+        unset = Resolver.UNSET
+
+        # Only ever a global variable
+        if not addresses:
+            return lambda frame : frame[1][name]
+        
+        # Only ever a variable of this scope, or a global variable
+        if len(addresses) == 1 and addresses[0][0] == 0:
+            slot = addresses[0][1]
+
+            def run(frame):
+                value = frame[slot]
+                return frame[1][name] if value is unset else value
+            
+            return run
+        
+        lookup = Resolver.lookup
+        return lambda frame : lookup(frame, name, addresses)
+    
+
+    def compileAssign(self, token):
+        """Compiles an assignment, either saving a variable to the
+        environment or saving a color to the pixels."""
+
+        # If the token that is to be saved is an index
+        if token.left.type == 'index':
+            return self.compilePixelAssign(token)
+        
+        # If the token that is supposed to be saved to isn't a
+        # variable name, then throw an error
+        if token.left.type != 'var':
+            return self.compileError(
+                SyntaxError, f'Cannot assign to {token.left}'
+            )
+        
+        name = token.left.value
+        slot = self.resolver.writes[id(token)]
+        right = self.compileToken(token.right)
+
+        # Saves to the globals from the outermost scope
+        if slot is None:
+            def run(frame):
+                # Evaluate the value, save it and return it
+                value = right(frame)
+                frame[1][name] = value
+                return value
+            
+            return run
+
+        def run(frame):
+            value = right(frame)
+            frame[slot] = value
+            return value
+        
+        return run
+    
+
+    def compilePixelAssign(self, token):
+        "Compiles saving a color to pixels[x, y]."
+
+        left = token.left
+        
+        # The same checks that ImgFilter.evaluate makes,
+        # except they only have to be made once
+        if left.var.value != 'pixels':
+            return self.compileError(
+                SyntaxError, f'Cannot assign to {left}'
+            )
+        if len(left.index) != 2:
+            return self.compileError(
+                SyntaxError, f'index must include x and y'
+            )
+        if getattr(token.right.value, 'value', None) != 'rgb':
+            return self.compileError(
+                SyntaxError, f'rgb function must be used to save to pixels'
+            )
+        
+        getPixels = self.compileToken(left.var)
+        getX = self.compileToken(left.index[0])
+        getY = self.compileToken(left.index[1])
+        getColor = self.compileToken(token.right)
+
+        def run(frame):
+            x = getX(frame)
+            y = getY(frame)
+
+            color = getColor(frame)
+            getPixels(frame)[x, y] = color
+
+            return color
+        
+        return run
+    
+
+    def compileBinary(self, token):
+        "Compiles a binary operation, looking up the operator once."
+
+        # An unrecognized operator only throws once it's reached
+        if token.value not in OPERATORS:
+            return self.compileError(
+                SyntaxError, f'Unrecognized operator {token.value}'
+            )
+        
+        op = OPERATORS[token.value]
+        left = self.compileToken(token.left)
+        right = self.compileToken(token.right)
+
+        return lambda frame : op(left(frame), right(frame))
+    
+
+    def compileLambda(self, token):
+        """Compiles a lambda, which returns a function when ran, see
+        ImgFilter.makeLambda."""
+
+        params = self.resolver.params[id(token)]
+        newFrame = self.resolver.frame
+        body = self.compileToken(token.body)
+
+        def run(frame):
+            step = frame[1]['@step']
+
+            # The function that the user will call
+            def func(*argv):
+                step()
+
+                # New scope for the variables in the function
+                scope = newFrame(token, frame)
+
+                # If a position arg wasn't given, save it as False
+                for i in range(len(params)):
+                    scope[params[i]] = argv[i] if i < len(argv) else False
+                
+                return body(scope)
+            
+            return func
+        
+        return run
+    
+
+    def compileIf(self, token):
+        "Compiles an if statement and its potential else statement."
+
+        cond = self.compileToken(token.value)
+        then = self.compileToken(token.then)
+
+        # Without an else statement, a false condition returns False
+        if not token.otherwise:
+            return lambda frame : then(frame) if cond(frame) else False
+        
+        otherwise = self.compileToken(token.otherwise)
+        return lambda frame : (
+            then(frame) if cond(frame) else otherwise(frame)
+        )
+    
+
+    def compileProg(self, token):
+        """Compiles a program, which runs each expression and returns
+        the value of the last one."""
+
+        exprs = [self.compileToken(expr) for expr in token.value]
+
+        def run(frame):
+            val = False
+            for expr in exprs:
+                val = expr(frame)
+            return val
+        
+        return run
+    
+
+    def compileCall(self, token):
+        "Compiles a function call and its arguments."
+
+        func = self.compileToken(token.value)
+        args = [self.compileToken(arg) for arg in token.args]
+
+        # The function is evaluated before its arguments
+        return lambda frame : func(frame)(*[arg(frame) for arg in args])
+    
+
+    def compileFor(self, token):
+        "Compiles a for loop, see ImgFilter.forEval."
+
+        init = self.compileToken(token.init)
+        cond = self.compileToken(token.cond)
+        incr = self.compileToken(token.incr)
+        body = self.compileToken(token.body)
+        newFrame = self.resolver.frame
+
+        def run(frame):
+            scope = newFrame(token, frame)
+            step = frame[1]['@step']
+
+            init(scope)
+
+            while cond(scope):
+                step()
+                body(scope)
+                incr(scope)
+            
+            return None
+        
+        return run
+
+
+class TranspileError(Exception):
+    """Raised when the Transpiler can't turn a program into Python that
+    is guaranteed to behave the same as the interpreter."""
+
+
+class Scope:
+    """Keeps track of a scope while transpiling. The variables of every
+    scope except the global one become local variables in Python."""
+
+    def __init__(self, number, parent = None):
+        self.number = number
+        self.parent : Scope = parent
+        # Every variable that is assigned anywhere in this scope
+        self.assigned = set()
+        # Variables that have certainly been assigned so far
+        self.defined = set()
+
+
+    def local(self, name) -> str:
+        "Returns the Python name of a variable in this scope."
+
+        return f'v{self.number}_{name}'
+
+
+class Transpiler:
+    """The Transpiler turns the tokens made by the Parser into Python
+    source code, which is then compiled by Python itself. For loops
+    become while loops and the variables in them become local
+    variables, so nothing has to be looked up in an Environment.
+
+    The global scope is still the dictionary of ImgFilter.env, so that
+    loadColor and loadRef can save r, g, and b to it. The builtins in
+    ImgFilter.env are expected to be there, and the ones that the
+    program never assigns to are read once at the start. Arithmetic is
+    done by Python directly when both sides are certainly numbers, see
+    isNumber, and otherwise by OPERATORS like the other engines, so
+    booleans and colors still can't be used as numbers.
+
+    Programs that can't be transpiled safely, like programs with
+    lambdas, or variables that might be read before they're assigned
+    in their scope, raise a TranspileError."""
+
+    # The builtins from ImgFilter.env that can be read only once
+    BUILTINS = (
+        'pixels', 'width', 'height', 'rgb', 'loadColor', 'makeRef',
+        'loadRef', 'sqrt', 'convolve', 'gradient', 'mapPixels',
+        'mapRegion'
+    )
+
+    # The operators that Python can apply directly
+    PYTHON_OPS = (
+        '+', '-', '*', '/', '%', '//', '<', '>', '<=', '>=', '==', '!='
+    )
+
+    # The names of the OPERATORS in the compiled code, for the operators
+    # that only take numbers
+    NUMERIC_OPS = {
+        '+': '_ADD', '-': '_SUB', '*': '_MUL', '/': '_TRUEDIV',
+        '%': '_MOD', '//': '_FLOORDIV', '<': '_LT', '>': '_GT',
+        '<=': '_LE', '>=': '_GE',
+    }
+
+    # The operators whose results are always numbers
+    ARITHMETIC_OPS = ('+', '-', '*', '/', '%', '//')
+
+    # The builtins, and the colors from loadColor and loadRef, that are
+    # numbers unless the program assigns something else to them
+    NUMBERS = ('width', 'height', 'r', 'g', 'b')
+
+    # Compiled programs by their hash, see self.load
+    cache = LRUCache(128)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.lines = []
+        # Counter to name temporary variables
+        self.temps = 0
+        # Counter to name scopes
+        self.scopes = 0
+
+        # All the names assigned anywhere in the program
+        self.assigned = set()
+        # Everything assigned to each name, in any scope
+        self.values = {}
+        # The scope of each for loop, by the id of its token
+        self.loopScopes = {}
+        self.globals = self.newScope(None)
+        self.collect(tokens, self.globals)
+
+        # The names that only ever hold numbers, found by ruling out the
+        # ones that are assigned anything else until none are left
+        self.numbers = (
+            set(self.values) - set(self.BUILTINS) | set(self.NUMBERS)
+        )
+        changed = True
+        while changed:
+            changed = False
+            for name in list(self.numbers):
+                if not all(map(self.isNumber, self.values.get(name, []))):
+                    self.numbers.discard(name)
+                    changed = True
+
+
+    @classmethod
+    def load(cls, tokens):
+        """Returns the compiled program for the tokens, which is a
+        function that takes the dictionary of the global scope. Returns
+        None if the program can't be transpiled. Compiled programs are
+        cached by the hash of the program."""
+
+        code = cls.cache.getOrCreate(
+            hashProgram(tokens), lambda : cls.compileCode(tokens)
+        )
+        
+        if code is None:
+            return None
+        
+        # Running the code defines the program function
+        namespace = {
+            '_AND': OPERATORS['&&'],
+            '_OR': OPERATORS['||'],
+        }
+        for op, name in cls.NUMERIC_OPS.items():
+            namespace[name] = OPERATORS[op]
+        exec(code, namespace)
+        return namespace['program']
+    
+
+    @classmethod
+    def compileCode(cls, tokens):
+        "Transpiles and compiles tokens, returns None if unable to."
+
+        try:
+            source = cls(tokens).source()
+            return compile(source, '<filter>', 'exec')
+        # SyntaxError from Python means too many nested blocks
+        except (TranspileError, SyntaxError, RecursionError):
+            return None
+        
+
+    def newScope(self, parent):
+        "Creates a new scope."
+
+        scope = Scope(self.scopes, parent)
+        self.scopes += 1
+        return scope
+    
+
+    def collect(self, token, scope):
+        """Goes through all the tokens to find which variables are
+        assigned in which scope, and gives each for loop its scope."""
+
+        if isinstance(token, list):
+            for t in token:
+                self.collect(t, scope)
+            return
+        
+        if not isinstance(token, (Token, ForToken)):
+            return
+        
+        typ = token.type
+
+        if typ == 'lambda':
+            raise TranspileError('lambdas are not supported')
+        
+        if typ == 'for':
+            inner = self.newScope(scope)
+            self.loopScopes[id(token)] = inner
+            for part in (token.init, token.cond, token.incr, token.body):
+                self.collect(part, inner)
+            return
+        
+        if typ == 'assign' and token.left.type == 'var':
+            scope.assigned.add(token.left.value)
+            self.assigned.add(token.left.value)
+            self.values.setdefault(token.left.value, []).append(token.right)
+        
+        if typ == 'if':
+            self.collect([token.value, token.then, token.otherwise], scope)
+        elif typ == 'call':
+            self.collect([token.value] + token.args, scope)
+        elif typ == 'index':
+            self.collect([token.var] + token.index, scope)
+        elif isinstance(token, BinaryToken):
+            self.collect([token.left, token.right], scope)
+        elif typ == 'prog':
+            self.collect(token.value, scope)
+    
+
+    def source(self) -> str:
+        "Returns the Python source code of the program."
+
+        self.emit(0, 'def program(G):')
+        self.emit(1, "_step = G['@step']")
+
+        # Reads the builtins that never change
+        for name in self.BUILTINS:
+            if name not in self.assigned:
+                self.emit(1, f'b_{name} = G[{name!r}]')
+
+        value = self.expr(self.tokens, self.globals, 1)
+        self.emit(1, f'return {value}')
+
+        return '\n'.join(self.lines) + '\n'
+    
+
+    def emit(self, indent, line):
+        "Adds a line of source code."
+
+        self.lines.append('    ' * indent + line)
+
+
+    def temp(self) -> str:
+        "Returns the name of a new temporary variable."
+
+        self.temps += 1
+        return f'_t{self.temps}'
+    
+
+    def resolve(self, name, scope) -> str:
+        """Returns the Python code that reads a variable, by finding the
+        scope that the variable lives in."""
+
+        # Find the closest scope that assigns the variable
+        owner = scope
+        while owner and name not in owner.assigned:
+            owner = owner.parent
+        
+        # Names never assigned in a scope are builtins, which are only
+        # read once if they are never assigned anywhere
+        if owner is None:
+            if name in self.BUILTINS and name not in self.assigned:
+                return f'b_{name}'
+            return f'G[{name!r}]'
+        
+        # The global scope stays a dictionary
+        if owner is self.globals:
+            return f'G[{name!r}]'
+        
+        # If the variable might not have been assigned yet, the
+        # interpreter could read it from a different scope
+        if name not in owner.defined:
+            raise TranspileError(f'{name} might be read before assigned')
+        
+        return owner.local(name)
+    
+
+    def target(self, name, scope) -> str:
+        "Returns the Python code that a variable is assigned to."
+
+        if scope is self.globals:
+            return f'G[{name!r}]'
+        return scope.local(name)
+    
+
+    def isPure(self, token) -> bool:
+        """Returns true if evaluating a token can't change any
+        variables, meaning it contains no assignments or calls."""
+
+        if isinstance(token, list):
+            return all(self.isPure(t) for t in token)
+        if not isinstance(token, (Token, ForToken)):
+            return True
+        if token.type in ('assign', 'call', 'for', 'lambda'):
+            return False
+        if token.type == 'if':
+            return self.isPure(
+                [token.value, token.then, token.otherwise]
+            )
+        if isinstance(token, BinaryToken):
+            return self.isPure([token.left, token.right])
+        if token.type == 'prog':
+            return self.isPure(token.value)
+        return True
+    
+
+    def isNumber(self, token) -> bool:
+        """Returns true if token certainly evaluates to a number, so that
+        Python can do arithmetic with it directly."""
+
+        typ = token.type
+
+        if typ == 'num':
+            return True
+        if typ == 'var':
+            return token.value in self.numbers
+        if typ == 'binary':
+            # The operators check that their numbers are numbers
+            if token.value in self.ARITHMETIC_OPS:
+                return True
+            if token.value == '||':
+                return self.isNumber(token.left) and self.isNumber(token.right)
+            return False
+        if typ == 'call':
+            return (
+                token.value.type == 'var' and token.value.value == 'sqrt'
+                and 'sqrt' not in self.assigned
+            )
+        return False
+    
+
+    def spill(self, code, indent) -> str:
+        """Saves code to a temporary variable, so that it is evaluated
+        now instead of later, unless it is a constant."""
+
+        if code in ('True', 'False', 'None') or code[0].isdigit():
+            return code
+        
+        temp = self.temp()
+        self.emit(indent, f'{temp} = {code}')
+        return temp
+    
+
+    def exprs(self, tokens, scope, indent) -> list:
+        """Returns the Python code for a list of expressions, making
+        sure they're evaluated in order."""
+
+        codes = []
+        for token in tokens:
+            before = len(self.lines)
+            code = self.expr(token, scope, indent)
+
+            # If the expression needed statements before it, the
+            # expressions before it have to be evaluated first
+            if len(self.lines) != before:
+                after = self.lines[before:]
+                del self.lines[before:]
+                codes = [self.spill(c, indent) for c in codes]
+                self.lines.extend(after)
+            
+            codes.append(code)
+        
+        return codes
+    
+
+    def expr(self, token, scope, indent) -> str:
+        """Returns the Python expression for a token, possibly adding
+        statements that have to run before it."""
+
+        typ = token.type
+
+        if typ == 'num':
+            return repr(token.value)
+        
+        if typ == 'bool':
+            return repr(token.value)
+        
+        if typ == 'var':
+            return self.resolve(token.value, scope)
+        
+        if typ == 'binary':
+            left, right = self.exprs([token.left, token.right], scope, indent)
+
+            op = token.value
+
+            # Dividing by anything but a number that isn't 0 goes through
+            # OPERATORS, so the error is the same as the other engines'
+            checked = op in self.NUMERIC_OPS and not (
+                self.isNumber(token.left) and self.isNumber(token.right)
+                and (op not in ('/', '%', '//') or (
+                    token.right.type == 'num' and token.right.value != 0
+                ))
+            )
+            if checked:
+                return f'{self.NUMERIC_OPS[op]}({left}, {right})'
+            if op in self.PYTHON_OPS:
+                return f'({left} {op} {right})'
+            if token.value == '&&':
+                return f'_AND({left}, {right})'
+            if token.value == '||':
+                return f'_OR({left}, {right})'
+            raise TranspileError(f'Unrecognized operator {token.value}')
+        
+        if typ == 'call':
+            return self.call(token, scope, indent)
+        
+        if typ in ('assign', 'if', 'prog', 'for'):
+            # Statements save their value to a temporary variable
+            temp = self.temp()
+            self.stmt(token, scope, indent, temp)
+            return temp
+        
+        raise TranspileError(f'Unable to evaluate {token}')
+    
+
+    def call(self, token, scope, indent) -> str:
+        "Returns the Python code of a function call."
+
+        func = token.value
+        builtin = (
+            func.type == 'var' and func.value not in self.assigned
+            and func.value
+        )
+
+        # rgb() is turned into a tuple directly
+        if builtin == 'rgb' and len(token.args) == 3:
+            r, g, b = self.exprs(token.args, scope, indent)
+            return f'(int({r}), int({g}), int({b}))'
+        
+        # loadColor() reads the pixel into the global r, g, and b
+        if (
+            builtin == 'loadColor' and len(token.args) == 2
+            and 'pixels' not in self.assigned
+        ):
+            x, y = self.exprs(token.args, scope, indent)
+            self.emit(
+                indent, f"G['r'], G['g'], G['b'] = b_pixels[{x}, {y}][:3]"
+            )
+            return 'None'
+        
+        codes = self.exprs([func] + token.args, scope, indent)
+        return f'{codes[0]}({", ".join(codes[1:])})'
+    
+
+    def stmt(self, token, scope, indent, result = None):
+        """Adds the Python statements of a token. If result is given,
+        the value of the token is saved to it."""
+
+        typ = token.type
+
+        if typ == 'assign':
+            self.assign(token, scope, indent, result)
+        
+        elif typ == 'if':
+            self.ifStmt(token, scope, indent, result)
+        
+        elif typ == 'prog':
+            for expr in token.value[:-1]:
+                self.stmt(expr, scope, indent)
+            
+            # The value of a program is its last expression
+            if token.value:
+                self.stmt(token.value[-1], scope, indent, result)
+            elif result:
+                self.emit(indent, f'{result} = False')
+        
+        elif typ == 'for':
+            self.forStmt(token, scope, indent)
+            if result:
+                self.emit(indent, f'{result} = None')
+        
+        else:
+            code = self.expr(token, scope, indent)
+            if result:
+                self.emit(indent, f'{result} = {code}')
+            elif typ in ('call', 'var', 'binary') and code != 'None':
+                # Still evaluated, as it may throw an error
+                self.emit(indent, code)
+    
+
+    def assign(self, token, scope, indent, result):
+        "Adds the statements of an assignment."
+
+        left = token.left
+
+        if left.type == 'index':
+            return self.pixelAssign(token, scope, indent, result)
+        
+        if left.type != 'var':
+            raise TranspileError(f'Cannot assign to {left}')
+        
+        value = self.expr(token.right, scope, indent)
+        if result:
+            self.emit(indent, f'{result} = {value}')
+            value = result
+        
+        self.emit(indent, f'{self.target(left.value, scope)} = {value}')
+        scope.defined.add(left.value)
+    
+
+    def pixelAssign(self, token, scope, indent, result):
+        "Adds the statements that save a color to pixels[x, y]."
+
+        left = token.left
+
+        if left.var.value != 'pixels' or len(left.index) != 2:
+            raise TranspileError(f'Cannot assign to {left}')
+        if getattr(token.right.value, 'value', None) != 'rgb':
+            raise TranspileError('rgb function must be used')
+        
+        pixels = self.resolve('pixels', scope)
+
+        # Python evaluates the color before the index, which only
+        # matters if either of them can change variables
+        if self.isPure(left.index) and self.isPure(token.right.args):
+            x, y = self.exprs(left.index, scope, indent)
+            color = self.expr(token.right, scope, indent)
+        else:
+            x, y, color = [
+                self.spill(code, indent) for code in
+                self.exprs(left.index + [token.right], scope, indent)
+            ]
+        
+        if result:
+            self.emit(indent, f'{result} = {color}')
+            color = result
+        
+        self.emit(indent, f'{pixels}[{x}, {y}] = {color}')
+    
+
+    def block(self, token, scope, indent, result):
+        """Adds the statements of a branch, returns the variables it
+        assigned in the scope."""
+
+        before = len(self.lines)
+        defined = set(scope.defined)
+
+        if token is None:
+            if result:
+                self.emit(indent, f'{result} = False')
+        else:
+            self.stmt(token, scope, indent, result)
+        
+        if len(self.lines) == before:
+            self.emit(indent, 'pass')
+        
+        # Restore what was defined before the branch
+        assigned = scope.defined
+        scope.defined = defined
+        return assigned
+    
+
+    def ifStmt(self, token, scope, indent, result):
+        "Adds the statements of an if statement."
+
+        cond = self.expr(token.value, scope, indent)
+        self.emit(indent, f'if {cond}:')
+        then = self.block(token.then, scope, indent + 1, result)
+
+        # Without an else statement or a result, else isn't needed
+        if token.otherwise is None and not result:
+            otherwise = set(scope.defined)
+        else:
+            self.emit(indent, 'else:')
+            otherwise = self.block(
+                token.otherwise, scope, indent + 1, result
+            )
+
+        # Only variables assigned in both branches are certainly assigned
+        scope.defined = then & otherwise
+    
+
+    def forStmt(self, token, scope, indent):
+        "Adds the statements of a for loop, which becomes a while loop."
+
+        inner = self.loopScopes[id(token)]
+
+        # The loop starts with a new scope each time it runs
+        inner.defined = set()
+        self.stmt(token.init, inner, indent)
+
+        # The condition is checked at the start of every loop
+        before = len(self.lines)
+        cond = self.expr(token.cond, inner, indent + 1)
+
+        if len(self.lines) == before:
+            self.emit(indent, f'while {cond}:')
+        else:
+            # If the condition needs statements, they run first
+            needed = self.lines[before:]
+            del self.lines[before:]
+            self.emit(indent, 'while True:')
+            self.lines.extend(needed)
+            self.emit(indent + 1, f'if not {cond}:')
+            self.emit(indent + 2, 'break')
+        
+        # Every pass through the loop is a step, see Budget
+        self.emit(indent + 1, '_step()')
+
+        self.stmt(token.body, inner, indent + 1)
+        self.stmt(token.incr, inner, indent + 1)
+
+
+class PixelLoop:
+    """The base of the classes that recognize programs which loop
+    through every pixel of the image:
+
+        for (x = 0; x < width; x = x + 1) {
+            for (y = 0; y < height; y = y + 1) {
+                ...
+            };
+        };
+    
+    The loops can also be the other way around, going through the
+    height first. Programs that don't match raise self.Error."""
+
+    # The error raised when a program doesn't match
+    Error = ValueError
+
+    # The builtins from ImgFilter.env that the program can't assign to
+    BUILTINS = (
+        'pixels', 'width', 'height', 'rgb', 'loadColor', 'makeRef',
+        'loadRef', 'sqrt', 'convolve', 'gradient', 'mapPixels',
+        'mapRegion', 'r', 'g', 'b'
+    )
+
+    def matchNest(self, outer):
+        """Checks that outer is a loop through the image, saving the
+        names of the x and y variables and the statements of the body
+        of the inner loop."""
+
+        outerVar, outerBound = self.matchLoop(outer)
+        inner = outer.body
+        innerVar, innerBound = self.matchLoop(inner)
+
+        # One loop has to go through the width and the other the height
+        if {outerBound, innerBound} != {'width', 'height'}:
+            raise self.Error('loops must go through width and height')
+        if outerVar == innerVar:
+            raise self.Error('loops must use different variables')
+        
+        # x is the variable that goes through the width
+        if outerBound == 'width':
+            self.x, self.y = outerVar, innerVar
+        else:
+            self.x, self.y = innerVar, outerVar
+        
+        self.outer = outer
+        self.body = inner.body.value if inner.body.type == 'prog' \
+            else [inner.body]
+    
+
+    @classmethod
+    def match(cls, tokens):
+        "Returns an instance for the tokens, or None if they don't match."
+
+        try:
+            return cls(tokens)
+        except cls.Error:
+            return None
+    
+
+    def matchLoop(self, token):
+        """Checks that token is a loop like (i = 0; i < bound; i = i + 1),
+        returns the name of the variable and the bound."""
+
+        if token.type != 'for':
+            raise self.Error('expected a for loop')
+        
+        init, cond, incr = token.init, token.cond, token.incr
+
+        if not (
+            init.type == 'assign' and init.left.type == 'var'
+            and init.right.type == 'num' and init.right.value == 0
+        ):
+            raise self.Error('loop must start at 0')
+        
+        name = init.left.value
+
+        if not (
+            cond.type == 'binary' and cond.value == '<'
+            and self.isVar(cond.left, name)
+            and cond.right.type == 'var'
+            and cond.right.value in ('width', 'height')
+        ):
+            raise self.Error('loop must end at width or height')
+        
+        if not (
+            incr.type == 'assign' and self.isVar(incr.left, name)
+            and incr.right.type == 'binary' and incr.right.value == '+'
+            and self.isVar(incr.right.left, name)
+            and incr.right.right.type == 'num'
+            and incr.right.right.value == 1
+        ):
+            raise self.Error('loop must count up by 1')
+        
+        return name, cond.right.value
+    
+
+    def isVar(self, token, name) -> bool:
+        "Returns true if token is the variable name."
+
+        return token.type == 'var' and token.value == name
+    
+
+    def isCoords(self, args) -> bool:
+        "Returns true if args are exactly the loop's x and y."
+
+        return (
+            len(args) == 2 and self.isVar(args[0], self.x)
+            and self.isVar(args[1], self.y)
+        )
+    
+
+    def isCall(self, token, name) -> bool:
+        "Returns true if token calls the function name."
+
+        return token.type == 'call' and self.isVar(token.value, name)
+
+
+class VectorizeError(Exception):
+    """Raised when the Vectorizer can't run a program over the whole
+    image at once."""
+
+
+class Vectorizer(PixelLoop):
+    """The Vectorizer recognizes programs that loop through every pixel
+    and only change each pixel using its own color, like the grayscale
+    and sepia filters:
+
+        for (x = 0; x < width; x = x + 1) {
+            for (y = 0; y < height; y = y + 1) {
+                loadColor(x, y);
+                ...
+                pixels[x, y] = rgb(...);
+            };
+        };
+
+    Instead of running the loop body once for each pixel, the body is
+    ran once with NumPy arrays holding the values of every pixel. If
+    statements become masks that pick which pixels take the new value.
+    
+    Programs that don't have this shape raise a VectorizeError when
+    matched, and programs that would throw an error in the interpreter,
+    like dividing by zero, raise a VectorizeError when ran, so that the
+    interpreter can throw the same error."""
+
+    Error = VectorizeError
+
+    # Operators that need numbers on both sides
+    NUMERIC_OPS = ('+', '-', '*', '/', '%', '//', '<', '>', '<=', '>=')
+
+    # The operators applied to arrays, && and || are handled separately
+    ARRAY_OPS = {
+        '+' : operator.add,
+        '-' : operator.sub,
+        '*' : operator.mul,
+        '/' : operator.truediv,
+        '%' : operator.mod,
+        '//': operator.floordiv,
+        '<' : operator.lt,
+        '>' : operator.gt,
+        '<=': operator.le,
+        '>=': operator.ge,
+        '==': operator.eq,
+        '!=': operator.ne,
+    }
+
+    # Integers have to stay below this to be used in arrays, see
+    # checkRange, and below FLOAT_LIMIT to be divided
+    INT_LIMIT = 2 ** 62
+    FLOAT_LIMIT = 2 ** 53
+
+    def __init__(self, tokens):
+        if np is None:
+            raise VectorizeError('NumPy is not installed')
+        
+        # The top level has to be a single for loop
+        if tokens.type != 'prog' or len(tokens.value) != 1:
+            raise VectorizeError('program must be a single for loop')
+        
+        self.matchNest(tokens.value[0])
+        self.check()
+    
+
+    def check(self):
+        """Checks that every statement in the loop body can be ran over
+        the whole image, and that every variable is assigned before it
+        is read."""
+
+        # Variables that are certainly assigned, x and y always are
+        defined = {self.x, self.y, 'width', 'height'}
+        written = False
+
+        for token in self.body:
+            if self.isCall(token, 'loadColor'):
+                if not self.isCoords(token.args):
+                    raise VectorizeError('loadColor must load (x, y)')
+                # Loading after writing would read a changed pixel
+                if written:
+                    raise VectorizeError('loadColor after writing pixels')
+                defined |= {'r', 'g', 'b'}
+            
+            elif token.type == 'assign' and token.left.type == 'index':
+                left = token.left
+                if not (
+                    self.isVar(left.var, 'pixels')
+                    and self.isCoords(left.index)
+                    and self.isCall(token.right, 'rgb')
+                    and len(token.right.args) == 3
+                ):
+                    raise VectorizeError('pixels must be set at (x, y)')
+                for arg in token.right.args:
+                    self.checkExpr(arg, defined)
+                written = True
+            
+            else:
+                defined = self.checkStmt(token, defined)
+    
+
+    def checkStmt(self, token, defined) -> set:
+        """Checks an assignment or if statement, returns the variables
+        that are certainly assigned after it."""
+
+        if token.type == 'assign':
+            if token.left.type != 'var':
+                raise VectorizeError(
+                    f'Cannot assign to {formatToken(token.left)}'
+                )
+            name = token.left.value
+            if name in self.BUILTINS or name in (self.x, self.y):
+                raise VectorizeError(f'Cannot vectorize assigning {name}')
+            
+            self.checkExpr(token.right, defined)
+            return defined | {name}
+        
+        if token.type == 'if':
+            self.checkExpr(token.value, defined)
+            then = self.checkBlock(token.then, defined)
+            otherwise = self.checkBlock(token.otherwise, defined)
+            return then & otherwise
+        
+        raise VectorizeError(f'Cannot vectorize {formatToken(token)}')
+    
+
+    def checkBlock(self, token, defined) -> set:
+        "Checks the statements in the branch of an if statement."
+
+        if token is None:
+            return defined
+        
+        if token.type == 'prog':
+            for stmt in token.value:
+                defined = self.checkStmt(stmt, defined)
+            return defined
+        
+        # An empty branch is parsed as false
+        if token.type == 'bool':
+            return defined
+        
+        return self.checkStmt(token, defined)
+    
+
+    def checkExpr(self, token, defined):
+        "Checks that an expression can be calculated over the image."
+
+        if token.type in ('num', 'bool'):
+            return
+        
+        if token.type == 'var':
+            if token.value not in defined:
+                raise VectorizeError(f'{token.value} might not be assigned')
+            return
+        
+        if token.type == 'binary':
+            if token.value not in OPERATORS:
+                raise VectorizeError(f'Unrecognized operator {token.value}')
+            self.checkExpr(token.left, defined)
+            self.checkExpr(token.right, defined)
+            return
+        
+        if self.isCall(token, 'sqrt') and len(token.args) == 1:
+            self.checkExpr(token.args[0], defined)
+            return
+        
+        raise VectorizeError(f'Cannot vectorize {formatToken(token)}')
+    
+
+    def run(self, imgFilter):
+        """Runs the loop body over the whole image of the ImgFilter.
+        Nothing is changed if a VectorizeError is raised."""
+
+        width, height = imgFilter.width, imgFilter.height
+
+        # The loops wouldn't run at all
+        if width == 0 or height == 0:
+            return None
+        
+        pixels = np.asarray(imgFilter.img).astype(np.int64)
+
+        # The image can be a strip of the rows from imgFilter.top on,
+        # see runStrips
+        top = imgFilter.top
+        rows = pixels.shape[0]
+
+        # Arrays are indexed [y, x], the same shape as the image
+        self.vars = {
+            self.x: np.arange(width).reshape(1, width),
+            self.y: np.arange(top, top + rows).reshape(rows, 1),
+            'width': width,
+            'height': height,
+        }
+        self.kinds = {}
+        colors = None
+
+        with np.errstate(all='ignore'):
+            for token in self.body:
+                if token.type == 'call':
+                    for i, name in enumerate('rgb'):
+                        self.vars[name] = pixels[:, :, i]
+                    continue
+                
+                if token.type == 'assign' and token.left.type == 'index':
+                    colors = [
+                        self.toColor(self.evalExpr(arg, None))
+                        for arg in token.right.args
+                    ]
+                    continue
+                
+                self.evalStmt(token, None)
+        
+        # The last pixel loaded is left in r, g, and b
+        if 'r' in self.vars:
+            last = pixels[rows - 1, width - 1]
+            for i, name in enumerate('rgb'):
+                imgFilter.env[name] = int(last[i])
+        
+        if colors is not None:
+            result = np.empty((rows, width, 3), dtype=np.uint8)
+            for i in range(3):
+                result[:, :, i] = colors[i]
+            # Paste into the image so that the pixel access stays valid
+            imgFilter.img.paste(Image.fromarray(result, 'RGB'))
+        
+        return None
+    
+
+    def toColor(self, value):
+        """Converts a value into a color channel, like rgb() and saving
+        to pixels would."""
+
+        value = np.asarray(value)
+
+        # int() can't convert these
+        if value.dtype.kind == 'f' and not np.isfinite(value).all():
+            raise VectorizeError('color is not a finite number')
+        
+        # int() rounds toward zero, and pixels clamp to 0 - 255
+        return np.clip(np.trunc(value), 0, 255)
+    
+
+    def isArray(self, value) -> bool:
+        return isinstance(value, np.ndarray)
+    
+
+    def anyWhere(self, values, mask) -> bool:
+        "Returns true if any of the values are true where mask is true."
+
+        if mask is not None:
+            values = values & mask
+        return bool(np.any(values))
+    
+
+    def evalStmt(self, token, mask):
+        """Runs an assignment or if statement for every pixel where mask
+        is true, or every pixel if mask is None."""
+
+        if token.type == 'assign':
+            name = token.left.value
+            value = self.evalExpr(token.right, mask)
+
+            # Only the pixels in the mask take the new value
+            if mask is not None and name in self.vars:
+                old = self.vars[name]
+                if self.kinds.get(name) != self.kinds.get(id(token.right)):
+                    self.kinds[name] = 'mixed'
+                value = np.where(mask, value, old)
+            else:
+                self.kinds[name] = self.kinds.get(id(token.right))
+            
+            self.vars[name] = value
+            return
+        
+        # if statement
+        cond = self.truth(self.evalExpr(token.value, mask))
+        then = cond if mask is None else cond & mask
+        otherwise = ~cond if mask is None else ~cond & mask
+
+        self.evalBlock(token.then, then)
+        self.evalBlock(token.otherwise, otherwise)
+    
+
+    def evalBlock(self, token, mask):
+        "Runs the statements in a branch of an if statement."
+
+        if token is None or token.type == 'bool':
+            return
+        
+        # Skip branches that no pixel takes
+        if not np.any(mask):
+            return
+        
+        for stmt in token.value if token.type == 'prog' else [token]:
+            self.evalStmt(stmt, mask)
+    
+
+    def truth(self, value):
+        "Returns whether each value is true, as an array."
+
+        return np.asarray(value != False)
+    
+
+    def evalExpr(self, token, mask):
+        """Calculates an expression for every pixel. Returns a number,
+        or an array of values. The kind of the value ('num', 'bool' or
+        'mixed') is saved in self.kinds by the id of the token."""
+
+        typ = token.type
+        key = id(token)
+
+        if typ == 'num':
+            self.kinds[key] = 'num'
+            return token.value
+        
+        if typ == 'bool':
+            self.kinds[key] = 'bool'
+            return token.value
+        
+        if typ == 'var':
+            self.kinds[key] = self.kinds.get(token.value, 'num')
+            return self.vars[token.value]
+        
+        if typ == 'call':
+            value = self.evalExpr(token.args[0], mask)
+            self.checkNum(token.args[0])
+
+            # math.sqrt throws an error for negative numbers
+            if self.anyWhere(np.asarray(value) < 0, mask):
+                raise VectorizeError('sqrt of a negative number')
+            
+            self.kinds[key] = 'num'
+            return np.sqrt(value) if self.isArray(value) \
+                else math.sqrt(value)
+        
+        op = token.value
+        a = self.evalExpr(token.left, mask)
+        b = self.evalExpr(token.right, mask)
+
+        if op in self.NUMERIC_OPS:
+            self.checkNum(token.left)
+            self.checkNum(token.right)
+        
+        if op in ('/', '%', '//'):
+            if self.anyWhere(np.asarray(b) == 0, mask):
+                raise VectorizeError('division by zero')
+        
+        kindA = self.kinds[id(token.left)]
+        kindB = self.kinds[id(token.right)]
+
+        if op in ('<', '>', '<=', '>=', '==', '!='):
+            self.kinds[key] = 'bool'
+        elif op == '&&':
+            self.kinds[key] = 'bool' if kindB == 'bool' else 'mixed'
+        elif op == '||':
+            self.kinds[key] = kindA if kindA == kindB else 'mixed'
+        else:
+            self.kinds[key] = 'num'
+        
+        # Two plain numbers are calculated like the interpreter would
+        if not self.isArray(a) and not self.isArray(b):
+            return OPERATORS[op](a, b)
+        
+        if op == '&&':
+            return np.where(self.truth(a), b, False)
+        if op == '||':
+            return np.where(self.truth(a), a, b)
+        
+        self.checkRange(op, a, b)
+        return self.ARRAY_OPS[op](a, b)
+    
+
+    def checkNum(self, token):
+        """Booleans can't be used as numbers, the interpreter will throw
+        the error."""
+
+        if self.kinds[id(token)] != 'num':
+            raise VectorizeError('expected a number')
+    
+
+    def checkRange(self, op, a, b):
+        """Python's ints can't overflow, but NumPy's int64 wraps around.
+        Integers are kept below INT_LIMIT, so adding or subtracting two
+        of them always fits, and products are checked before they're
+        calculated. NumPy divides integers as floats, which is only the
+        same as Python below FLOAT_LIMIT."""
+
+        sizeA = self.intSize(a)
+        sizeB = self.intSize(b)
+        sizes = [size for size in (sizeA, sizeB) if size is not None]
+
+        if any(size >= self.INT_LIMIT for size in sizes):
+            raise VectorizeError('integer overflow')
+        if op == '*' and len(sizes) == 2 and sizeA * sizeB >= self.INT_LIMIT:
+            raise VectorizeError('integer overflow')
+        if op == '/' and len(sizes) == 2 and max(sizes) >= self.FLOAT_LIMIT:
+            raise VectorizeError('integer too big to divide exactly')
+    
+
+    def intSize(self, value):
+        """Returns the biggest absolute value of an integer or an array of
+        integers, or None if value isn't one."""
+
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, np.integer)):
+            return abs(int(value))
+        if self.isArray(value) and value.dtype.kind in 'iu':
+            return int(np.abs(value).max()) if value.size else 0
+        return None
+
+
+class TileError(Exception):
+    """Raised when a program can't be split into tiles that are ran
+    separately."""
+
+
+class TilePlan(PixelLoop):
+    """The TilePlan recognizes programs where every pixel only depends
+    on its own color, or on colors from a reference image made with
+    makeRef() before the loops, like all three of the common filters.
+    The outer loop of these programs can be split into tiles that are
+    ran at the same time by different processes.
+
+    The program may only start with makeRef() calls, followed by the
+    loops. In the loops, loadColor can only load (x, y), pixels can only
+    be set at (x, y), and every variable (and r, g, and b) has to be
+    assigned in the same pass through the loop before it's read, so
+    nothing carries over from one pixel to the next."""
+
+    Error = TileError
+
+    # The globals that hold where a tile starts and stops, they can't
+    # be used in code as they aren't valid names
+    START = '@start'
+    STOP = '@stop'
+
+    # The functions that can be called in the loops
+    FUNCTIONS = ('rgb', 'sqrt', 'loadColor', 'loadRef')
+
+    def __init__(self, tokens):
+        if tokens.type != 'prog' or not tokens.value:
+            raise TileError('program must end with a for loop')
+        
+        *refs, loop = tokens.value
+
+        # The reference image is made before any pixel is changed, so
+        # it is the same as the source image
+        for token in refs:
+            if not (self.isCall(token, 'makeRef') and not token.args):
+                raise TileError('only makeRef() can come before the loops')
+        self.usesRef = len(refs) > 0
+
+        self.matchNest(loop)
+        # What the outer loop goes through, width or height
+        self.bound = loop.cond.right.value
+
+        self.check()
+
+        # The outer loop, but only going through a tile
+        self.tokens = Token('prog', [self.limit(loop, loop.body)])
+    
+
+    def limit(self, loop, body):
+        """Returns a loop like loop, which only goes from START to STOP,
+        and runs body."""
+
+        var = loop.init.left.value
+        return ForToken(
+            'for',
+            init = BinaryToken(
+                'assign', '=', Token('var', var), Token('var', self.START)
+            ),
+            cond = BinaryToken(
+                'binary', '<', Token('var', var), Token('var', self.STOP)
+            ),
+            incr = loop.incr,
+            body = body
+        )
+    
+
+    def check(self):
+        "Checks that no pixel depends on the pixels before it."
+
+        # Names that can always be read
+        defined = {
+            self.x, self.y, 'width', 'height', 'pixels'
+        } | set(self.FUNCTIONS)
+
+        self.checkToken(Token('prog', self.body), defined)
+    
+
+    def checkToken(self, token, defined) -> set:
+        """Checks a token, returns the names that are certainly assigned
+        after it has ran."""
+
+        typ = token.type
+
+        if typ in ('num', 'bool'):
+            return defined
+        
+        if typ == 'var':
+            if token.value not in defined:
+                raise TileError(f'{token.value} might not be assigned')
+            return defined
+        
+        if typ == 'binary':
+            defined = self.checkToken(token.left, defined)
+            return self.checkToken(token.right, defined)
+        
+        if typ == 'prog':
+            for expr in token.value:
+                defined = self.checkToken(expr, defined)
+            return defined
+        
+        if typ == 'if':
+            defined = self.checkToken(token.value, defined)
+            then = self.checkToken(token.then, defined)
+            if token.otherwise is None:
+                return then & defined
+            return then & self.checkToken(token.otherwise, defined)
+        
+        if typ == 'assign':
+            left = token.left
+
+            if left.type == 'index':
+                if not (
+                    self.isVar(left.var, 'pixels')
+                    and self.isCoords(left.index)
+                    and self.isCall(token.right, 'rgb')
+                ):
+                    raise TileError('pixels can only be set at (x, y)')
+                return self.checkToken(token.right, defined)
+            
+            if (
+                left.type != 'var' or left.value in self.BUILTINS
+                or left.value in (self.x, self.y)
+            ):
+                raise TileError(f'Cannot assign to {left}')
+            
+            return self.checkToken(token.right, defined) | {left.value}
+        
+        if typ == 'call':
+            name = token.value.value if token.value.type == 'var' else None
+
+            if name not in self.FUNCTIONS:
+                raise TileError(f'Cannot call {token.value} in tiles')
+            if name == 'loadColor' and not self.isCoords(token.args):
+                raise TileError('loadColor must load (x, y)')
+            if name == 'loadRef' and not self.usesRef:
+                raise TileError('loadRef needs makeRef() before the loops')
+            
+            for arg in token.args:
+                defined = self.checkToken(arg, defined)
+            
+            if name in ('loadColor', 'loadRef'):
+                defined = defined | {'r', 'g', 'b'}
+            return defined
+        
+        raise TileError(f'Cannot run {formatToken(token)} in tiles')
+
+
+class StripError(TileError):
+    """Raised when a program or image can't be ran a strip of rows at a
+    time, see runStrips."""
+
+
+class StripPlan(TilePlan):
+    """The StripPlan recognizes the programs of a TilePlan that can be
+    ran a strip of rows at a time, for images too big to keep in memory.
+    Their loop through the height only goes through a strip, see
+    TilePlan.limit.
+
+    loadRef() has to load rows a fixed distance from y, like
+    loadRef(x + 1, y - 1), so that only the strip and the halo, the
+    rows up to self.halo above and below it, have to be read."""
+
+    def __init__(self, tokens):
+        self.halo = 0
+        super().__init__(tokens)
+
+        outer = self.outer
+        inner = outer.body
+
+        if self.bound != 'height':
+            self.tokens = Token('prog', [ForToken(
+                'for',
+                init = outer.init,
+                cond = outer.cond,
+                incr = outer.incr,
+                body = self.limit(inner, inner.body)
+            )])
+    
+
+    def checkToken(self, token, defined) -> set:
+        "Checks a token, and how far from y it loads rows with loadRef."
+
+        if self.isCall(token, 'loadRef'):
+            offset = self.rowOffset(token.args)
+            if offset is None:
+                raise StripError('loadRef must load rows near y')
+            self.halo = max(self.halo, abs(offset))
+        
+        return super().checkToken(token, defined)
+    
+
+    def rowOffset(self, args):
+        """Returns how far the row of loadRef(x, y + offset) is from y,
+        or None if it isn't a fixed distance."""
+
+        if len(args) != 2:
+            return None
+        
+        row = args[1]
+        if self.isVar(row, self.y):
+            return 0
+        
+        if not (
+            row.type == 'binary' and row.value in ('+', '-')
+            and self.isVar(row.left, self.y)
+            and row.right.type == 'num' and type(row.right.value) == int
+        ):
+            return None
+        
+        return row.right.value if row.value == '+' else -row.right.value
+
+
+class StripRows:
+    """The rows of the image from top on, which are read and changed
+    with the coordinates of the whole image, see runStrips. Rows outside
+    of the image act like they do for Pillow, and rows of the image
+    outside of the strip raise a StripError."""
+
+    def __init__(self, img, top, height):
+        self.pixels = img.load()
+        self.top = top
+        self.rows = img.size[1]
+        self.height = height
+    
+
+    def row(self, y):
+        "Returns the row in the strip of row y of the image."
+
+        # Like Pillow, negative rows are counted from the bottom
+        y = int(y)
+        if y < 0:
+            y += self.height
+        if not 0 <= y < self.height:
+            raise IndexError('image index out of range')
+        if not self.top <= y < self.top + self.rows:
+            raise StripError(f'row {y} is outside of the strip')
+        
+        return y - self.top
+    
+
+    def __getitem__(self, xy):
+        # Nearly every row is a row of the strip, which is checked first
+        row = xy[1] - self.top
+        if type(row) is not int or not 0 <= row < self.rows:
+            row = self.row(xy[1])
+
+        return self.pixels[xy[0], row]
+    
+
+    def __setitem__(self, xy, color):
+        row = xy[1] - self.top
+        if type(row) is not int or not 0 <= row < self.rows:
+            row = self.row(xy[1])
+
+        self.pixels[xy[0], row] = color
+
+
+# How many pixels are in each strip, see runStrips
+STRIP_PIXELS = 1 << 20
+
+
+def runStrips(tokens, source, dest, engine = 'interpreter', vectorize = True,
+              optimize = True, budget = None, stripPixels = STRIP_PIXELS,
+              level = 6):
+    """Filters the PNG at the path source into the file dest a strip of
+    rows at a time, so only the strip and its halo are ever in memory,
+    see StripPlan. The tokens are ran like ImgFilter.run would, and dest
+    is compressed as hard as level, see PngWriter.
+
+    Raises a StripError if the program can't be ran in strips, or a
+    PngError if the PNG can't be read in rows. These can be raised after
+    part of dest is written, so dest should be thrown away, and the
+    image filtered all at once instead."""
+
+    budget = budget or Budget()
+    budget.start()
+
+    if optimize:
+        tokens = Optimizer().optimize(tokens)
+    
+    plan = StripPlan.match(tokens)
+    if plan is None:
+        raise StripError('program can\'t be ran in strips')
+    
+    vectorizer = Vectorizer.match(tokens) if vectorize else None
+
+    with PngReader(source) as reader:
+        width, height = reader.width, reader.height
+        rows = max(1, stripPixels // max(width, 1))
+        writer = PngWriter(dest, width, height, level)
+
+        # The rows read so far that are still needed, from row start on
+        window = Image.new('RGB', (width, 0))
+        start = 0
+
+        for top in range(0, height, rows):
+            bottom = min(top + rows, height)
+            first = max(top - plan.halo, 0)
+            last = min(bottom + plan.halo, height)
+
+            # Drop the rows above the halo, and read the ones below it
+            kept = window.crop((0, first - start, width, window.size[1]))
+            added = reader.read(last - start - window.size[1])
+            window = Image.new('RGB', (width, last - first))
+            window.paste(kept, (0, 0))
+            if added is not None:
+                window.paste(added.convert('RGB'), (0, kept.size[1]))
+            start = first
+
+            strip = window.crop((0, top - start, width, bottom - start))
+            imgFilter = ImgFilter.fromPixels(
+                StripRows(strip, top, height),
+                StripRows(window, start, height),
+                width, height, engine, budget
+            )
+            imgFilter.img = strip
+            imgFilter.top = top
+
+            try:
+                if not vectorizer:
+                    raise VectorizeError('program can\'t be vectorized')
+                vectorizer.run(imgFilter)
+            except VectorizeError:
+                imgFilter.env[TilePlan.START] = top
+                imgFilter.env[TilePlan.STOP] = bottom
+                imgFilter.runEngine(plan.tokens)
+            
+            writer.write(strip)
+            budget.advance(bottom / height)
+        
+        writer.close()
+    
+    return plan
+
+
+def sharedImage(memory, width, height) -> Image.Image:
+    """Returns an image whose pixels are kept in shared memory, so that
+    processes can change the same image. Pillow can only share images
+    with 4 bytes per pixel, so the image is RGBX, and its pixels have a
+    fourth value that is always 255."""
+
+    img = Image.frombuffer(
+        'RGBX', (width, height), memory.buf, 'raw', 'RGBX', 0, 1
+    )
+    # Images made from buffers are read only, but this memory isn't
+    img.readonly = 0
+    return img
+
+
+def runTile(tokens, engine, sourceName, destName, stateName, index, width,
+            height, start, stop, steps = None, deadline = None):
+    """Runs one tile of a TilePlan in a worker process. The pixels are
+    read and written through shared memory. The tile has its own Budget
+    of steps that stops at deadline (from time.time()), or once runTiles
+    sets the flag in the state, where the tile saves its steps."""
+
+    source = shared_memory.SharedMemory(name=sourceName)
+    dest = shared_memory.SharedMemory(name=destName)
+    state = shared_memory.SharedMemory(name=stateName)
+    imgFilter = None
+    budget = None
+    stopped = None
+
+    def cancelled():
+        # Called on every check, so runTiles can add up the steps
+        setTileSteps(state, index, budget.steps)
+        return state.buf[0]
+
+    try:
+        seconds = None if deadline is None else deadline - time.time()
+        budget = Budget(steps, seconds)
+        budget.cancelled = cancelled
+        imgFilter = ImgFilter.fromPixels(
+            sharedImage(dest, width, height).load(),
+            sharedImage(source, width, height).load(),
+            width, height, engine, budget
+        )
+        imgFilter.env[TilePlan.START] = start
+        imgFilter.env[TilePlan.STOP] = stop
+        try:
+            imgFilter.run(tokens)
+        except BudgetError as error:
+            # Its traceback would keep the images alive
+            stopped = BudgetError(error.reason, error.progress)
+    finally:
+        if budget is not None:
+            setTileSteps(state, index, budget.steps)
+        
+        # The images have to be let go before the memory is closed,
+        # and the ImgFilter's functions refer back to it
+        imgFilter = None
+        gc.collect()
+        source.close()
+        dest.close()
+        state.close()
+    
+    if stopped is not None:
+        raise stopped
+
+
+def setTileSteps(state, index: int, steps: int):
+    """Saves the steps of tile index in the state of runTiles, which
+    has a flag in its first 8 bytes and the steps of every tile after."""
+
+    state.buf[8 * index + 8:8 * index + 16] = steps.to_bytes(8, 'little')
+
+
+def getTileSteps(state, count: int) -> int:
+    "Adds up the steps of count tiles saved with setTileSteps."
+
+    return sum(
+        int.from_bytes(state.buf[8 * i + 8:8 * i + 16], 'little')
+        for i in range(count)
+    )
+
+
+# Process pools that run tiles, by their number of workers
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+def getPool(workers: int) -> ProcessPoolExecutor:
+    """Returns the process pool with the number of workers, starting it
+    the first time it's needed."""
+
+    with POOLS_LOCK:
+        if workers not in POOLS:
+            # Forking a process with threads running isn't safe
+            POOLS[workers] = ProcessPoolExecutor(
+                workers, mp_context=get_context('spawn')
+            )
+        return POOLS[workers]
+
+
+class RefRegion:
+    """A part of the image copied by makeRef(), which is read with the
+    coordinates of the whole image, see RefPlan."""
+
+    def __init__(self, img, box):
+        self.x, self.y = box[:2]
+        self.pixels = img.crop(box).load()
+    
+
+    def __getitem__(self, xy):
+        return self.pixels[xy[0] - self.x, xy[1] - self.y]
+
+
+class RefPlan(PixelLoop):
+    """The RefPlan decides how much of the image makeRef() has to copy,
+    by looking at where the program reads the reference image with
+    loadRef() and where it changes pixels.
+
+    The copy is skipped, and loadRef() reads the pixels directly, when
+    loadRef() is never called, when no pixel is ever changed, or when
+    the program loops through the image and only ever loads (x, y)
+    before setting pixels at (x, y), as no pixel is then read after it
+    has changed. Otherwise, if every loadRef() can be shown to stay in
+    part of the image, only that part is copied, see RefRegion.
+    
+    makeRef() in a loop makes a copy every time it is called, so those
+    calls are added to self.warnings."""
+
+    # The functions that change many pixels at once
+    FILTERS = ('convolve', 'gradient', 'mapPixels', 'mapRegion')
+
+    # The FILTERS that call a function for every pixel
+    MAPS = ('mapPixels', 'mapRegion')
+
+    def __init__(self, tokens, width, height):
+        self.width = width
+        self.height = height
+        self.warnings = []
+
+        # The box of the image that has to be copied, None if the copy
+        # can be skipped
+        self.box = (0, 0, width, height)
+
+        self.loads = []
+        self.writes = 0
+        self.assigned = set()
+        # Set if loadRef, makeRef or the FILTERS are used other than by
+        # calling them
+        self.unknown = False
+
+        self.findAssigned(tokens)
+        self.visit(tokens, {}, 0)
+
+        if self.unknown or {'loadRef', 'makeRef'} & self.assigned:
+            return
+
+        if not self.loads or not self.writes or self.readsBeforeWrite(tokens):
+            self.box = None
+            return
+        
+        # The box around every pixel that loadRef() could load
+        boxes = [self.loadBox(args, ranges) for args, ranges in self.loads]
+        if None in boxes:
+            return
+        
+        self.box = (
+            min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes)
+        )
+    
+
+    def findAssigned(self, token):
+        "Saves the names of every variable that is assigned."
+
+        for child in self.children(token):
+            self.findAssigned(child)
+        
+        if token.type == 'assign' and token.left.type == 'var':
+            self.assigned.add(token.left.value)
+    
+
+    def children(self, token) -> list:
+        "Returns the tokens in token, in the order they are evaluated."
+
+        typ = token.type
+
+        if typ == 'for':
+            return [token.init, token.cond, token.body, token.incr]
+        if typ == 'lambda':
+            return [token.body]
+        if typ == 'if':
+            return [token.value, token.then] + (
+                [token.otherwise] if token.otherwise else []
+            )
+        if typ == 'call':
+            return [token.value] + token.args
+        if typ == 'prog':
+            return token.value
+        if typ == 'assign' and token.left.type == 'index':
+            return token.left.index + [token.right]
+        if typ == 'assign':
+            return [token.right]
+        if typ == 'binary':
+            return [token.left, token.right]
+        
+        return []
+    
+
+    def visit(self, token, ranges, loops):
+        """Finds the calls to loadRef and makeRef, and the changes to
+        pixels. ranges holds the values that the variables of the loops
+        around token can have, and loops counts the loops."""
+
+        typ = token.type
+
+        if typ == 'var' and token.value in ('loadRef', 'makeRef') + (
+            self.FILTERS
+        ):
+            self.unknown = True
+            return
+        
+        if typ == 'call' and token.value.type == 'var':
+            name = token.value.value
+
+            # Changes every pixel, and the MAPS run their function as
+            # if it was in a loop
+            if name in self.FILTERS:
+                self.writes += 1
+                for arg in token.args:
+                    self.visit(arg, ranges, loops + (name in self.MAPS))
+                return
+
+            if name == 'loadRef':
+                self.loads.append((token.args, ranges))
+            elif name == 'makeRef' and loops:
+                self.warnings.append(
+                    'makeRef() is called in a loop, which copies the '
+                    'image every time it is called'
+                )
+            
+            if name in ('loadRef', 'makeRef'):
+                for arg in token.args:
+                    self.visit(arg, ranges, loops)
+                return
+        
+        if typ == 'assign' and token.left.type == 'index':
+            self.writes += 1
+        
+        if typ == 'lambda':
+            # The function could be called anywhere
+            self.visit(token.body, {}, loops)
+            return
+        
+        if typ == 'for':
+            for part in (token.init, token.cond, token.incr):
+                self.visit(part, ranges, loops)
+            self.visit(
+                token.body, self.loopRanges(token, ranges), loops + 1
+            )
+            return
+        
+        for child in self.children(token):
+            self.visit(child, ranges, loops)
+    
+
+    def loopRanges(self, token, ranges) -> dict:
+        """Returns the ranges of the variables in the body of a loop
+        like (i = a; i < b; i = i + 1), where i is only changed by the
+        loop and a and b have known ranges."""
+
+        ranges = dict(ranges)
+        init, cond, incr = token.init, token.cond, token.incr
+
+        if not (init.type == 'assign' and init.left.type == 'var'):
+            return ranges
+        
+        name = init.left.value
+        ranges.pop(name, None)
+
+        # The loop variable is only changed by the loop
+        if self.changes(token.body, name) or not (
+            cond.type == 'binary' and cond.value == '<'
+            and self.isVar(cond.left, name)
+            and incr.type == 'assign' and self.isVar(incr.left, name)
+            and incr.right.type == 'binary' and incr.right.value == '+'
+            and self.isVar(incr.right.left, name)
+            and incr.right.right.type == 'num'
+            and incr.right.right.value == 1
+        ):
+            return ranges
+
+        start = self.interval(init.right, ranges)
+        stop = self.interval(cond.right, ranges)
+        if start and stop:
+            ranges[name] = (start[0], stop[1] - 1)
+        
+        return ranges
+    
+
+    def changes(self, token, name) -> bool:
+        "Returns true if name is assigned anywhere in token."
+
+        if token.type == 'assign' and self.isVar(token.left, name):
+            return True
+        return any(self.changes(t, name) for t in self.children(token))
+    
+
+    def interval(self, token, ranges):
+        """Returns the smallest and largest integer that token could be,
+        or None if that isn't known."""
+
+        typ = token.type
+
+        if typ == 'num':
+            if type(token.value) != int:
+                return None
+            return (token.value, token.value)
+        
+        if typ == 'var':
+            if token.value in ranges:
+                return ranges[token.value]
+            if token.value in self.assigned:
+                return None
+            if token.value == 'width':
+                return (self.width, self.width)
+            if token.value == 'height':
+                return (self.height, self.height)
+            return None
+        
+        if typ == 'binary' and token.value in ('+', '-'):
+            left = self.interval(token.left, ranges)
+            right = self.interval(token.right, ranges)
+            if not (left and right):
+                return None
+            if token.value == '+':
+                return (left[0] + right[0], left[1] + right[1])
+            return (left[0] - right[1], left[1] - right[0])
+        
+        return None
+    
+
+    def loadBox(self, args, ranges):
+        """Returns the box around the pixels that loadRef(x, y) could
+        load, or None if it could load any of them."""
+
+        if len(args) != 2:
+            return None
+        
+        x = self.interval(args[0], ranges)
+        y = self.interval(args[1], ranges)
+
+        # Pixels outside of the image throw errors, or wrap around to
+        # the other side, so those are left to the full copy
+        if not (
+            x and y and 0 <= x[0] and x[1] < self.width
+            and 0 <= y[0] and y[1] < self.height
+        ):
+            return None
+        
+        return (x[0], y[0], x[1] + 1, y[1] + 1)
+    
+
+    def readsBeforeWrite(self, tokens) -> bool:
+        """Returns true if the program is only makeRef() calls followed
+        by a loop through the image, which loads (x, y) with loadRef()
+        before setting pixels at (x, y), and nothing else."""
+
+        if tokens.type != 'prog' or not tokens.value:
+            return False
+        
+        *refs, loop = tokens.value
+        if not all(
+            self.isCall(token, 'makeRef') and not token.args
+            for token in refs
+        ):
+            return False
+        
+        try:
+            self.matchNest(loop)
+        except self.Error:
+            return False
+        
+        self.written = False
+        try:
+            for token in self.body:
+                self.checkOrder(token)
+        except self.Error:
+            return False
+        
+        return True
+    
+
+    def checkOrder(self, token):
+        """Checks that token only loads and sets pixels at (x, y), and
+        doesn't load any pixels after setting them."""
+
+        typ = token.type
+
+        if typ in ('for', 'lambda'):
+            raise self.Error('cannot check the order of loops or lambdas')
+        
+        if typ == 'assign' and token.left.type == 'var' and (
+            token.left.value in (self.x, self.y)
+        ):
+            raise self.Error('x and y cannot be changed')
+        
+        if self.isCall(token, 'makeRef') or any(
+            self.isCall(token, name) for name in self.FILTERS
+        ):
+            raise self.Error(f'{token.value.value} cannot be in the loop')
+        
+        for child in self.children(token):
+            self.checkOrder(child)
+        
+        if self.isCall(token, 'loadRef'):
+            if self.written or not self.isCoords(token.args):
+                raise self.Error('loadRef must load (x, y) before it changes')
+        
+        if typ == 'assign' and token.left.type == 'index':
+            if not self.isCoords(token.left.index):
+                raise self.Error('pixels can only be set at (x, y)')
+            self.written = True
+
+
+class ProgressPlan(PixelLoop):
+    """The ProgressPlan lets a program report how far it got, by calling
+    '@progress' at the start of every pass through its loops over the
+    image that aren't inside of anything else:
+
+        for (x = 0; x < width; x = x + 1) {
+            '@progress'(0, x);
+            ...
+        };
+
+    It's given which of those loops it is and the loop's variable, and
+    the loops are counted as taking about as long as each other, see
+    ImgFilter.trackLoop. Like '@step', '@progress' can't be used in code
+    as it isn't a valid name. Programs without those loops are left as
+    they are, and only report once they're done."""
+
+    def __init__(self, tokens, width, height):
+        # The number of passes through each loop
+        self.sizes = []
+
+        statements = tokens.value if tokens.type == 'prog' else [tokens]
+        tracked = [self.track(token, width, height) for token in statements]
+        self.tokens = Token('prog', tracked) if self.sizes else tokens
+    
+
+    def track(self, token, width, height):
+        "Returns the statement, reporting its progress if it's a loop."
+
+        try:
+            name, bound = self.matchLoop(token)
+        except self.Error:
+            return token
+        
+        report = CallToken('call', Token('var', '@progress'), [
+            Token('num', len(self.sizes)), Token('var', name)
+        ])
+        self.sizes.append(width if bound == 'width' else height)
+
+        return ForToken(
+            'for', token.init, token.cond, token.incr,
+            Token('prog', [report, token.body])
+        )
+
+
+class BudgetError(Exception):
+    """Raised when a program runs out of steps or time, or is cancelled.
+    How far it got is kept in progress."""
+
+    def __init__(self, reason, progress):
+        super().__init__(
+            f'Stopped after {progress["steps"]} steps and '
+            f'{progress["seconds"]:.2f} seconds, as {reason}'
+        )
+        self.reason = reason
+        self.progress = progress
+    
+
+    def __reduce__(self):
+        # Errors from worker processes are pickled, see workers.py
+        return (type(self), (self.reason, self.progress))
+
+
+class Budget:
+    """The Budget keeps a program from running forever. Every pass
+    through a loop and every call to a lambda is a step, and the program
+    is stopped with a BudgetError once it takes more than steps steps,
+    runs for more than seconds seconds, or cancelled() returns true.
+    Leaving them as None means there is no limit.
+
+    Compiled code calls step through the global '@step', which can't be
+    used in code as it isn't a valid name. Looking at the clock is slow
+    compared to counting, so the time and cancelled are only checked
+    every CHECK_EVERY steps.
+
+    How much of the program is done, from 0 to 1, is kept in done, see
+    advance. With report, it's called with self.progress() at most every
+    REPORT_EVERY seconds while the program runs."""
+
+    CHECK_EVERY = 1000
+
+    REPORT_EVERY = 0.5
+
+    def __init__(self, steps = None, seconds = None, cancelled = None,
+                 report = None):
+        self.maxSteps = steps
+        self.seconds = seconds
+        self.cancelled = cancelled
+        self.report = report
+        self.start()
+    
+
+    def start(self):
+        "Starts counting steps and time from zero."
+
+        self.steps = 0
+        self.done = 0.0
+        self.started = time.monotonic()
+        self.deadline = (
+            None if self.seconds is None else self.started + self.seconds
+        )
+        self.nextCheck = 0
+        self.nextReport = self.started + self.REPORT_EVERY
+        self.check()
+    
+
+    def advance(self, done: float):
+        "Saves how much of the program is done, and reports it if it's time."
+
+        self.done = done
+
+        if self.report is not None:
+            now = time.monotonic()
+            if now >= self.nextReport:
+                self.nextReport = now + self.REPORT_EVERY
+                self.report(self.progress())
+    
+
+    def step(self):
+        "Counts a step, and stops the program if it's over budget."
+
+        self.steps += 1
+        if self.steps >= self.nextCheck:
+            self.check()
+    
+
+    def check(self):
+        "Stops the program if it's over budget."
+
+        if self.maxSteps is not None and self.steps > self.maxSteps:
+            raise BudgetError('it ran out of steps', self.progress())
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetError('it ran out of time', self.progress())
+        if self.cancelled is not None and self.cancelled():
+            raise BudgetError('it was cancelled', self.progress())
+        
+        self.nextCheck = self.steps + self.CHECK_EVERY
+        if self.maxSteps is not None:
+            self.nextCheck = min(self.nextCheck, self.maxSteps + 1)
+    
+
+    def progress(self) -> dict:
+        "Returns the steps taken, seconds spent and how much is done so far."
+
+        return {
+            'steps': self.steps,
+            'seconds': time.monotonic() - self.started,
+            'done': self.done,
+        }
+
+
+class Profiler:
+    """The Profiler counts how many times every token is evaluated and
+    how long it takes, so that slow filters can be traced back to the
+    lines of code that make them slow.
+
+    Each token has a total time, which includes the tokens inside of it,
+    and an own time, which doesn't. A lambda that calls itself counts
+    its time more than once in its total, but never in its own time.
+    Measuring every token makes the program a lot slower, so profiling
+    is only done when asked for, see ImgFilter."""
+
+    def __init__(self):
+        # The token, evaluations, total and own seconds, by id(token)
+        self.nodes = {}
+        # The seconds spent in the tokens inside each measured token
+        self.stack = []
+        # The seconds spent measuring the outermost tokens
+        self.seconds = 0.0
+    
+
+    def measure(self, token, func, *args):
+        "Returns func(*args), counting the time it takes toward token."
+
+        self.stack.append(0.0)
+        start = time.perf_counter()
+
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            inner = self.stack.pop()
+
+            node = self.nodes.get(id(token))
+            if node is None:
+                # The token is kept so its id can't be reused
+                node = self.nodes[id(token)] = [token, 0, 0.0, 0.0]
+            node[1] += 1
+            node[2] += elapsed
+            node[3] += elapsed - inner
+
+            if self.stack:
+                self.stack[-1] += elapsed
+            else:
+                self.seconds += elapsed
+    
+
+    def wrap(self, code, token):
+        "Returns code measured as token, for the Compiler."
+
+        measure = self.measure
+        return lambda frame : measure(token, code, frame)
+    
+
+    def percent(self, seconds) -> float:
+        "Returns the percent of the whole run that seconds are."
+
+        return 100 * seconds / self.seconds if self.seconds else 0.0
+    
+
+    def report(self, limit = None) -> list:
+        """Returns the measured tokens, the ones that took the most time
+        of their own first."""
+
+        nodes = sorted(self.nodes.values(), key=lambda node : -node[3])
+
+        return [
+            {
+                'line': token.line,
+                'col': token.col,
+                'type': token.type,
+                'code': formatToken(token),
+                'count': count,
+                'seconds': total,
+                'ownSeconds': own,
+                'percent': self.percent(total),
+                'ownPercent': self.percent(own),
+            }
+            for token, count, total, own in nodes[:limit]
+        ]
+    
+
+    def lines(self) -> list:
+        """Returns the own time of the tokens on each line, the slowest
+        lines first."""
+
+        lines = {}
+        for token, count, total, own in self.nodes.values():
+            lines[token.line] = lines.get(token.line, 0.0) + own
+        
+        return [
+            {'line': line, 'seconds': own, 'percent': self.percent(own)}
+            for line, own in sorted(lines.items(), key=lambda x : -x[1])
+        ]
+    
+
+    def format(self, limit = 20) -> str:
+        "Returns the report as a table, to be printed."
+
+        rows = [
+            f'{self.seconds:.3f} seconds, the slowest tokens first',
+            f'{"line:col":>9} {"own":>7} {"total":>7} {"count":>10}  code',
+        ]
+
+        for node in self.report(limit):
+            where = f'{node["line"]}:{node["col"]}'
+            code = node['code']
+            if len(code) > 40:
+                code = code[:37] + '...'
+            
+            rows.append(
+                f'{where:>9} {node["ownPercent"]:6.1f}% '
+                f'{node["percent"]:6.1f}% {node["count"]:>10}  {code}'
+            )
+        
+        return '\n'.join(rows)
+    
+
+    def toDict(self, limit = 20) -> dict:
+        "Returns the report, to be sent as JSON."
+
+        return {
+            'seconds': self.seconds,
+            'tokens': self.report(limit),
+            'lines': self.lines(),
+            'text': self.format(limit),
+        }
+
+
+# This could also be made into a function, or we could apply multiple
+# filters to one image, which is an interesting idea
+class ImgFilter:
+    """The ImgFilter class will take the given image and open it, and
+    also evaluate the written code, giving it ways to access and filter
+    the given image.
+    
+    The code can be ran by one of three engines, 'interpreter', which
+    walks through the tokens with self.evaluate, 'closure', which
+    compiles the tokens with the Compiler before running them, or
+    'python', which runs the code made by the Transpiler, and uses the
+    'closure' engine for programs that can't be transpiled.
+    
+    The program is stopped with a BudgetError if it goes over budget,
+    which by default has no limits, see Budget.
+
+    With profile, the time taken by every token is kept in
+    self.profiler, see Profiler. Only the 'interpreter' and 'closure'
+    engines run token by token, so the 'python' engine uses 'closure',
+    and the program is never vectorized or split into tiles.
+
+    With optimize, the tokens are first simplified by the Optimizer, and
+    what it removed is kept in self.removed. Anything in the program
+    that is likely a mistake is kept in self.warnings.
+
+    With vectorize, programs that the Vectorizer recognizes are ran over
+    the whole image at once with NumPy, no matter the engine. With more
+    than one worker, programs that a TilePlan recognizes are split into
+    tiles that are ran by that many processes."""
+
+    # The engines that are able to run the user's code
+    ENGINES = ('interpreter', 'closure', 'python')
+
+    # Images with fewer pixels aren't worth splitting into tiles
+    TILE_MIN_PIXELS = 256 * 256
+
+    # How many tiles each worker gets, more tiles spread the work better
+    TILES_PER_WORKER = 4
+
+    # How convolve() fills in the pixels past the edges of the image, by
+    # the number the user passes in. The numbers are also given to the
+    # user as edgeZero, edgeExtend, edgeWrap and edgeMirror.
+    EDGES = {0: 'constant', 1: 'edge', 2: 'wrap', 3: 'reflect'}
+
+    def __init__(self, imgname, engine = 'interpreter', vectorize = True,
+                 workers = 1, optimize = True, budget = None,
+                 profile = False):
+        self.setup(engine, vectorize, workers, optimize, budget, profile)
+        self.imgname = imgname
+
+        # Opens the image and saves it to the class
+        with Image.open(f'static/images/source/{imgname}') as img:
+            self.setImage(upright(img))
+    
+
+    @classmethod
+    def fromImage(cls, img, engine = 'interpreter', **options):
+        """Creates an ImgFilter that changes a copy of img, an image that
+        is already opened, instead of an image from static/images/source.
+        It takes the same options as ImgFilter, and is ran with run."""
+
+        self = cls.__new__(cls)
+        self.setup(engine, **options)
+        self.imgname = None
+        self.setImage(img.copy())
+        return self
+    
+
+    def setup(self, engine, vectorize = True, workers = 1, optimize = True,
+              budget = None, profile = False):
+        "Saves the options of the ImgFilter, see __init__."
+
+        if engine not in self.ENGINES:
+            raise ValueError(f'Unknown engine {engine}')
+
+        self.engine = engine
+        self.vectorize = vectorize
+        self.workers = workers
+        self.optimize = optimize
+        self.budget = budget or Budget()
+        self.profiler = Profiler() if profile else None
+        self.removed = []
+        self.warnings = []
+        self.refPlan = None
+        self.progressPlan = None
+        # The stage of the pipeline being ran, out of stages
+        self.stage = 0
+        self.stages = 1
+        # The image as it's being changed, if it isn't self.img
+        self.shown = None
+    
+
+    def setImage(self, img):
+        "Saves the image that will be filtered, and its global scope."
+
+        self.img = img if img.mode == 'RGB' else img.convert('RGB')
+        # Also saves the pixels, which is what we can edit to change
+        # the photo
+        self.pixels = self.img.load()
+
+        # Saves the dimensions for use in the user's code
+        self.width = self.img.size[0]
+        self.height = self.img.size[1]
+        # The row of the whole image that self.img starts at, which is
+        # only ever not 0 for strips, see runStrips
+        self.top = 0
+
+        self.env = self.makeEnv()
+
+
+    @classmethod
+    def fromPixels(cls, pixels, ref, width, height, engine = 'interpreter',
+                   budget = None):
+        """Creates an ImgFilter that changes pixels directly instead of
+        an opened image, with ref already made as the reference image.
+        The tokens it runs are expected to be optimized already."""
+
+        if engine not in cls.ENGINES:
+            raise ValueError(f'Unknown engine {engine}')
+        
+        self = cls.__new__(cls)
+        self.imgname = None
+        self.img = None
+        self.engine = engine
+        self.vectorize = False
+        self.workers = 1
+        self.optimize = False
+        self.budget = budget or Budget()
+        self.profiler = None
+        self.removed = []
+        self.warnings = []
+        self.refPlan = None
+        self.progressPlan = None
+        self.stage = 0
+        self.stages = 1
+        self.shown = None
+        self.pixels = pixels
+        self.ref = ref
+        self.width = width
+        self.height = height
+        self.top = 0
+        self.env = self.makeEnv()
+        return self
+    
+
+    def makeEnv(self):
+        "Returns the global scope, with the variables given to the user."
+
+        # Saves variables accessible to the user
+        return Environment({
+            'pixels': self.pixels,
+            'width': self.width,
+            'height': self.height,
+            'rgb': lambda r, g, b : (int(r), int(g), int(b)),
+            'loadColor': lambda x, y : self.loadColor(x, y),
+            'makeRef': self.makeRef,
+            'loadRef': lambda x, y : self.loadRef(x, y),
+            'sqrt': lambda x : math.sqrt(x),
+            'convolve': self.convolve,
+            'gradient': self.gradient,
+            'edgeZero': 0,
+            'edgeExtend': 1,
+            'edgeWrap': 2,
+            'edgeMirror': 3,
+            'mapPixels': self.mapPixels,
+            'mapRegion': self.mapRegion,
+            '@step': self.budget.step,
+            '@progress': self.trackLoop,
+        })
+
+
+    def evaluate(self, token: Token, frame):
+        """Reads tokens and returns and saves them in a way usable by
+        Python. Variables are kept in frame, see Resolver."""
+
+        # Gets the type of the given token
+        typ = token.type
+
+        # If number or boolean, return the value as int, float, or bool
+        if typ in ('num', 'bool'):
+            return token.value
+        
+        # If the name of a variable, return the value of the variable
+        if typ == 'var':
+            addresses = self.resolver.reads[id(token)]
+            if not addresses:
+                return frame[1][token.value]
+            return Resolver.lookup(frame, token.value, addresses)
+        
+        # If assignment token, then save the variable to the environment
+        if typ == 'assign':
+            # If the token that is to be saved is an index
+            if token.left.type == 'index':
+                if token.left.var.value != 'pixels':
+                    raise SyntaxError(f'Cannot assign to {token.left}')
+                if len(token.left.index) != 2:
+                    raise SyntaxError(f'index must include x and y')
+                if token.right.value.value != 'rgb':
+                    raise SyntaxError(
+                        f'rgb function must be used to save to pixels'
+                    )
+                
+                x = self.evaluate(token.left.index[0], frame)
+                y = self.evaluate(token.left.index[1], frame)
+
+                color = self.evaluate(token.right, frame)
+                self.evaluate(token.left.var, frame)[x, y] = color
+
+                return color
+
+            # If the token that is supposed to be saved to isn't a
+            # variable name, then throw an error
+            if token.left.type != 'var':
+                raise SyntaxError(f'Cannot assign to {token.left}')
+            # Otherwise, evaluate the tokens that are supposed to be
+            # assigned to the variable
+            value = self.evaluate(token.right, frame)
+            # And then save it to its slot, or to the globals
+            slot = self.resolver.writes[id(token)]
+            if slot is None:
+                frame[1][token.left.value] = value
+            else:
+                frame[slot] = value
+            # And return the value that was saved
+            return value
+        
+        # If it is a BinaryToken, then apply the operation
+        # and return the value
+        if typ == 'binary':
+            return self.applyOp(
+                # First give the operator
+                op = token.value,
+                # Then the numbers that are being operated on
+                a  = self.evaluate(token.left, frame),
+                b  = self.evaluate(token.right, frame)
+            )
+
+        # If it is a lambda token, then call makeLambda, a functino
+        # used for Interpreting functions and making them callable
+        if typ == 'lambda':
+            return self.makeLambda(token, frame) 
+        
+        # If it is an IfToken
+        if typ == 'if':
+            # Evaluate the if condition
+            cond = self.evaluate(token.value, frame)
+
+            # If a condition is true,
+            # evaluate the then part of the IfToken
+            # else, evaluate otherwise of IfToken
+            # Finally return False if there was no condition
+            # and there was no otherwise statement
+            if cond:
+                return self.evaluate(token.then, frame)
+            elif token.otherwise:
+                return self.evaluate(token.otherwise, frame)
+            else:
+                return False
+            
+        # If type 'prog', go through all the contained tokens
+        # and evaluate them, returning the value of the final token
+        if typ == 'prog':
+            val = False
+            for expr in token.value:
+                val = self.evaluate(expr, frame)
+            return val
+
+        # If the Token is calling a function
+        if typ == 'call':
+            # Get the function saved in memory by evaluating the name
+            # of the function
+            func = self.evaluate(token.value, frame)
+
+            # And then apply the saved args to the function using the
+            # splat operator to unpack it into the function
+            return func(
+                *[self.evaluate(arg, frame) for arg in token.args]
+            )
+        
+        # If the Token is a for loop
+        if typ == 'for':
+            return self.forEval(token, frame)
+        
+        # Raise an error if the token isn't recognized
+        raise SyntaxError(f'Unable to evaluate {token}')
+    
+
+    def applyOp(self, op, a, b):
+        """The applyOp function will perform the given operation (op)
+        on a and b."""
+
+        # Throw an error if unrecognized operator
+        if op not in OPERATORS:
+            raise SyntaxError(f'Unrecognized operator {op}')
+
+        # Applies the operator
+        return OPERATORS[op](a, b)
+    
+
+    def makeLambda(self, token, frame):
+        """The makeLambda function will return a function that will
+        evaluate tokens and run them when called."""
+
+        # The function to be returned, this will
+        # usually be saved to the environment
+        def func(*argv):
+            self.budget.step()
+
+            # Read the slots of the variable names given by the lambda
+            params = self.resolver.params[id(token)]
+
+            # Create a new frame that will simulate scope,
+            # ensuring that variables saved in the function will not
+            # be accessible from outside of the function
+            scope = self.resolver.frame(token, frame)
+
+            # Saves the given parameters in *argv to the names given
+            # to the function inside the local scope
+            for i in range(len(params)):
+                # If a position arg wasn't given, save it as False
+                scope[params[i]] = argv[i] if i < len(argv) else False
+            
+            # Returns the last read value
+            return self.evaluate(token.body, scope)
+        
+        # Returns the generated function
+        return func
+    
+
+    def forEval(self, token, frame):
+        "Loops through for loop while its condition is true."
+
+        scope = self.resolver.frame(token, frame)
+        step = self.budget.step
+
+        self.evaluate(token.init, scope)
+
+        while self.evaluate(token.cond, scope):
+            step()
+            self.evaluate(token.body, scope)
+            self.evaluate(token.incr, scope)
+        
+        return None
+    
+
+    def loadColor(self, x, y):
+        # Shared images have a fourth value, see sharedImage
+        r, g, b = self.pixels[x, y][:3]
+
+        self.env['r'] = r
+        self.env['g'] = g
+        self.env['b'] = b
+
+
+    def makeRef(self):
+        # Only copies as much of the image as is needed, see RefPlan
+        box = self.refPlan.box if self.refPlan else (0, 0) + self.img.size
+
+        if box is None:
+            self.ref = self.pixels
+        elif box == (0, 0) + self.img.size:
+            self.ref = self.img.copy().load()
+        else:
+            self.ref = RefRegion(self.img, box)
+
+
+    def loadRef(self, x, y):
+        r, g, b = self.ref[x, y][:3]
+
+        self.env['r'] = r
+        self.env['g'] = g
+        self.env['b'] = b
+    
+
+    def convolve(self, edge, combined, *kernel):
+        """Replaces every pixel with the sum of the pixels around it,
+        each multiplied by its number in the kernel, see applyKernels."""
+
+        self.applyKernels('convolve', edge, combined, [kernel])
+    
+
+    def gradient(self, edge, combined, *kernels):
+        """Applies two kernels of the same size, given one after the
+        other, and replaces every pixel with sqrt(a * a + b * b) of the
+        two sums, like the Sobel operator does. With only one kernel,
+        the second is the first one flipped over its diagonal, which
+        finds the edges going the other way. See applyKernels."""
+
+        size = math.isqrt(len(kernels))
+        if size * size == len(kernels):
+            flipped = tuple(
+                kernels[x * size + y]
+                for y in range(size) for x in range(size)
+            )
+            kernels = [kernels, flipped]
+        else:
+            half = len(kernels) // 2
+            kernels = [kernels[:half], kernels[half:]]
+        
+        self.applyKernels('gradient', edge, combined, kernels)
+    
+
+    def applyKernels(self, name, edge, combined, kernels):
+        """Applies NxN kernels to the whole image at once with NumPy.
+        The kernel is laid out row by row, as it sits over the image, and
+        edge is one of EDGES. If combined, the kernels are applied to the
+        average of r, g and b, and the image is made gray, otherwise
+        every channel is filtered on its own. Results are rounded, and
+        kept between 0 and 255."""
+
+        if np is None:
+            raise RuntimeError(f'{name} needs NumPy to be installed')
+        if checkNum(edge) not in self.EDGES:
+            raise ValueError(f'Unknown edge {edge} for {name}')
+        
+        size = math.isqrt(len(kernels[-1]))
+        for kernel in kernels:
+            if size == 0 or len(kernel) != size * size:
+                raise ValueError(
+                    f'{name} needs kernels of N * N numbers, got '
+                    f'{len(kernel)}'
+                )
+            for value in kernel:
+                checkNum(value)
+        
+        img = np.asarray(self.img, dtype=np.float64)
+        if combined:
+            img = img.mean(axis=2, keepdims=True)
+        height, width = img.shape[:2]
+
+        # Pixels past the edges, so every pixel has all of its neighbors
+        before = size // 2
+        after = size - 1 - before
+        padded = np.pad(
+            img, ((before, after), (before, after), (0, 0)),
+            mode=self.EDGES[edge]
+        )
+
+        # Each number in the kernel multiplies the whole image at once,
+        # shifted by its position in the kernel
+        sums = []
+        for kernel in kernels:
+            total = np.zeros_like(img)
+            for i, value in enumerate(kernel):
+                if value:
+                    y, x = divmod(i, size)
+                    total += value * padded[y:y + height, x:x + width]
+            sums.append(total)
+        
+        if len(sums) == 1:
+            result = sums[0]
+        else:
+            result = np.sqrt(sums[0] * sums[0] + sums[1] * sums[1])
+
+        result = np.clip(np.trunc(result + 0.5), 0, 255).astype(np.uint8)
+        if combined:
+            result = np.repeat(result, 3, axis=2)
+        
+        self.img.paste(Image.fromarray(result, 'RGB'))
+    
+
+    def mapPixels(self, func):
+        """Calls func(r, g, b, x, y) for every pixel, and replaces the
+        pixel with the color it returns, see mapRegion."""
+
+        self.mapRegion(0, 0, self.width, self.height, func)
+    
+
+    def mapRegion(self, left, top, right, bottom, func):
+        """Calls func(r, g, b, x, y) for every pixel from (left, top)
+        up to, but not including, (right, bottom), and replaces the pixel
+        with the color it returns. The colors are all read before func
+        is first called and written after it's last called, instead of
+        one pixel at a time."""
+
+        box = tuple(int(checkNum(v)) for v in (left, top, right, bottom))
+        left, top, right, bottom = box
+
+        if not (
+            0 <= left <= right <= self.width
+            and 0 <= top <= bottom <= self.height
+        ):
+            raise ValueError(f'mapRegion{box} is outside of the image')
+        
+        whole = box == (0, 0, self.width, self.height)
+        region = self.img if whole else self.img.crop(box)
+
+        coords = (
+            (x, y) for y in range(top, bottom) for x in range(left, right)
+        )
+        colors = [
+            func(r, g, b, x, y)
+            for (r, g, b), (x, y) in zip(region.getdata(), coords)
+        ]
+
+        for color in colors:
+            if type(color) != tuple or len(color) != 3:
+                raise TypeError(
+                    f'The function must return a color made by rgb, '
+                    f'got {color}'
+                )
+        
+        region.putdata(colors)
+        if not whole:
+            self.img.paste(region, box)
+    
+
+    def run(self, tokens):
+        "Runs the parsed tokens using the selected engine."
+
+        self.runPipeline([tokens])
+    
+
+    def runPipeline(self, stages):
+        """Runs parsed programs one after the other on the same image,
+        which is the same as saving the image after each one and running
+        the next on it, without saving it. Every stage starts with its
+        own variables and no reference image, and the budget is for all
+        of them together."""
+
+        self.budget.start()
+        self.stages = len(stages)
+        removed = []
+        warnings = []
+
+        for i, tokens in enumerate(stages):
+            if i > 0:
+                # Only the image is kept from the last stage
+                self.env = self.makeEnv()
+                self.__dict__.pop('ref', None)
+            
+            self.stage = i
+            self.runStage(tokens)
+            self.advance(1)
+            removed += self.removed
+            warnings += self.warnings
+        
+        self.removed = removed
+        self.warnings = warnings
+    
+
+    def runStage(self, tokens):
+        """Runs the parsed tokens on the image as it is now, see
+        runPipeline."""
+
+        self.removed = []
+        if self.optimize:
+            optimizer = Optimizer()
+            tokens = optimizer.optimize(tokens)
+            self.removed = optimizer.removed
+
+        self.refPlan = RefPlan(tokens, self.width, self.height)
+        self.warnings = self.refPlan.warnings
+
+        profiler = self.profiler
+
+        # Run the program over the whole image if possible, otherwise
+        # fall back to the engine
+        if self.vectorize and not profiler:
+            vectorizer = Vectorizer.match(tokens)
+            if vectorizer:
+                try:
+                    return vectorizer.run(self)
+                except VectorizeError:
+                    pass
+        
+        # Split the program between processes if possible
+        if (
+            self.workers > 1 and not profiler
+            and self.width * self.height >= self.TILE_MIN_PIXELS
+        ):
+            plan = TilePlan.match(tokens)
+            if plan:
+                return self.runTiles(plan)
+
+        # Only reported when someone is listening, as it isn't free
+        if self.budget.report is not None and not profiler:
+            self.progressPlan = ProgressPlan(tokens, self.width, self.height)
+            tokens = self.progressPlan.tokens
+
+        return self.runEngine(tokens)
+    
+
+    def advance(self, done: float):
+        """Saves how much of the current stage of the pipeline is done,
+        from 0 to 1, see Budget.advance."""
+
+        self.budget.advance((self.stage + done) / self.stages)
+    
+
+    def trackLoop(self, loop: int, value):
+        "Saves how far the program is through loop, see ProgressPlan."
+
+        sizes = self.progressPlan.sizes
+        self.advance((loop + value / max(sizes[loop], 1)) / len(sizes))
+    
+
+    def snapshot(self, size: int):
+        """Returns a copy of the image as it is now, while it's being
+        filtered, shrunk so its longest side is at most size."""
+
+        img = (self.shown or self.img).convert('RGB')
+        img.thumbnail((size, size), Image.Resampling.BILINEAR)
+        return img
+    
+
+    def runEngine(self, tokens):
+        "Runs the tokens with the selected engine, as they are."
+
+        profiler = self.profiler
+
+        if self.engine == 'python' and not profiler:
+            program = Transpiler.load(tokens)
+            if program:
+                return program(self.env.vars)
+        
+        if self.engine in ('closure', 'python'):
+            return Compiler(profiler).compile(tokens)(self.env)
+        
+        self.resolver = Resolver(tokens)
+
+        # Every token evaluated goes through self.evaluate, so measuring
+        # it measures every token
+        if profiler:
+            evaluate = type(self).evaluate
+            self.evaluate = lambda token, frame : profiler.measure(
+                token, evaluate, self, token, frame
+            )
+
+        return self.evaluate(tokens, [None, self.env.vars])
+    
+
+    def runTiles(self, plan):
+        """Runs a TilePlan, splitting its outer loop into tiles that are
+        ran by the worker processes. The source and changed pixels are
+        kept in shared memory, so the image is never copied to them."""
+
+        size = self.width * self.height * 4
+        source = shared_memory.SharedMemory(create=True, size=size)
+        dest = shared_memory.SharedMemory(create=True, size=size)
+
+        # Split the outer loop into tiles of about the same size
+        length = self.width if plan.bound == 'width' else self.height
+        count = min(length, self.workers * self.TILES_PER_WORKER)
+        edges = [length * i // count for i in range(count + 1)]
+
+        # Has the flag that stops the tiles and their steps, see runTile
+        state = shared_memory.SharedMemory(create=True, size=8 * count + 8)
+
+        try:
+            # Pixels are changed in dest, while source stays the same
+            sharedImage(source, self.width, self.height).paste(self.img)
+            dest.buf[:size] = source.buf[:size]
+            state.buf[:] = bytes(state.size)
+
+            # Tiles stop themselves once what's left of the budget runs
+            # out, in case this process isn't checking. The clocks of
+            # other processes can't be compared with time.monotonic()
+            budget = self.budget
+            before = budget.steps
+            steps = None
+            if budget.maxSteps is not None:
+                steps = budget.maxSteps - before
+            deadline = None
+            if budget.deadline is not None:
+                deadline = time.time() + budget.deadline - time.monotonic()
+
+            pool = getPool(self.workers)
+            futures = [
+                pool.submit(
+                    runTile, plan.tokens, self.engine, source.name,
+                    dest.name, state.name, i, self.width, self.height,
+                    start, stop, steps, deadline
+                )
+                for i, (start, stop) in enumerate(zip(edges, edges[1:]))
+            ]
+
+            # Snapshots show the tiles as they're changed
+            self.shown = sharedImage(dest, self.width, self.height)
+
+            try:
+                pending = futures
+                while pending:
+                    done, pending = wait(
+                        pending, timeout=0.1, return_when=FIRST_EXCEPTION
+                    )
+                    if any(future.exception() for future in done):
+                        break
+                    budget.steps = before + getTileSteps(state, count)
+                    budget.check()
+                    self.advance(1 - len(pending) / len(futures))
+
+                # Throws the error of the first tile that failed, which
+                # is the error the loop would have reached first
+                for future in futures:
+                    future.result()
+            except BudgetError as error:
+                # A tile only knows its own steps and time
+                self.stopTiles(state, futures)
+                budget.steps = before + getTileSteps(state, count)
+                raise BudgetError(error.reason, budget.progress()) from None
+            except Exception:
+                self.stopTiles(state, futures)
+                raise
+            
+            self.img.paste(self.shown)
+        finally:
+            # The image has to be let go before the memory is closed
+            self.shown = None
+            source.close()
+            dest.close()
+            state.close()
+            source.unlink()
+            dest.unlink()
+            state.unlink()
+        
+        return None
+    
+
+    def stopTiles(self, state, futures):
+        """Stops the tiles of runTiles, cancelling the ones that haven't
+        started and waiting for the running ones to see the flag, so
+        nothing uses the memory once it's closed."""
+
+        state.buf[0] = 1
+        for future in futures:
+            future.cancel()
+        wait(futures)
+    
+
+    def __call__(self, *texts):
+        """When an initiated ImgFilter class is called and given code
+        to read, it will run that code. Given more than one program, they
+        are ran one after the other, see runPipeline, and only the last
+        image is saved."""
+
+        self.runPipeline([parseProgram(text) for text in texts])
+        self.img.save(f'static/images/filtered/{self.imgname}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Runs a filter on an image from static/images/source, '
+        'saving it to static/images/filtered.'
+    )
+    parser.add_argument('image', help='name of the source image')
+    parser.add_argument('program', help='file with the filter, or - to read '
+                        'it from stdin')
+    parser.add_argument('--engine', choices=ImgFilter.ENGINES,
+                        default='interpreter')
+    parser.add_argument('--profile', action='store_true',
+                        help='print where the filter spends its time')
+    parser.add_argument('--limit', type=int, default=20,
+                        help='number of tokens in the profile')
+    args = parser.parse_args()
+
+    if args.program == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.program, 'r') as file:
+            text = file.read()
+
+    img = ImgFilter(args.image, args.engine, profile=args.profile)
+    img.env['print'] = lambda x : print(x)
+
+    img(text)
+
+    if args.profile:
+        print(img.profiler.format(args.limit))
+
+        # The slowest lines, with their code
+        source = normalizeText(text).split('\n')
+        print()
+        for line in img.profiler.lines()[:5]:
+            code = source[line['line'] - 1].strip()
+            print(f'{line["percent"]:6.1f}%  line {line["line"]}: {code}')
@@ -0,0 +1,332 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import re
+import threading
+import time
+import uuid
+
+
+class QueueFullError(Exception):
+    "Raised when too many jobs are already waiting to run."
+
+
+def errorMessage(e: Exception) -> str:
+    "Returns the message of an error, without the colors for the terminal."
+
+    return re.sub(r'\033\[\d+m', '', str(e)) or type(e).__name__
+
+
+class Job:
+    """A Job is a function that is waiting to run, running, or finished
+    running in a JobQueue, along with its result or error.
+
+    The function is given the job before its args, so that while it
+    runs, it can stop once job.cancelled is set, and tell how far it
+    got with job.report. Whoever wants to know when the job changes can
+    wait for it, see waitForChange."""
+
+    # The states a job goes through
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, func, args):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.state = self.QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+        # How far the job got while it runs, or before it failed, if the
+        # error tells
+        self.progress = None
+        # A small image of what the job has done so far, and how many
+        # there have been
+        self.snapshot = None
+        self.snapshots = 0
+
+        # Counts the changes to the job, see waitForChange
+        self.version = 0
+        self.changed = threading.Condition()
+
+        # The last time someone asked about the job, see JobQueue.get
+        self.seen = self.created
+
+
+    def run(self):
+        "Runs the job, saving its result or its error."
+
+        # Cancelled before it got to run
+        if self.cancelled.is_set():
+            self.state = self.CANCELLED
+            self.finished = time.time()
+            self.notify()
+            return
+
+        self.state = self.RUNNING
+        self.started = time.time()
+        self.notify()
+
+        try:
+            self.result = self.func(self, *self.args)
+            self.state = self.DONE
+        except Exception as e:
+            # Errors from the filter are colored for the terminal
+            self.error = errorMessage(e)
+            self.progress = getattr(e, 'progress', None)
+            self.state = (
+                self.CANCELLED if self.cancelled.is_set() else self.FAILED
+            )
+        finally:
+            self.finished = time.time()
+            # Only the result is wanted now
+            self.snapshot = None
+            self.notify()
+    
+
+    def report(self, progress: dict, snapshot: bytes = None):
+        """Saves how far the running job got, and a snapshot of it if
+        there's a new one."""
+
+        with self.changed:
+            # Reports can arrive after the job is done
+            if self.finishedRunning():
+                return
+            
+            self.progress = progress
+            if snapshot is not None:
+                self.snapshot = snapshot
+                self.snapshots += 1
+            self.notify()
+    
+
+    def notify(self):
+        "Wakes up whoever is waiting for the job to change."
+
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+    
+
+    def waitForChange(self, version, timeout: float = None) -> int:
+        """Waits until the job changed since version, or for timeout
+        seconds, and returns the version it's at now."""
+
+        with self.changed:
+            self.changed.wait_for(lambda : self.version != version, timeout)
+            return self.version
+
+
+    def cancel(self):
+        "Asks the job to stop, or to never start if it hasn't yet."
+
+        self.cancelled.set()
+
+
+    def finishedRunning(self) -> bool:
+        "Returns true if the job is done, failed, or was cancelled."
+
+        return self.state in (self.DONE, self.FAILED, self.CANCELLED)
+
+
+    def toDict(self) -> dict:
+        "Returns the state of the job, to be sent as JSON."
+
+        return {
+            'id': self.id,
+            'state': self.state,
+            'error': self.error,
+            'progress': self.progress,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class Batch:
+    """A Batch is a group of jobs that were submitted together, like one
+    filter being ran on many images. It keeps its jobs, so they can be
+    found after the JobQueue forgets them."""
+
+    def __init__(self, jobs: list):
+        self.id = uuid.uuid4().hex
+        self.jobs = jobs
+        self.created = time.time()
+
+
+    def finishedRunning(self) -> bool:
+        "Returns true once every job has finished running."
+
+        return all(job.finishedRunning() for job in self.jobs)
+
+
+    def toDict(self) -> dict:
+        "Returns the state of the batch and its jobs, to be sent as JSON."
+
+        counts = {}
+        for job in self.jobs:
+            counts[job.state] = counts.get(job.state, 0) + 1
+
+        return {
+            'id': self.id,
+            'state': Job.DONE if self.finishedRunning() else Job.RUNNING,
+            'counts': counts,
+            'created': self.created,
+            'jobs': [job.toDict() for job in self.jobs],
+        }
+
+
+class JobQueue:
+    """The JobQueue runs jobs with a fixed number of threads, so that a
+    request doesn't have to wait for its job to finish. It refuses new
+    jobs once too many are waiting, and only remembers a limited number
+    of finished jobs.
+
+    Jobs that nobody has asked about for abandonAfter seconds are
+    cancelled, as whoever wanted them has likely left."""
+
+    def __init__(self, workers: int, maxQueued: int, maxJobs: int = 1000,
+                 abandonAfter: float = None):
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix='filter-job'
+        )
+        self.maxQueued = maxQueued
+        self.maxJobs = maxJobs
+        self.abandonAfter = abandonAfter
+
+        # Every remembered job by id, oldest first
+        self.jobs = OrderedDict()
+        # Every remembered batch by id, oldest first
+        self.batches = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def submit(self, func, *args) -> Job:
+        "Queues func to be called with its Job and args, returns the Job."
+
+        job = Job(func, args)
+        self.queue([job])
+        return job
+
+
+    def submitBatch(self, func, argsList: list) -> Batch:
+        """Queues func to be called once for each of the args in
+        argsList, returns the Batch of their jobs. Either every job is
+        queued, or none are."""
+
+        batch = Batch([Job(func, args) for args in argsList])
+        self.queue(batch.jobs)
+
+        with self.lock:
+            self.batches[batch.id] = batch
+            self.forget()
+
+        return batch
+
+
+    def queue(self, jobs: list):
+        "Queues the jobs, if there's room for all of them."
+
+        with self.lock:
+            self.abandon()
+
+            queued = sum(
+                1 for j in self.jobs.values() if j.state == Job.QUEUED
+            )
+            if queued + len(jobs) > self.maxQueued:
+                raise QueueFullError('Too many filters are waiting to run')
+
+            for job in jobs:
+                self.jobs[job.id] = job
+            self.forget()
+
+        for job in jobs:
+            self.executor.submit(job.run)
+
+
+    def get(self, jobId: str):
+        """Returns the job with the id, or None if there isn't one. The
+        job is then known to still be wanted."""
+
+        with self.lock:
+            job = self.jobs.get(jobId)
+            if job is not None:
+                job.seen = time.time()
+
+            self.abandon()
+            return job
+
+
+    def getBatch(self, batchId: str):
+        """Returns the batch with the id, or None if there isn't one. Its
+        jobs are then known to still be wanted."""
+
+        with self.lock:
+            batch = self.batches.get(batchId)
+            if batch is not None:
+                now = time.time()
+                for job in batch.jobs:
+                    job.seen = now
+
+            self.abandon()
+            return batch
+
+
+    def cancelBatch(self, batchId: str):
+        """Cancels every job of the batch with the id, returns it, or None
+        if there isn't one."""
+
+        with self.lock:
+            batch = self.batches.get(batchId)
+
+        if batch is not None:
+            for job in batch.jobs:
+                job.cancel()
+        return batch
+
+
+    def cancel(self, jobId: str):
+        "Cancels the job with the id, returns it, or None if there isn't one."
+
+        with self.lock:
+            job = self.jobs.get(jobId)
+
+        if job is not None:
+            job.cancel()
+        return job
+
+
+    def abandon(self):
+        """Cancels the jobs that haven't been asked about in a while.
+        Must be called while holding the lock."""
+
+        if self.abandonAfter is None:
+            return
+
+        cutoff = time.time() - self.abandonAfter
+        for job in self.jobs.values():
+            if not job.finishedRunning() and job.seen < cutoff:
+                job.cancel()
+
+
+    def forget(self):
+        """Forgets the oldest finished jobs and batches once too many are
+        remembered. Must be called while holding the lock."""
+
+        for jobId in list(self.jobs):
+            if len(self.jobs) <= self.maxJobs:
+                break
+            if self.jobs[jobId].finishedRunning():
+                del self.jobs[jobId]
+
+        for batchId in list(self.batches):
+            if len(self.batches) <= self.maxJobs:
+                break
+            if self.batches[batchId].finishedRunning():
+                del self.batches[batchId]
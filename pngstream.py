@@ -0,0 +1,324 @@
+from io import BytesIO
+from PIL import Image
+import struct
+import zlib
+
+# NumPy picks the best way to compress each row, without it the rows
+# are compressed as they are
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class PngError(Exception):
+    "Raised when a PNG can't be read or written a few rows at a time."
+
+
+def makeChunk(kind: bytes, data: bytes) -> bytes:
+    "Returns a PNG chunk, with its length and checksum."
+
+    return (
+        struct.pack('>I', len(data)) + kind + data
+        + struct.pack('>I', zlib.crc32(kind + data))
+    )
+
+
+class PngReader:
+    """The PngReader reads the rows of a PNG a few at a time, so that a
+    huge image never has to be decoded all at once.
+
+    The pixels of a PNG are compressed one row after another, and each
+    row is stored as its difference from the rows before it. The rows
+    are uncompressed here, but undoing the differences is left to
+    Pillow, by giving it a small PNG of the rows that were read, with
+    the last row read before them on top.
+
+    Only 8 bit PNGs that aren't interlaced can be read this way, any
+    other PNG raises a PngError, and has to be opened with Pillow."""
+
+    # The bytes in a pixel, by the color type of the PNG
+    CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+    # The chunks that the rows need to be decoded, like the palette
+    KEEP = (b'PLTE', b'tRNS')
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+
+        try:
+            self.readHeader()
+        except Exception:
+            self.file.close()
+            raise
+
+
+    def readHeader(self):
+        "Reads the chunks before the pixels, and checks the PNG can be read."
+
+        if self.file.read(len(SIGNATURE)) != SIGNATURE:
+            raise PngError('not a PNG')
+
+        kind, data = self.readChunk()
+        if kind != b'IHDR':
+            raise PngError('PNG must start with its header')
+
+        (
+            self.width, self.height, depth, self.colorType, compression,
+            filtering, interlace
+        ) = struct.unpack('>IIBBBBB', data)
+
+        if depth != 8 or self.colorType not in self.CHANNELS:
+            raise PngError('only 8 bit PNGs can be read in rows')
+        if interlace:
+            raise PngError('interlaced PNGs can\'t be read in rows')
+
+        self.header = data
+        self.stride = self.width * self.CHANNELS[self.colorType]
+        self.kept = b''
+
+        # Chunks are read until the pixels start
+        while True:
+            kind, data = self.readChunk()
+
+            if kind == b'IDAT':
+                break
+            if kind == b'IEND':
+                raise PngError('PNG has no pixels')
+            if kind in self.KEEP:
+                self.kept += makeChunk(kind, data)
+
+        self.decompressor = zlib.decompressobj()
+        self.compressed = data
+        self.buffer = bytearray()
+        self.done = False
+
+        # The row before the first one is all zeros
+        self.previous = bytes(self.stride)
+        self.row = 0
+
+
+    def readChunk(self) -> tuple:
+        "Reads the next chunk, returns its kind and data."
+
+        head = self.file.read(8)
+        if len(head) < 8:
+            raise PngError('PNG ends too early')
+
+        length, kind = struct.unpack('>I4s', head)
+        data = self.file.read(length)
+        crc = self.file.read(4)
+
+        if len(crc) < 4 or struct.unpack('>I', crc)[0] != zlib.crc32(
+            kind + data
+        ):
+            raise PngError(f'PNG chunk {kind!r} is broken')
+
+        return kind, data
+
+
+    def fill(self, size: int):
+        "Uncompresses rows until size bytes of them are waiting."
+
+        while len(self.buffer) < size:
+            # What the last chunk couldn't fit is uncompressed first
+            data = self.decompressor.unconsumed_tail or self.compressed
+            self.compressed = b''
+
+            if not data:
+                if self.done:
+                    return
+
+                kind, data = self.readChunk()
+                if kind == b'IEND':
+                    self.done = True
+                    continue
+                if kind != b'IDAT':
+                    continue
+
+            self.buffer += self.decompressor.decompress(
+                data, size - len(self.buffer)
+            )
+
+
+    def read(self, rows: int):
+        """Returns an image of the next rows, or None once every row has
+        been read. Fewer rows are returned at the bottom of the image."""
+
+        rows = min(rows, self.height - self.row)
+        if rows <= 0:
+            return None
+
+        # Every row starts with a byte saying how it was stored
+        size = rows * (self.stride + 1)
+        self.fill(size)
+        if len(self.buffer) < size:
+            raise PngError('PNG ends too early')
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        # The last row read is stored as it is, so the first new row can
+        # be decoded from it
+        png = b''.join((
+            SIGNATURE,
+            makeChunk(
+                b'IHDR',
+                struct.pack('>I', self.width) + struct.pack('>I', rows + 1)
+                + self.header[8:]
+            ),
+            self.kept,
+            makeChunk(
+                b'IDAT', zlib.compress(b'\0' + self.previous + data, 0)
+            ),
+            makeChunk(b'IEND', b''),
+        ))
+
+        with Image.open(BytesIO(png)) as img:
+            img.load()
+            strip = img.crop((0, 1, self.width, rows + 1))
+            self.previous = img.crop(
+                (0, rows, self.width, rows + 1)
+            ).tobytes()
+
+        # Pillow changed how the pixels are stored
+        if len(self.previous) != self.stride:
+            raise PngError(f'PNG can\'t be read in rows as {strip.mode}')
+
+        self.row += rows
+        return strip
+
+
+    def strips(self, rows: int):
+        "Yields images of the rows that are left, rows at a time."
+
+        while True:
+            strip = self.read(rows)
+            if strip is None:
+                return
+            yield strip
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PngWriter:
+    """The PngWriter writes an RGB PNG a few rows at a time, so a huge
+    image never has to be kept in memory all at once. Like Pillow, each
+    row is stored in whichever way should compress best, see filter."""
+
+    def __init__(self, file, width: int, height: int, level: int = 6):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.stride = width * 3
+        self.compressor = zlib.compressobj(level)
+        self.previous = bytes(self.stride)
+        self.rows = 0
+
+        file.write(SIGNATURE)
+        file.write(makeChunk(
+            b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+        ))
+
+
+    def write(self, img):
+        "Writes the rows of img, which must be as wide as the PNG."
+
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if img.size[0] != self.width:
+            raise PngError('rows must be as wide as the PNG')
+
+        rows = img.size[1]
+        if self.rows + rows > self.height:
+            raise PngError('PNG has too many rows')
+
+        data = img.tobytes()
+        self.writeData(self.compressor.compress(self.filter(data, rows)))
+
+        self.previous = data[-self.stride:] if rows else self.previous
+        self.rows += rows
+
+
+    def writeData(self, data: bytes):
+        "Writes compressed rows, if there are any yet."
+
+        if data:
+            self.file.write(makeChunk(b'IDAT', data))
+
+
+    def filter(self, data: bytes, rows: int) -> bytes:
+        """Returns the rows stored as differences from the pixels before
+        them, picking for every row the way that leaves the smallest
+        differences, which compress best."""
+
+        if np is None:
+            return b''.join(
+                b'\0' + data[i:i + self.stride]
+                for i in range(0, len(data), self.stride)
+            )
+
+        row = np.frombuffer(data, np.uint8).reshape(rows, self.stride)
+        row = row.astype(np.int16)
+        up = np.vstack((
+            np.frombuffer(self.previous, np.uint8).reshape(1, -1), row[:-1]
+        )).astype(np.int16)
+
+        # The pixel to the left, and the one above it
+        left = np.zeros_like(row)
+        left[:, 3:] = row[:, :-3]
+        upLeft = np.zeros_like(row)
+        upLeft[:, 3:] = up[:, :-3]
+
+        # The Paeth filter guesses whichever is closest to left + up - upLeft
+        guess = left + up - upLeft
+        nearLeft = np.abs(guess - left)
+        nearUp = np.abs(guess - up)
+        nearUpLeft = np.abs(guess - upLeft)
+        paeth = np.where(
+            (nearLeft <= nearUp) & (nearLeft <= nearUpLeft), left,
+            np.where(nearUp <= nearUpLeft, up, upLeft)
+        )
+
+        out = np.empty((rows, self.stride + 1), np.uint8)
+        best = None
+
+        # In the order of the PNG's filter types, each one is only kept
+        # for the rows it leaves the smallest differences in, counting
+        # bytes over 127 as negative
+        guesses = (0, left, up, (left + up) // 2, paeth)
+        for kind, guess in enumerate(guesses):
+            filtered = (row - guess).astype(np.uint8)
+            cost = np.abs(filtered.view(np.int8).astype(np.int16)).sum(
+                axis=1, dtype=np.int64
+            )
+
+            better = slice(None) if best is None else cost < best
+            best = cost if best is None else np.minimum(best, cost)
+            out[better, 0] = kind
+            out[better, 1:] = filtered[better]
+
+        return out.tobytes()
+
+
+    def close(self):
+        "Writes the last of the rows, which must all have been written."
+
+        if self.rows != self.height:
+            raise PngError(f'PNG has {self.rows} of {self.height} rows')
+
+        self.writeData(self.compressor.flush())
+        self.file.write(makeChunk(b'IEND', b''))
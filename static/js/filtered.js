@@ -171,6 +171,13 @@ for (x = 0; x < width; x = x + 1)
     };
 };`;
 
+const FAST_SOBEL = `# gradient() applies a kernel and the same kernel flipped over its
+# diagonal to every pixel at once, and combines them like the loops above
+gradient(edgeZero, false,
+    0 - 1, 0, 1,
+    0 - 2, 0, 2,
+    0 - 1, 0, 1);`;
+
 function grayscale() {
     editor.getDoc().setValue(GRAYSCALE);
 }
@@ -183,4 +190,9 @@ function sepia() {
 
 function sobel() {
     editor.getDoc().setValue(SOBEL);
-}
\ No newline at end of file
+}
+
+
+function fastSobel() {
+    editor.getDoc().setValue(FAST_SOBEL);
+}
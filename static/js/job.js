@@ -0,0 +1,146 @@
+const status = document.getElementById('job-status');
+const result = document.getElementById('job-result');
+const debug = document.getElementById('job-debug');
+const render = document.getElementById('job-render');
+
+// how often to ask whether the filter is finished, in milliseconds,
+// when the browser can't be told instead
+const POLL_INTERVAL = 1000;
+
+// the longest side of the shown image
+const MAX_SIZE = 750;
+
+// whether the filter is still queued or running
+let waiting = true;
+
+
+function showResult(job) {
+    result.onload = null;
+    const factor = MAX_SIZE / Math.max(job.width, job.height);
+
+    result.src = job.result;
+    result.width = job.width * factor;
+    result.height = job.height * factor;
+    result.hidden = false;
+    status.hidden = true;
+
+    // previews can be filtered again at full resolution
+    render.hidden = !job.preview;
+
+    // where the filter spent its time, if it was profiled
+    if (job.debug) {
+        debug.textContent = job.debug.profile.text;
+        debug.hidden = false;
+    }
+}
+
+
+// snapshots are small, so they're stretched to the size of the result
+function showSnapshot(url) {
+    result.onload = () => {
+        const factor = MAX_SIZE / Math.max(
+            result.naturalWidth, result.naturalHeight
+        );
+        result.width = result.naturalWidth * factor;
+        result.height = result.naturalHeight * factor;
+        result.hidden = false;
+    };
+    result.src = url;
+}
+
+
+function describeProgress(progress) {
+    let text = `Filtering... ${Math.floor(progress.percent)}%`;
+
+    if (progress.pixelsPerSecond) {
+        const rate = progress.pixelsPerSecond >= 1e6
+            ? `${(progress.pixelsPerSecond / 1e6).toFixed(1)}M`
+            : `${Math.round(progress.pixelsPerSecond / 1e3)}K`;
+        text += `, ${rate} pixels a second`;
+    }
+    if (progress.eta !== null && progress.eta !== undefined) {
+        text += `, about ${Math.ceil(progress.eta)} seconds left`;
+    }
+
+    return text;
+}
+
+
+// shows the state of the job, returns whether it's still queued or running
+function showJob(job) {
+    waiting = !['done', 'failed', 'cancelled'].includes(job.state);
+
+    if (job.state === 'done') {
+        showResult(job);
+    } else if (job.state === 'failed') {
+        status.textContent = `The filter failed: ${job.error}`;
+    } else if (job.state === 'cancelled') {
+        status.textContent = 'The filter was cancelled.';
+    } else if (job.state === 'queued') {
+        status.textContent = 'Waiting to filter...';
+    } else if (job.progress && job.progress.percent !== undefined) {
+        status.textContent = describeProgress(job.progress);
+    } else {
+        status.textContent = 'Filtering...';
+    }
+
+    return waiting;
+}
+
+
+async function poll() {
+    const response = await fetch(status.dataset.url);
+
+    if (!response.ok) {
+        status.textContent = 'This filter could not be found.';
+        return;
+    }
+
+    if (showJob(await response.json())) {
+        setTimeout(poll, POLL_INTERVAL);
+    }
+}
+
+
+// the server sends the progress of the filter as it runs, along with
+// snapshots of the image so far
+function listen() {
+    const events = new EventSource(status.dataset.events);
+
+    events.addEventListener('progress', (event) => {
+        const job = JSON.parse(event.data);
+        showJob(job);
+
+        if (job.snapshot && job.snapshot !== result.getAttribute('src')) {
+            showSnapshot(job.snapshot);
+        }
+    });
+
+    events.addEventListener('done', (event) => {
+        events.close();
+        showJob(JSON.parse(event.data));
+    });
+
+    // the stream broke, or was never there, so ask instead
+    events.onerror = () => {
+        events.close();
+        if (waiting) {
+            poll();
+        }
+    };
+}
+
+
+// nobody will see the result once the page is left, so stop the filter
+window.addEventListener('pagehide', () => {
+    if (waiting) {
+        navigator.sendBeacon(status.dataset.cancel);
+    }
+});
+
+
+if (window.EventSource) {
+    listen();
+} else {
+    poll();
+}
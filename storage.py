@@ -0,0 +1,656 @@
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image, ImageOps
+from pngstream import PngError, PngReader
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+
+# How many pixels of an image are hashed at a time
+HASH_PIXELS = 1 << 20
+
+
+def hashImage(path: str) -> str:
+    """Returns a hash of the pixels of an image, so that the same image
+    saved twice has the same hash. PNGs are read a few rows at a time
+    when possible, so huge images can be hashed too."""
+
+    try:
+        reader = PngReader(path)
+    except PngError:
+        reader = None
+
+    if reader is not None:
+        with reader:
+            # The size is included, as different sizes can share pixel
+            # bytes
+            size = (reader.width, reader.height)
+            digest = hashlib.sha256(f'{size}'.encode())
+
+            rows = max(1, HASH_PIXELS // max(reader.width, 1))
+            for strip in reader.strips(rows):
+                digest.update(strip.convert('RGB').tobytes())
+
+        return digest.hexdigest()
+
+    with Image.open(path) as img:
+        img = upright(img)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        digest = hashlib.sha256(f'{img.size}'.encode())
+        digest.update(img.tobytes())
+
+    return digest.hexdigest()
+
+
+# The EXIF tag that tells which way up a photo is, and its values that
+# turn the photo on its side
+ORIENTATION = 0x0112
+SIDEWAYS = (5, 6, 7, 8)
+
+
+def orientation(img: Image.Image) -> int:
+    """Returns the EXIF orientation of an opened image, 1 if it's already
+    upright. Phones save photos the way the camera was held and only
+    mark which way is up, which browsers follow when they show them.
+    Only JPEGs and WebPs are turned, as PNGs can be read a strip at a
+    time by PngReader, which doesn't know about it."""
+
+    if img.format not in ('JPEG', 'WEBP'):
+        return 1
+    return img.getexif().get(ORIENTATION, 1)
+
+
+def uprightSize(img: Image.Image) -> tuple:
+    "Returns the size of an opened image once it's turned upright."
+
+    if orientation(img) in SIDEWAYS:
+        return img.size[::-1]
+    return img.size
+
+
+def upright(img: Image.Image) -> Image.Image:
+    "Returns an opened image turned upright, see orientation."
+
+    if orientation(img) == 1:
+        return img
+    return ImageOps.exif_transpose(img)
+
+
+# The formats images can be uploaded as, and the extension they're saved
+# with
+UPLOAD_FORMATS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+
+
+class UploadError(Exception):
+    "Raised when an upload isn't an image that can be filtered."
+
+
+def saveUpload(stream, folder: str) -> str:
+    """Saves an uploaded image to folder, named by the hash of its bytes,
+    which are hashed as they're read from stream, and returns its name.
+    The same image uploaded again is only saved once, and images with
+    the same name never replace each other. Raises an UploadError if it
+    isn't a PNG, JPEG or WebP."""
+
+    digest = hashlib.sha256()
+    handle, temp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            while True:
+                chunk = stream.read(1 << 16)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                file.write(chunk)
+
+        # Only the header is read, to tell what the image really is
+        try:
+            with Image.open(temp) as img:
+                format = img.format
+        except OSError:
+            raise UploadError('Must be a PNG, JPEG or WebP image.')
+
+        if format not in UPLOAD_FORMATS:
+            raise UploadError('Must be a PNG, JPEG or WebP image.')
+
+        name = f'{digest.hexdigest()}.{UPLOAD_FORMATS[format]}'
+        path = os.path.join(folder, name)
+
+        # Already uploaded, so it's kept as it is
+        if not os.path.exists(path):
+            os.replace(temp, path)
+
+        return name
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+class Encoding:
+    """An Encoding is how a result is saved: its format, and a number
+    trading how fast it's saved for how big it is. For PNGs the number
+    is how hard it's compressed, from 0 to 9, where 9 is the smallest
+    and slowest. For JPEG and WebP it's the quality, from 1 to 100,
+    where lower numbers are smaller but lose more detail."""
+
+    # Pillow's name for each format, its mime type and file extension
+    FORMATS = {
+        'png': ('PNG', 'image/png', 'png'),
+        'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+        'webp': ('WEBP', 'image/webp', 'webp'),
+    }
+
+    # The lowest, highest and default numbers for each format. PNGs are
+    # compressed as hard as Pillow does by default
+    LEVELS = {
+        'png': (0, 9, 6),
+        'jpeg': (1, 100, 85),
+        'webp': (1, 100, 80),
+    }
+
+    def __init__(self, format: str = 'png', level: int = None):
+        if format not in self.FORMATS:
+            raise ValueError(f'Unknown format {format}')
+
+        low, high, default = self.LEVELS[format]
+        if level is None:
+            level = default
+        if not low <= level <= high:
+            raise ValueError(
+                f'{format} must be saved with a number from {low} to {high}'
+            )
+
+        self.format = format
+        self.level = level
+
+
+    @property
+    def mimetype(self) -> str:
+        return self.FORMATS[self.format][1]
+
+
+    @property
+    def extension(self) -> str:
+        return self.FORMATS[self.format][2]
+
+
+    @property
+    def variant(self) -> str:
+        """Returns what keeps results saved this way apart from others,
+        see ResultCache.key. Default PNGs have none, as every result was
+        saved that way before there were other encodings."""
+
+        if self.format == 'png' and self.level == self.LEVELS['png'][2]:
+            return ''
+        return f'{self.format}{self.level}'
+
+
+    def options(self) -> dict:
+        "Returns the options Pillow saves the image with."
+
+        if self.format == 'png':
+            return {'compress_level': self.level}
+        return {'quality': self.level}
+
+
+    def encode(self, img: Image.Image) -> bytes:
+        "Returns the image saved in memory."
+
+        buffer = BytesIO()
+        img.save(buffer, self.FORMATS[self.format][0], **self.options())
+        return buffer.getvalue()
+
+
+    @classmethod
+    def mimetypeOf(cls, name: str) -> str:
+        "Returns the mime type of a file saved by an Encoding."
+
+        extension = name.rsplit('.', 1)[-1]
+        for _, mimetype, known in cls.FORMATS.values():
+            if extension == known:
+                return mimetype
+
+        return 'application/octet-stream'
+
+
+class ResultCache:
+    """The ResultCache keeps filtered images on disk, by the pixels of
+    the source image and the program that filtered them. Running the
+    same program on the same image again can just use the saved image.
+
+    The cache stays under a budget of bytes on disk, removing the least
+    recently used images first. The most recently saved images are also
+    kept in memory, up to memoryBytes, so they can be sent without
+    reading them from disk."""
+
+    # The extensions of the files saved by each Encoding
+    EXTENSIONS = tuple(
+        f'.{extension}' for _, _, extension in Encoding.FORMATS.values()
+    )
+
+    def __init__(self, folder: str, maxBytes: int, memoryBytes: int = 0):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.memoryBytes = memoryBytes
+
+        # The size of each saved image, least recently used first
+        self.entries = OrderedDict()
+        self.total = 0
+        # The encoded images kept in memory, least recently used first
+        self.memory = OrderedDict()
+        self.memoryTotal = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(folder, exist_ok=True)
+        self.scan()
+
+
+    def scan(self):
+        """Finds images saved by earlier runs of the app, using the time
+        they were last used to order them."""
+
+        files = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(self.EXTENSIONS):
+                continue
+            stat = os.stat(os.path.join(self.folder, name))
+            files.append((stat.st_mtime, name, stat.st_size))
+
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total += size
+
+        with self.lock:
+            self.evict()
+
+
+    def key(self, imageHash: str, programHash: str, variant: str = '',
+            extension: str = 'png') -> str:
+        """Returns the key of an image filtered by a program, which is
+        also the name of the file it's saved to, so it ends with the
+        extension of its Encoding. Results that are made differently,
+        like previews, are kept apart by variant."""
+
+        text = f'{imageHash}:{programHash}'
+        if variant:
+            text += f':{variant}'
+
+        return f'{hashlib.sha256(text.encode()).hexdigest()}.{extension}'
+
+
+    def filename(self, key: str) -> str:
+        "Returns the name of the file that the result is saved to."
+
+        return key
+
+
+    def path(self, key: str) -> str:
+        "Returns the path of the file that the result is saved to."
+
+        return os.path.join(self.folder, self.filename(key))
+
+
+    def get(self, key: str):
+        "Returns the path of the saved result, or None if not saved."
+
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        path = self.path(key)
+
+        # Mark the file as used, so it is ordered right after a restart
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Removed from outside of the cache
+            with self.lock:
+                self.total -= self.entries.pop(key, 0)
+                self.forgetData(key)
+            return None
+
+        return path
+
+
+    def read(self, key: str):
+        """Returns the saved result if it's kept in memory, or None if it
+        has to be read from disk, see get."""
+
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+            return data
+
+
+    def temp(self, key: str) -> str:
+        """Returns the path of a file the result can be written to before
+        it's saved, so that it's never seen half written."""
+
+        return f'{self.path(key)}.{threading.get_ident()}.tmp'
+
+
+    def put(self, key: str, source: str) -> str:
+        "Saves a copy of the file source as a result, returns its path."
+
+        path = self.path(key)
+
+        temp = self.temp(key)
+        shutil.copyfile(source, temp)
+        os.replace(temp, path)
+
+        return self.add(key, path)
+
+
+    def move(self, key: str, source: str) -> str:
+        """Saves the file source as a result by moving it, returns its
+        path. source has to be in the same folder, see temp."""
+
+        path = self.path(key)
+        os.replace(source, path)
+        self.add(key, path)
+
+        # Small results are kept in memory, like saved ones are
+        if os.path.getsize(path) <= self.memoryBytes:
+            with open(path, 'rb') as file:
+                data = file.read()
+            with self.lock:
+                self.remember(key, data)
+
+        return path
+
+
+    def save(self, key: str, img: Image.Image,
+             encoding: Encoding = None) -> str:
+        """Saves an image as a result, encoded in memory with encoding,
+        which is a default PNG if not given. Returns its path."""
+
+        data = (encoding or Encoding()).encode(img)
+        path = self.write(key, lambda file : file.write(data))
+
+        with self.lock:
+            self.remember(key, data)
+
+        return path
+
+
+    def write(self, key: str, write) -> str:
+        """Saves a result by calling write with the file to write it to,
+        returns its path. Nothing is saved if write raises an error."""
+
+        path = self.path(key)
+
+        temp = self.temp(key)
+        try:
+            with open(temp, 'wb') as file:
+                write(file)
+        except BaseException:
+            os.remove(temp)
+            raise
+        os.replace(temp, path)
+
+        return self.add(key, path)
+
+
+    def add(self, key: str, path: str) -> str:
+        "Counts a newly saved result, removing old ones if over budget."
+
+        size = os.path.getsize(path)
+
+        with self.lock:
+            self.total += size - self.entries.get(key, 0)
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+            self.forgetData(key)
+            self.evict()
+
+        return path
+
+
+    def evict(self):
+        """Removes the least recently used results until the cache is
+        under budget, always keeping the newest one. Must be called
+        while holding the lock."""
+
+        while self.total > self.maxBytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total -= size
+            self.forgetData(key)
+
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+
+    def remember(self, key: str, data: bytes):
+        """Keeps a saved result in memory, forgetting the least recently
+        used ones once over budget. Must be called while holding the
+        lock."""
+
+        if key not in self.entries or len(data) > self.memoryBytes:
+            return
+
+        self.forgetData(key)
+        self.memory[key] = data
+        self.memoryTotal += len(data)
+
+        while self.memoryTotal > self.memoryBytes:
+            _, old = self.memory.popitem(last=False)
+            self.memoryTotal -= len(old)
+
+
+    def forgetData(self, key: str):
+        """Forgets the result kept in memory, if it is. Must be called
+        while holding the lock."""
+
+        data = self.memory.pop(key, None)
+        if data is not None:
+            self.memoryTotal -= len(data)
+
+
+    def stats(self) -> dict:
+        "Returns the number of results, their size and hit counts."
+
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'bytes': self.total,
+                'maxBytes': self.maxBytes,
+                'memoryBytes': self.memoryTotal,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class SourceCache:
+    """The SourceCache keeps what is known about source images in
+    memory, by their path: their size, their hash, and their pixels once
+    they've been decoded. Filtering the same image again then doesn't
+    have to open it at all, and its size is known without decoding it.
+
+    Everything known about an image is forgotten once its file changes,
+    which is told by its modification time and size. The decoded images
+    stay under a budget of bytes, dropping the least recently used
+    first, and images bigger than the whole budget are never kept.
+
+    When only a smaller copy of a JPEG is needed, like for a preview, it
+    is decoded at a half, a quarter or an eighth of its size, which is
+    much faster, and kept apart from the full image.
+
+    The images are shared by everyone who asks for them, so nothing is
+    allowed to change them, see ImgFilter.fromImage."""
+
+    def __init__(self, maxBytes: int, maxEntries: int = 1024):
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+
+        # What is known about each image, least recently used first
+        self.entries = OrderedDict()
+        # The bytes of the decoded images
+        self.total = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def stamp(self, path: str) -> tuple:
+        "Returns what changes about a file when it's written again."
+
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+    def entry(self, path: str) -> dict:
+        """Returns what is known about the image, forgetting it first if
+        the file has changed."""
+
+        stamp = self.stamp(path)
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry['stamp'] != stamp:
+                self.drop(path)
+                entry = None
+
+            if entry is None:
+                entry = {'stamp': stamp, 'size': None, 'hash': None,
+                         'images': {}, 'bytes': 0}
+                self.entries[path] = entry
+
+            self.entries.move_to_end(path)
+            self.evict()
+            return entry
+
+
+    def size(self, path: str) -> tuple:
+        "Returns the width and height of the image, without decoding it."
+
+        entry = self.entry(path)
+        if entry['size'] is None:
+            # Only the header is read until the pixels are loaded
+            with Image.open(path) as img:
+                entry['size'] = uprightSize(img)
+
+        return entry['size']
+
+
+    def hash(self, path: str) -> str:
+        "Returns the hash of the image's pixels, see hashImage."
+
+        entry = self.entry(path)
+        if entry['hash'] is None:
+            entry['hash'] = hashImage(path)
+
+        return entry['hash']
+
+
+    def image(self, path: str, size: int = None) -> Image.Image:
+        """Returns the image decoded as RGB, which must not be changed.
+        With size, the image can be smaller than the file, as long as
+        it's at least size pixels across and down, see draft."""
+
+        entry = self.entry(path)
+
+        with self.lock:
+            # The full image will do for any size
+            img = entry['images'].get(None)
+            if img is None:
+                img = entry['images'].get(size)
+            if img is not None:
+                self.hits += 1
+                return img
+            self.misses += 1
+
+        with Image.open(path) as img:
+            entry['size'] = uprightSize(img)
+            full = img.size
+
+            if size is not None:
+                # Only JPEGs can be decoded smaller, others ignore this
+                img.draft('RGB', (size, size))
+                if img.size == full:
+                    size = None
+
+            img = upright(img).convert('RGB')
+
+        # Pillow keeps 4 bytes for every RGB pixel
+        count = img.size[0] * img.size[1] * 4
+
+        with self.lock:
+            # The file could have changed while it was decoded
+            if count <= self.maxBytes and self.entries.get(path) is entry \
+                    and size not in entry['images']:
+                # Smaller copies aren't needed once there's a full one
+                if size is None:
+                    entry['images'] = {}
+                    self.total -= entry['bytes']
+                    entry['bytes'] = 0
+
+                entry['images'][size] = img
+                entry['bytes'] += count
+                self.total += count
+                self.evict()
+
+        return img
+
+
+    def forget(self, path: str):
+        "Forgets everything about the image, like when it's replaced."
+
+        with self.lock:
+            self.drop(path)
+
+
+    def drop(self, path: str):
+        "Forgets the image. Must be called while holding the lock."
+
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.total -= entry['bytes']
+
+
+    def evict(self):
+        """Drops the least recently used images until the cache is under
+        budget, and forgets the least recently used entries once there
+        are too many. Must be called while holding the lock."""
+
+        for entry in self.entries.values():
+            if self.total <= self.maxBytes:
+                break
+
+            entry['images'] = {}
+            self.total -= entry['bytes']
+            entry['bytes'] = 0
+
+        while len(self.entries) > self.maxEntries:
+            _, entry = self.entries.popitem(last=False)
+            self.total -= entry['bytes']
+
+
+    def stats(self) -> dict:
+        "Returns the number of images, their size and hit counts."
+
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'images': sum(
+                    len(entry['images']) for entry in self.entries.values()
+                ),
+                'bytes': self.total,
+                'maxBytes': self.maxBytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
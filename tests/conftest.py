@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The tests import the modules at the top of the repository, which read
+# files like the presets relative to it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
@@ -0,0 +1,25 @@
+from PIL import Image
+from imgfilter import ImgFilter, parseProgram
+
+
+def makeImage(width: int = 24, height: int = 16) -> Image.Image:
+    "Returns a small image with a different color at every pixel."
+
+    img = Image.new('RGB', (width, height))
+    img.putdata([
+        (x * 10 % 256, y * 15 % 256, (x * y + 7) % 256)
+        for y in range(height) for x in range(width)
+    ])
+    return img
+
+
+def runFilter(code: str, engine: str, **options):
+    """Runs code on the small image, returns its pixels, or the type of
+    the error it threw."""
+
+    imgFilter = ImgFilter.fromImage(makeImage(), engine, **options)
+    try:
+        imgFilter.run(parseProgram(code))
+    except Exception as e:
+        return type(e)
+    return imgFilter.img.tobytes()
@@ -0,0 +1,102 @@
+from imgfilter import (
+    PARSE_CACHE, LRUCache, Parser, hashProgram, loadPresets, parseProgram
+)
+import pytest
+import threading
+
+
+def test_forgets_least_recently_used():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+
+    # b is the least recently used now
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_counts_hits_and_misses():
+    cache = LRUCache(4)
+    cache.put('a', 1)
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+
+    assert cache.stats() == {
+        'size': 1, 'maxSize': 4, 'hits': 2, 'misses': 1
+    }
+
+    cache.clear()
+    assert cache.stats() == {
+        'size': 0, 'maxSize': 4, 'hits': 0, 'misses': 0
+    }
+
+
+def test_get_or_create_keeps_none():
+    cache = LRUCache(4)
+    calls = []
+
+    def create():
+        calls.append(1)
+        return None
+
+    assert cache.getOrCreate('a', create) is None
+    assert cache.getOrCreate('a', create) is None
+    assert len(calls) == 1
+
+
+def test_threads_share_the_cache():
+    cache = LRUCache(8)
+    errors = []
+
+    def work(n):
+        try:
+            for i in range(2000):
+                key = (n + i) % 16
+                assert cache.getOrCreate(key, lambda : key * 2) == key * 2
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert errors == []
+    assert len(cache) == 8
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 8 * 2000
+
+
+@pytest.mark.parametrize('name', sorted(loadPresets()))
+def test_cached_tokens_match_parser(name):
+    text = loadPresets()[name]
+    PARSE_CACHE.clear()
+
+    tokens = parseProgram(text)
+    assert hashProgram(tokens) == hashProgram(Parser(text).tokens)
+    assert parseProgram(text) is tokens
+    assert PARSE_CACHE.stats()['hits'] == 1
+
+
+def test_same_code_is_parsed_once():
+    PARSE_CACHE.clear()
+    tokens = parseProgram('x = 1;\ny = 2;')
+
+    # Line endings and trailing whitespace don't change the program
+    assert parseProgram('x = 1;  \r\ny = 2;\r\n\n') is tokens
+    assert parseProgram('x = 1;\ny = 3;') is not tokens
+    assert len(PARSE_CACHE) == 2
+
+
+def test_errors_arent_cached():
+    PARSE_CACHE.clear()
+    for _ in range(2):
+        with pytest.raises(SyntaxError):
+            parseProgram('x = ;')
+    assert len(PARSE_CACHE) == 0
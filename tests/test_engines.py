@@ -0,0 +1,105 @@
+from helpers import runFilter
+from imgfilter import (
+    ImgFilter, StripPlan, TilePlan, loadPresets, parseProgram
+)
+import pytest
+
+
+PRESETS = loadPresets()
+
+ENGINES = ImgFilter.ENGINES
+
+
+# Programs that every engine has to run the same, or fail the same
+PROGRAMS = [
+    'v = 1 + 2 * 3 - 4; pixels[0, 0] = rgb(v, v, v);',
+    'v = 7 // 2 + 7 % 3 + 7 / 2; pixels[0, 0] = rgb(v, v, v);',
+    'v = -7 // 2 + -7 % 3; pixels[0, 0] = rgb(v, 0, 0);',
+    'v = (false || 3) + 1; pixels[0, 0] = rgb(v, v, v);',
+    'v = 1 < 2 && 3; pixels[0, 0] = rgb(v, v, v);',
+    'v = sqrt(width * height); pixels[0, 0] = rgb(v, v, v);',
+    'loadColor(1, 1); v = r + g + b; pixels[0, 0] = rgb(v, v, v);',
+    'v = true + 1; pixels[0, 0] = rgb(v, v, v);',
+    'v = 1 - false; pixels[0, 0] = rgb(v, v, v);',
+    'v = true < 2; pixels[0, 0] = rgb(0, 0, 0);',
+    'v = rgb(1, 2, 3) + 1;',
+    'v = 1 / 0;',
+    'v = 7 % 0;',
+    'v = 1.0 // 0;',
+    'v = sqrt(-1);',
+    'v = 0; w = 5 / v;',
+    'v = true; w = v * 2;',
+    'v = 1; v = false; w = v + 1;',
+]
+
+
+@pytest.mark.parametrize('code', PROGRAMS)
+def test_engines_agree(code):
+    results = [runFilter(code, engine) for engine in ENGINES]
+    assert results[1:] == results[:1] * (len(ENGINES) - 1)
+
+
+@pytest.mark.parametrize('code', PROGRAMS[7:11])
+def test_booleans_arent_numbers(code):
+    for engine in ENGINES:
+        assert runFilter(code, engine) is TypeError
+
+
+@pytest.mark.parametrize('name', sorted(PRESETS))
+def test_presets_agree(name):
+    results = [
+        runFilter(PRESETS[name], engine, vectorize=False)
+        for engine in ENGINES
+    ]
+    assert isinstance(results[0], bytes)
+    assert results[1:] == results[:1] * (len(ENGINES) - 1)
+
+
+@pytest.mark.parametrize('name', sorted(PRESETS))
+def test_vectorized_presets_agree(name):
+    expected = runFilter(PRESETS[name], 'interpreter', vectorize=False)
+    assert runFilter(PRESETS[name], 'interpreter', vectorize=True) == expected
+
+
+def test_vectorizer_overflow_falls_back():
+    code = '''
+    for (x = 0; x < width; x = x + 1) {
+        for (y = 0; y < height; y = y + 1) {
+            loadColor(x, y);
+            v = r + 4611686018427387904;
+            v = v + 4611686018427387904;
+            v = v * 1099511627776;
+            w = v % 255;
+            pixels[x, y] = rgb(w, g, b);
+        };
+    };'''
+    expected = runFilter(code, 'interpreter', vectorize=False)
+    assert runFilter(code, 'interpreter', vectorize=True) == expected
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_vectorizer_falls_back_for_if_expressions(engine):
+    code = '''
+    for (x = 0; x < width; x = x + 1) {
+        for (y = 0; y < height; y = y + 1) {
+            loadColor(x, y);
+            v = if (r > 100) 255 else 0;
+            pixels[x, y] = rgb(v, v, v);
+        };
+    };'''
+    expected = runFilter(code, 'interpreter', vectorize=False)
+    assert isinstance(expected, bytes)
+    assert runFilter(code, engine, vectorize=True) == expected
+
+
+@pytest.mark.parametrize('plan', [TilePlan, StripPlan])
+def test_plans_refuse_lambdas_with_if_expressions(plan):
+    code = '''
+    for (x = 0; x < width; x = x + 1) {
+        for (y = 0; y < height; y = y + 1) {
+            loadColor(x, y);
+            f = lambda (a) if (a > 100) 255 else 0;
+            pixels[x, y] = rgb(f(r), g, b);
+        };
+    };'''
+    assert plan.match(parseProgram(code)) is None
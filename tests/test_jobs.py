@@ -0,0 +1,167 @@
+from jobs import Job, JobQueue, QueueFullError
+import pytest
+import threading
+import time
+
+
+def waitUntilFinished(job: Job, timeout: float = 5) -> str:
+    "Waits for the job to finish running, and returns its state."
+
+    deadline = time.monotonic() + timeout
+    version = job.version
+    while not job.finishedRunning():
+        left = deadline - time.monotonic()
+        assert left > 0, f'job is still {job.state}'
+        version = job.waitForChange(version, left)
+    return job.state
+
+
+def waitUntilRunning(job: Job, timeout: float = 5):
+    "Waits for the job to start running."
+
+    deadline = time.monotonic() + timeout
+    version = job.version
+    while job.state == Job.QUEUED:
+        left = deadline - time.monotonic()
+        assert left > 0, 'job never started'
+        version = job.waitForChange(version, left)
+
+
+def blocked(job, release: threading.Event):
+    "Runs until release is set."
+
+    release.wait(5)
+    return 'released'
+
+
+def untilCancelled(job):
+    "Runs until the job is cancelled, like a filter with a Budget does."
+
+    if not job.cancelled.wait(5):
+        return 'never cancelled'
+    raise RuntimeError('it was cancelled')
+
+
+def test_job_finishes():
+    queue = JobQueue(1, 4)
+    release = threading.Event()
+    release.set()
+
+    job = queue.submit(blocked, release)
+    assert waitUntilFinished(job) == Job.DONE
+    assert job.result == 'released'
+    assert queue.get(job.id) is job
+
+
+def test_job_fails_with_its_error():
+    queue = JobQueue(1, 4)
+    job = queue.submit(lambda job : 1 / 0)
+
+    assert waitUntilFinished(job) == Job.FAILED
+    assert job.error == 'division by zero'
+
+
+def test_cancel_running_job():
+    queue = JobQueue(1, 4)
+    job = queue.submit(untilCancelled)
+    waitUntilRunning(job)
+
+    assert queue.cancel(job.id) is job
+    assert waitUntilFinished(job) == Job.CANCELLED
+    assert job.error == 'it was cancelled'
+
+
+def test_cancel_queued_job_never_runs():
+    queue = JobQueue(1, 4)
+    release = threading.Event()
+    ran = []
+
+    first = queue.submit(blocked, release)
+    second = queue.submit(lambda job : ran.append(job))
+    waitUntilRunning(first)
+
+    queue.cancel(second.id)
+    release.set()
+
+    assert waitUntilFinished(first) == Job.DONE
+    assert waitUntilFinished(second) == Job.CANCELLED
+    assert ran == []
+
+
+def test_cancel_unknown_job():
+    assert JobQueue(1, 4).cancel('nope') is None
+
+
+def test_abandoned_jobs_are_cancelled():
+    queue = JobQueue(2, 4, abandonAfter=0.2)
+    wanted = queue.submit(untilCancelled)
+    abandoned = queue.submit(untilCancelled)
+
+    # Asking about a job keeps it going, the other is left alone
+    deadline = time.monotonic() + 0.6
+    while time.monotonic() < deadline:
+        assert queue.get(wanted.id) is wanted
+        time.sleep(0.05)
+
+    assert waitUntilFinished(abandoned) == Job.CANCELLED
+    assert not wanted.finishedRunning()
+
+    queue.cancel(wanted.id)
+    assert waitUntilFinished(wanted) == Job.CANCELLED
+
+
+def test_finished_jobs_arent_abandoned():
+    queue = JobQueue(1, 4, abandonAfter=0.05)
+    job = queue.submit(lambda job : 'done')
+
+    assert waitUntilFinished(job) == Job.DONE
+    time.sleep(0.1)
+    queue.get(job.id)
+    assert job.state == Job.DONE
+
+
+def test_queue_refuses_jobs_once_full():
+    queue = JobQueue(1, 2)
+    release = threading.Event()
+
+    running = queue.submit(blocked, release)
+    waitUntilRunning(running)
+    queued = [queue.submit(blocked, release) for _ in range(2)]
+
+    with pytest.raises(QueueFullError):
+        queue.submit(blocked, release)
+    
+    # A batch is queued all at once or not at all
+    with pytest.raises(QueueFullError):
+        queue.submitBatch(blocked, [(release,)])
+    
+    release.set()
+    for job in [running] + queued:
+        assert waitUntilFinished(job) == Job.DONE
+
+
+def test_cancel_batch():
+    queue = JobQueue(1, 8)
+    release = threading.Event()
+
+    first = queue.submit(blocked, release)
+    waitUntilRunning(first)
+    batch = queue.submitBatch(untilCancelled, [()] * 3)
+
+    assert queue.cancelBatch(batch.id) is batch
+    release.set()
+
+    for job in batch.jobs:
+        assert waitUntilFinished(job) == Job.CANCELLED
+    assert batch.finishedRunning()
+    assert batch.toDict()['counts'] == {Job.CANCELLED: 3}
+
+
+def test_old_finished_jobs_are_forgotten():
+    queue = JobQueue(1, 4, maxJobs=2)
+    jobs = []
+    for i in range(4):
+        jobs.append(queue.submit(lambda job, i : i, i))
+        waitUntilFinished(jobs[-1])
+
+    assert [queue.get(job.id) for job in jobs] == [None, None] + jobs[2:]
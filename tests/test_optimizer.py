@@ -0,0 +1,100 @@
+from helpers import runFilter
+from imgfilter import ImgFilter, Optimizer, hashProgram, parseProgram
+import pytest
+
+
+# Programs with something to optimize away, which have to do the same
+# thing, or throw the same error, as the interpreter without optimizing
+PROGRAMS = [
+    # Assignments to variables that are never read
+    'for (i = 0; i < 3; i = i + 1) { y = 5 }; pixels[0, 0] = rgb(7, 1, 2);',
+    '''for (x = 0; x < width; x = x + 1) {
+        for (y = 0; y < height; y = y + 1) {
+            loadColor(x, y);
+            unused = r * 2;
+            also = 5;
+            pixels[x, y] = rgb(b, g, r);
+        };
+    };''',
+    '''if (width > 2) { y = 5 } else { z = 6 };
+    pixels[0, 0] = rgb(7, 1, 2);''',
+    '''v = if (width > 2) { y = 5; 100 } else { z = 6; 200 };
+    pixels[0, 0] = rgb(v, 1, 2);''',
+    '''f = lambda (a) { y = 5; a + 1 };
+    v = f(3);
+    pixels[0, 0] = rgb(v, v, v);''',
+    '''f = lambda (a) { y = a };
+    v = f(30);
+    pixels[0, 0] = rgb(v, v, v);''',
+    'a = 5; b = a + 1; pixels[0, 0] = rgb(1, 2, 3);',
+    # Assignments that are dropped still throw their errors
+    'y = 1 / 0; pixels[0, 0] = rgb(1, 2, 3);',
+    'y = true + 1; pixels[0, 0] = rgb(1, 2, 3);',
+    # Folding and simplifying
+    'v = 2 * 3 + 4 - 1; pixels[0, 0] = rgb(v, v, v);',
+    'v = 1 / 0; pixels[0, 0] = rgb(v, v, v);',
+    'v = true * 1; pixels[0, 0] = rgb(v, v, v);',
+    'v = 0 + false; pixels[0, 0] = rgb(v, v, v);',
+    'loadColor(2, 2); v = r * 1 + 0; pixels[0, 0] = rgb(v, v, v);',
+    '''if (false) { pixels[0, 0] = rgb(1, 2, 3) }
+    else { pixels[0, 0] = rgb(4, 5, 6) };''',
+    'v = if (true) 10; pixels[0, 0] = rgb(v, v, v);',
+    'v = if (false) 10; pixels[0, 0] = rgb(v, v, v);',
+]
+
+
+@pytest.mark.parametrize('engine', ImgFilter.ENGINES)
+@pytest.mark.parametrize('code', PROGRAMS)
+def test_optimized_matches_interpreter(code, engine):
+    expected = runFilter(code, 'interpreter', optimize=False)
+    assert runFilter(code, engine, optimize=True) == expected
+
+
+def optimize(code: str):
+    "Returns the optimized tokens of code, and what was removed."
+
+    optimizer = Optimizer()
+    return optimizer.optimize(parseProgram(code)), optimizer.removed
+
+
+def test_removes_dead_stores_in_bodies():
+    code = '''
+    for (i = 0; i < 3; i = i + 1) { y = 5 };
+    if (width > 2) { z = 6 };
+    f = lambda (a) { w = 7; a };
+    f(1);'''
+    tokens, removed = optimize(code)
+
+    for name in ('y', 'z', 'w'):
+        assert f'assignment to {name}' in removed
+    
+    loop = tokens.value[0]
+    assert loop.body.type in ('prog', 'bool')
+
+
+def test_keeps_values_of_dead_stores():
+    # The value is still evaluated in case it throws, so b stays read
+    tokens, removed = optimize('a = 5; b = a + 1; c = b * 2; 0;')
+    assert removed == ['assignment to c']
+    assert [token.type for token in tokens.value] == [
+        'assign', 'assign', 'binary', 'num'
+    ]
+
+
+def test_folds_literals():
+    tokens, removed = optimize('v = 2 * 3 + 4; w = v;')
+    assert tokens.value[0].right.value == 10
+    assert removed[:2] == ['2 * 3, folded into 6', '6 + 4, folded into 10']
+
+
+def test_keeps_errors():
+    tokens, _ = optimize('v = 1 / 0; w = v;')
+    assert tokens.value[0].right.type == 'binary'
+
+
+def test_parsed_tokens_are_not_changed():
+    code = 'v = 2 * 3; for (i = 0; i < 3; i = i + 1) { y = v }'
+    tokens = parseProgram(code)
+    before = hashProgram(tokens)
+    Optimizer().optimize(tokens)
+    assert hashProgram(tokens) == before
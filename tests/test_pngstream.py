@@ -0,0 +1,112 @@
+from io import BytesIO
+from PIL import Image
+from pngstream import SIGNATURE, PngError, PngReader, PngWriter, makeChunk
+import pytest
+import struct
+import zlib
+
+
+def makeImage(mode: str, width: int = 37, height: int = 23) -> Image.Image:
+    """Returns an image with a different color at every pixel, with
+    smooth parts and sharp edges so every way of storing rows is used."""
+
+    img = Image.new('RGB', (width, height))
+    img.putdata([
+        (x * 7 % 256, (x + y) * 5 % 256, 255 if x > y else (x * y) % 256)
+        for y in range(height) for x in range(width)
+    ])
+    if mode == 'P':
+        return img.quantize(256)
+    return img.convert(mode)
+
+
+def readStrips(path, rows: int) -> Image.Image:
+    "Reads the PNG at path rows at a time, and pastes the strips together."
+
+    with PngReader(path) as reader:
+        img = Image.new('RGB', (reader.width, reader.height))
+        top = 0
+        for strip in reader.strips(rows):
+            img.paste(strip.convert('RGB'), (0, top))
+            top += strip.size[1]
+    
+    assert top == img.size[1]
+    return img
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L', 'LA', 'P'])
+@pytest.mark.parametrize('rows', [1, 5, 23, 100])
+def test_reader_matches_pillow(tmp_path, mode, rows):
+    path = tmp_path / 'image.png'
+    makeImage(mode).save(path)
+
+    with Image.open(path) as expected:
+        expected = expected.convert('RGB')
+    assert readStrips(path, rows).tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize('rows', [1, 4, 23])
+@pytest.mark.parametrize('level', [0, 6, 9])
+def test_writer_round_trip(tmp_path, rows, level):
+    img = makeImage('RGB')
+    path = tmp_path / 'image.png'
+
+    with open(path, 'wb') as file:
+        writer = PngWriter(file, img.size[0], img.size[1], level)
+        for top in range(0, img.size[1], rows):
+            bottom = min(top + rows, img.size[1])
+            writer.write(img.crop((0, top, img.size[0], bottom)))
+        writer.close()
+
+    with Image.open(path) as written:
+        assert written.mode == 'RGB'
+        assert written.tobytes() == img.tobytes()
+    assert readStrips(path, 5).tobytes() == img.tobytes()
+
+
+def test_writer_checks_rows():
+    writer = PngWriter(BytesIO(), 4, 2)
+
+    with pytest.raises(PngError):
+        writer.write(Image.new('RGB', (3, 1)))
+    
+    writer.write(Image.new('RGB', (4, 1)))
+    with pytest.raises(PngError):
+        writer.close()
+    
+    writer.write(Image.new('RGB', (4, 1)))
+    with pytest.raises(PngError):
+        writer.write(Image.new('RGB', (4, 1)))
+
+
+def test_reader_refuses_other_images(tmp_path):
+    jpeg = tmp_path / 'image.jpg'
+    makeImage('RGB').save(jpeg)
+    with pytest.raises(PngError):
+        PngReader(jpeg)
+    
+    # Pillow can't write interlaced PNGs, but only the header is read
+    interlaced = tmp_path / 'interlaced.png'
+    interlaced.write_bytes(b''.join((
+        SIGNATURE,
+        makeChunk(b'IHDR', struct.pack('>IIBBBBB', 2, 2, 8, 2, 0, 0, 1)),
+        makeChunk(b'IDAT', zlib.compress(bytes(26))),
+        makeChunk(b'IEND', b''),
+    )))
+    with pytest.raises(PngError):
+        PngReader(interlaced)
+    
+    deep = tmp_path / 'deep.png'
+    makeImage('I;16').save(deep)
+    with pytest.raises(PngError):
+        PngReader(deep)
+
+
+def test_reader_finds_truncated_pngs(tmp_path):
+    path = tmp_path / 'image.png'
+    makeImage('RGB').save(path)
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) * 2 // 3])
+
+    with pytest.raises(PngError):
+        readStrips(path, 5)
@@ -0,0 +1,116 @@
+from helpers import runFilter
+from imgfilter import ImgFilter, RefPlan, loadPresets, parseProgram
+import imgfilter
+import pytest
+
+
+def loops(body: str) -> str:
+    "Returns a program that runs body for every pixel."
+
+    return (
+        'for (x = 0; x < width; x = x + 1) {'
+        f' for (y = 0; y < height; y = y + 1) {{ {body} }}; }};'
+    )
+
+
+# Programs that use makeRef(), and the box RefPlan copies for an image
+# 8 by 6 pixels
+PROGRAMS = {
+    'same': (
+        'makeRef(); ' + loops('loadRef(x, y); pixels[x, y] = rgb(b, g, r);'),
+        None
+    ),
+    'no loads': (
+        'makeRef(); ' + loops('loadColor(x, y); pixels[x, y] = rgb(b, g, r);'),
+        None
+    ),
+    'no writes': ('makeRef(); loadRef(2, 2); v = r;', None),
+    'mirror': (
+        'makeRef(); '
+        + loops('loadRef(width - 1 - x, y); pixels[x, y] = rgb(r, g, b);'),
+        (0, 0, 8, 6)
+    ),
+    'right': (
+        'makeRef();'
+        'for (x = 0; x < width - 1; x = x + 1) {'
+        '  for (y = 0; y < height; y = y + 1) {'
+        '    loadRef(x + 1, y); pixels[x, y] = rgb(r, g, b) }; };',
+        (1, 0, 8, 6)
+    ),
+    'rows': (
+        'makeRef();'
+        'for (x = 0; x < width; x = x + 1) {'
+        '  for (y = 2; y < 4; y = y + 1) {'
+        '    loadRef(x, y - 1); pixels[x, y] = rgb(g, b, r) }; };',
+        (0, 1, 8, 3)
+    ),
+    'region': (
+        'makeRef(); for (x = 0; x < 5; x = x + 1) {'
+        '  loadRef(x, 0); pixels[x, 1] = rgb(r, g, b) };',
+        (0, 0, 5, 1)
+    ),
+    'out of bounds': (
+        'makeRef(); for (x = 0; x < 30; x = x + 1) {'
+        '  loadRef(x, 0); pixels[0, 1] = rgb(r, g, b) };',
+        (0, 0, 8, 6)
+    ),
+    'lambda': (
+        'makeRef(); f = lambda (a, b) loadRef(a, b); '
+        + loops('f(width - 1 - x, y); pixels[x, y] = rgb(r, g, b);'),
+        (0, 0, 8, 6)
+    ),
+    'alias': (
+        'makeRef(); load = loadRef; '
+        + loops('load(width - 1 - x, y); pixels[x, y] = rgb(r, g, b);'),
+        (0, 0, 8, 6)
+    ),
+    'twice': (
+        'makeRef(); '
+        + loops('loadRef(width - 1 - x, y); pixels[x, y] = rgb(r, g, b);')
+        + 'makeRef(); '
+        + loops('loadRef(x, height - 1 - y); pixels[x, y] = rgb(g, r, b);'),
+        (0, 0, 8, 6)
+    ),
+    'in a loop': (
+        loops(
+            'makeRef(); loadRef(width - 1 - x, y);'
+            'pixels[x, y] = rgb(r, g, b);'
+        ),
+        (0, 0, 8, 6)
+    ),
+}
+
+PRESETS = loadPresets()
+
+
+class CopyEverything(RefPlan):
+    "A RefPlan that always copies the whole image, like makeRef() did."
+
+    def __init__(self, tokens, width, height):
+        super().__init__(tokens, width, height)
+        self.box = (0, 0, width, height)
+
+
+@pytest.mark.parametrize('name, expected', [
+    (name, box) for name, (code, box) in PROGRAMS.items()
+])
+def test_copies_only_what_is_read(name, expected):
+    plan = RefPlan(parseProgram(PROGRAMS[name][0]), 8, 6)
+    assert plan.box == expected
+
+
+def test_warns_about_makeref_in_loops():
+    plan = RefPlan(parseProgram(PROGRAMS['in a loop'][0]), 8, 6)
+    assert len(plan.warnings) == 1
+    assert RefPlan(parseProgram(PROGRAMS['twice'][0]), 8, 6).warnings == []
+
+
+@pytest.mark.parametrize('engine', ImgFilter.ENGINES)
+@pytest.mark.parametrize(
+    'code', [code for code, box in PROGRAMS.values()] + list(PRESETS.values())
+)
+def test_same_pixels_as_copying_everything(monkeypatch, code, engine):
+    planned = runFilter(code, engine, vectorize=False)
+
+    monkeypatch.setattr(imgfilter, 'RefPlan', CopyEverything)
+    assert runFilter(code, engine, vectorize=False) == planned
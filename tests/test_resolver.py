@@ -0,0 +1,140 @@
+from PIL import Image
+from imgfilter import Environment, ImgFilter, Resolver, parseProgram
+import pytest
+
+
+# Programs that depend on which scope a variable is read from, with the
+# first four pixels they left when scopes were chained Environments
+BLACK = (0, 0, 0)
+PROGRAMS = [
+    # Assigning in a loop saves to the loop, the global stays the same
+    ('v = 1; for (i = 0; i < 3; i = i + 1) { v = 50 };'
+     'pixels[0, 0] = rgb(v, 0, 0);',
+     [(1, 0, 0), BLACK, BLACK, BLACK]),
+    # The global is read until the loop assigns its own
+    ('v = 7; for (i = 0; i < 3; i = i + 1) {'
+     '  w = v; v = w + 1; pixels[i, 0] = rgb(v, w, 0) };',
+     [(8, 7, 0), (9, 8, 0), (10, 9, 0), BLACK]),
+    # Slots that aren't assigned yet fall through to the outer scope
+    ('v = 3; for (i = 0; i < 4; i = i + 1) {'
+     '  if (i > 1) { v = 100 + i }; pixels[i, 0] = rgb(v, i, 0) };',
+     [(3, 0, 0), (3, 1, 0), (102, 2, 0), (103, 3, 0)]),
+    ('for (i = 0; i < 2; i = i + 1) { s = i * 10;'
+     '  for (j = 0; j < 2; j = j + 1) {'
+     '    pixels[i * 2 + j, 0] = rgb(s + j, i, j) } };',
+     [BLACK, (1, 0, 1), (10, 1, 0), (11, 1, 1)]),
+    # Lambdas run in a scope of their own, inside the one they're called
+    ('a = 5; f = lambda (a) a * 2; b = f(3); pixels[0, 0] = rgb(a, b, 0);',
+     [(5, 6, 0), BLACK, BLACK, BLACK]),
+    ('k = 4; f = lambda (x) x + k; k = 10; pixels[0, 0] = rgb(f(1), 0, 0);',
+     [(11, 0, 0), BLACK, BLACK, BLACK]),
+    ('f = lambda (n) if (n < 2) n else f(n - 1) + f(n - 2);'
+     'pixels[0, 0] = rgb(f(10), 0, 0);',
+     [(55, 0, 0), BLACK, BLACK, BLACK]),
+    ('f = lambda (x) { y = x * 2; y + 1 }; y = 3;'
+     'pixels[0, 0] = rgb(f(5), y, 0);',
+     [(11, 3, 0), BLACK, BLACK, BLACK]),
+    ('f = lambda (x) lambda (y) x + y; g = f(3);'
+     'pixels[0, 0] = rgb(g(4), 0, 0);',
+     [(7, 0, 0), BLACK, BLACK, BLACK]),
+    ('for (i = 0; i < 3; i = i + 1) {'
+     '  f = lambda (x) x + i; pixels[i, 0] = rgb(f(10), 0, 0) };',
+     [(10, 0, 0), (11, 0, 0), (12, 0, 0), BLACK]),
+    # Names that were never assigned
+    ('for (i = 0; i < 3; i = i + 1) {'
+     '  if (i > 5) { q = 1 }; pixels[i, 0] = rgb(q, 0, 0) };',
+     KeyError),
+    ('pixels[0, 0] = rgb(nope, 0, 0);', KeyError),
+]
+
+
+@pytest.mark.parametrize('engine', ImgFilter.ENGINES)
+@pytest.mark.parametrize('code, expected', PROGRAMS)
+def test_scopes_match_environments(code, expected, engine):
+    imgFilter = ImgFilter.fromImage(
+        Image.new('RGB', (4, 1)), engine, optimize=False
+    )
+
+    if expected is KeyError:
+        with pytest.raises(KeyError):
+            imgFilter.run(parseProgram(code))
+        return
+    
+    imgFilter.run(parseProgram(code))
+    assert [imgFilter.img.getpixel((i, 0)) for i in range(4)] == expected
+
+
+def findReads(token, reads):
+    "Adds every variable read in token to reads, in the order they're read."
+
+    if isinstance(token, list):
+        for t in token:
+            findReads(t, reads)
+    elif token is None or not hasattr(token, 'type'):
+        return
+    elif token.type == 'var':
+        reads.append(token)
+    elif token.type == 'for':
+        findReads([token.init, token.cond, token.incr, token.body], reads)
+    elif token.type == 'if':
+        findReads([token.value, token.then, token.otherwise], reads)
+    elif token.type == 'assign':
+        findReads(token.right, reads)
+    elif token.type == 'binary':
+        findReads([token.left, token.right], reads)
+    elif token.type == 'prog':
+        findReads(token.value, reads)
+
+
+def test_reads_get_every_scope_they_could_come_from():
+    tokens = parseProgram('''
+    a = 1;
+    for (i = 0; i < 1; i = i + 1) {
+        b = 2;
+        for (j = 0; j < 1; j = j + 1) {
+            if (i > 5) { b = 3 };
+            c = a + b + j;
+        };
+    };''')
+    resolver = Resolver(tokens)
+
+    reads = []
+    findReads(tokens, reads)
+    addresses = {
+        token.value: resolver.reads[id(token)] for token in reads[-3:]
+    }
+
+    # The inner loop's slots are j, b and c, the outer loop's i and b
+    assert addresses == {
+        'a': (),
+        'b': ((0, 3), (1, 3)),
+        'j': ((0, 2),),
+    }
+
+
+@pytest.mark.parametrize('innerB', [5, Resolver.UNSET])
+def test_lookup_matches_environment(innerB):
+    unset = Resolver.UNSET
+    variables = {'a': 1, 'b': 2}
+
+    outerEnv = Environment({'b': 20, 'c': 30}, Environment(variables))
+    innerEnv = Environment({'c': 300}, outerEnv)
+    if innerB is not unset:
+        innerEnv['b'] = innerB
+
+    # The same scopes as frames, see Resolver
+    root = [None, variables]
+    outer = [root, variables, 20, 30]
+    inner = [outer, variables, 300, innerB, unset]
+
+    for name, addresses in [
+        ('a', ()),
+        ('b', ((0, 3), (1, 2))),
+        ('c', ((0, 2), (1, 3))),
+    ]:
+        assert Resolver.lookup(inner, name, addresses) == innerEnv[name]
+    
+    with pytest.raises(KeyError):
+        innerEnv['d']
+    with pytest.raises(KeyError):
+        Resolver.lookup(inner, 'd', ((0, 4),))
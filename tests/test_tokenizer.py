@@ -0,0 +1,108 @@
+from imgfilter import Tokenizer, loadPresets
+import hashlib
+import pytest
+
+
+def tokenize(text: str) -> list:
+    """Returns the type and value of every token in text, ending with
+    'error' if the Tokenizer threw one."""
+
+    tokenizer = Tokenizer(text)
+    tokens = []
+    try:
+        while not tokenizer.eof():
+            token = tokenizer.next()
+            tokens.append((token.type, token.value))
+    except SyntaxError:
+        tokens.append(('error', None))
+    return tokens
+
+
+# The tokens the Tokenizer gave when it read one character at a time,
+# before it used a single regular expression
+STREAMS = [
+    ('x = 1.5 + 2. * 30;', [
+        ('var', 'x'), ('op', '='), ('num', 1.5), ('op', '+'),
+        ('num', 2.0), ('op', '*'), ('num', 30), ('punc', ';'),
+    ]),
+    ('a//b <= c && !d || e != f', [
+        ('var', 'a'), ('op', '//'), ('var', 'b'), ('op', '<='),
+        ('var', 'c'), ('op', '&&'), ('op', '!'), ('var', 'd'),
+        ('op', '||'), ('var', 'e'), ('op', '!='), ('var', 'f'),
+    ]),
+    ('if (true) lambda(x) x else false; for', [
+        ('kw', 'if'), ('punc', '('), ('kw', 'true'), ('punc', ')'),
+        ('kw', 'lambda'), ('punc', '('), ('var', 'x'), ('punc', ')'),
+        ('var', 'x'), ('kw', 'else'), ('kw', 'false'), ('punc', ';'),
+        ('kw', 'for'),
+    ]),
+    ('pixels[x, y] = rgb(r, g, b);', [
+        ('var', 'pixels'), ('punc', '['), ('var', 'x'), ('punc', ','),
+        ('var', 'y'), ('punc', ']'), ('op', '='), ('var', 'rgb'),
+        ('punc', '('), ('var', 'r'), ('punc', ','), ('var', 'g'),
+        ('punc', ','), ('var', 'b'), ('punc', ')'), ('punc', ';'),
+    ]),
+    ('# comment only', []),
+    ('v = 1; # trailing comment', [
+        ('var', 'v'), ('op', '='), ('num', 1), ('punc', ';'),
+    ]),
+    ('x = 1 # no newline\ny = 2', [
+        ('var', 'x'), ('op', '='), ('num', 1),
+        ('var', 'y'), ('op', '='), ('num', 2),
+    ]),
+    ('x\t=\n\n3', [('var', 'x'), ('op', '='), ('num', 3)]),
+    ('a1_b2 = _c3', [('var', 'a1_b2'), ('op', '='), ('var', '_c3')]),
+    ('ifx = lambdas', [('var', 'ifx'), ('op', '='), ('var', 'lambdas')]),
+    ('x=-1', [('var', 'x'), ('op', '=-'), ('num', 1)]),
+    ('12abc', [('num', 12), ('var', 'abc')]),
+    ('1.2.3', [('num', 1.2), ('error', None)]),
+    ('x = 5 $ 3', [('var', 'x'), ('op', '='), ('num', 5), ('error', None)]),
+    ('', []),
+]
+
+
+@pytest.mark.parametrize('text, expected', STREAMS)
+def test_tokens_match_old_tokenizer(text, expected):
+    assert tokenize(text) == expected
+
+
+# Hashes of the tokens of the presets from the old Tokenizer
+PRESET_HASHES = {
+    'fast_sobel': '5970ebf034485758',
+    'grayscale': 'a1013ddff24e088e',
+    'sepia': '7038ce41077aad75',
+    'sobel': 'b67eab5f371f53c0',
+}
+
+
+@pytest.mark.parametrize('name, expected', sorted(PRESET_HASHES.items()))
+def test_preset_tokens_match_old_tokenizer(name, expected):
+    tokens = repr(tokenize(loadPresets()[name])).encode()
+    assert hashlib.sha256(tokens).hexdigest()[:16] == expected
+
+
+def test_tokens_know_where_they_start():
+    tokenizer = Tokenizer('x = 1\n  y # c\n\tz')
+    places = []
+    while not tokenizer.eof():
+        token = tokenizer.next()
+        places.append((token.value, token.line, token.col))
+    
+    assert places == [
+        ('x', 1, 0), ('=', 1, 2), (1, 1, 4), ('y', 2, 2), ('z', 3, 1)
+    ]
+
+
+def test_errors_point_at_the_character():
+    tokenizer = Tokenizer('a\n b $')
+    with pytest.raises(SyntaxError, match='line: 2, col: 3'):
+        while not tokenizer.eof():
+            tokenizer.next()
+
+
+def test_peek_doesnt_advance():
+    tokenizer = Tokenizer('a b')
+    assert tokenizer.peek() is tokenizer.peek()
+    assert tokenizer.next().value == 'a'
+    assert tokenizer.next().value == 'b'
+    assert tokenizer.eof()
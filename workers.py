@@ -0,0 +1,447 @@
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import get_context, shared_memory
+from PIL import Image
+from imgfilter import (
+    Budget, ImgFilter, StripError, loadPresets, parseProgram, runStrips
+)
+from pngstream import PngError, PngReader
+from storage import SourceCache
+import os
+import threading
+import time
+
+# Memory limits are only supported on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class WorkerCrashedError(Exception):
+    "Raised when the process running a filter stops without finishing it."
+
+
+# The longest side of the snapshots of images being filtered, and how
+# many seconds apart they're taken, see Reporter
+SNAPSHOT_SIZE = 256
+SNAPSHOT_EVERY = 2.0
+
+# The source images decoded by this process, see startWorker
+SOURCES = None
+
+# The queue that this process reports the progress of filters to
+REPORTS = None
+
+
+def startWorker(engine: str, sourcesBytes: int, memoryBytes: int = None,
+                reports = None, warm: bool = True):
+    """Gets a worker process ready to filter images: limits how much
+    memory it can use, and runs the preset filters so their code is
+    already parsed and compiled when a real filter needs it. The
+    progress of filters is put on reports, see WorkerPool.listen."""
+
+    global SOURCES, REPORTS
+
+    # Going over the limit raises a MemoryError, or stops the process,
+    # either of which only loses this filter
+    if memoryBytes and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memoryBytes, memoryBytes))
+
+    SOURCES = SourceCache(sourcesBytes)
+    REPORTS = reports
+
+    if warm:
+        warmWorker(engine)
+
+
+def warmWorker(engine: str):
+    "Runs the preset filters on a tiny image, filling the caches."
+
+    try:
+        presets = loadPresets()
+    except OSError:
+        return
+
+    img = Image.new('RGB', (8, 8))
+    for text in presets.values():
+        try:
+            ImgFilter.fromImage(img, engine).run(parseProgram(text))
+        except Exception:
+            # A broken preset only means its code isn't cached
+            pass
+
+
+def shouldStream(path: str, streamPixels: int) -> bool:
+    width, height = SOURCES.size(path)
+    return width * height >= streamPixels
+
+
+def previewImage(path: str, size: int, streamPixels: int):
+    """Returns the source image shrunk so its longest side is size, or
+    None if it's already that small."""
+
+    if max(SOURCES.size(path)) <= size:
+        return None
+
+    if shouldStream(path, streamPixels):
+        proxy = streamPreview(path, size)
+        if proxy is not None:
+            return proxy
+
+    # JPEGs only have to be decoded as big as the preview
+    img = SOURCES.image(path, size).copy()
+    img.thumbnail((size, size), Image.Resampling.BILINEAR)
+    return img
+
+
+def streamPreview(path: str, size: int):
+    """Shrinks a huge source image a strip at a time, returns None if it
+    can't be read in strips."""
+
+    try:
+        reader = PngReader(path)
+    except PngError:
+        return None
+
+    with reader:
+        # Each strip is shrunk by a whole factor, so its rows have to be
+        # a multiple of it
+        factor = max(1, max(reader.width, reader.height) // size)
+        rows = max(1, (1 << 20) // reader.width // factor) * factor
+
+        parts = [
+            strip.convert('RGB').reduce(factor)
+            for strip in reader.strips(rows)
+        ]
+
+    img = Image.new('RGB', (parts[0].size[0], sum(p.size[1] for p in parts)))
+    top = 0
+    for part in parts:
+        img.paste(part, (0, top))
+        top += part.size[1]
+
+    # What the whole factor left over is shrunk like any other preview
+    img.thumbnail((size, size), Image.Resampling.BILINEAR)
+    return img
+
+
+def streamFilter(path: str, dest: str, tokens, engine: str, budget,
+                 optimize: bool = True, level: int = 6) -> bool:
+    """Filters a huge image a strip at a time straight into dest, returns
+    false if the filter has to see all of the image at once."""
+
+    try:
+        with open(dest, 'wb') as file:
+            runStrips(
+                tokens, path, file, engine, optimize=optimize,
+                budget=budget, level=level
+            )
+    except (StripError, PngError):
+        return False
+
+    return True
+
+
+class Reporter:
+    """The Reporter is given the progress of a filter by its Budget, and
+    passes it on to report with how many pixels are filtered a second,
+    and about how many seconds are left. Every SNAPSHOT_EVERY seconds,
+    it also passes on a small JPEG of the image so far, once the image
+    has an imgFilter to take it from."""
+
+    def __init__(self, report, pixels: int):
+        self.report = report
+        self.pixels = pixels
+        self.imgFilter = None
+        self.nextSnapshot = time.monotonic() + SNAPSHOT_EVERY
+    
+
+    def __call__(self, progress: dict):
+        done = progress['done']
+        seconds = progress['seconds']
+
+        progress['percent'] = round(done * 100, 1)
+        progress['pixelsPerSecond'] = (
+            self.pixels * done / seconds if seconds else None
+        )
+        progress['eta'] = seconds * (1 - done) / done if done else None
+
+        snapshot = None
+        now = time.monotonic()
+        if self.imgFilter is not None and now >= self.nextSnapshot:
+            self.nextSnapshot = now + SNAPSHOT_EVERY
+
+            buffer = BytesIO()
+            self.imgFilter.snapshot(SNAPSHOT_SIZE).save(buffer, 'JPEG')
+            snapshot = buffer.getvalue()
+        
+        self.report(progress, snapshot)
+
+
+def renderImage(task: dict, cancelled = None, report = None) -> dict:
+    """Filters the image at task['path'] with each of the programs, one
+    after the other, and saves the last image to task['dest'] with
+    task['encoding']. Returns the size of the result, whether it's a
+    preview, and with task['profile'], where the filter spent its time.
+    It stops once cancelled() returns true, and while it runs, its
+    progress and snapshots are given to report, see Reporter.
+
+    The programs are task['texts'], or task['optimized'] if they were
+    already parsed and optimized. With task['preview'], the filter runs
+    on a copy of the image no bigger than preview pixels across."""
+
+    global SOURCES
+
+    if SOURCES is None:
+        SOURCES = SourceCache(0)
+
+    path = task['path']
+    dest = task['dest']
+    engine = task['engine']
+    encoding = task['encoding']
+    profile = task['profile']
+
+    optimized = task['optimized']
+    program = optimized if optimized is not None else [
+        parseProgram(text) for text in task['texts']
+    ]
+    optimize = optimized is None
+
+    proxy = task['preview'] and previewImage(
+        path, task['preview'], task['streamPixels']
+    )
+
+    # Each stage of the pipeline goes through every pixel
+    width, height = proxy.size if proxy else SOURCES.size(path)
+    reporter = report and Reporter(report, width * height * len(program))
+
+    budget = Budget(
+        task['steps'], task['seconds'], cancelled=cancelled,
+        report=reporter
+    )
+
+    # Pipelines are kept in memory between their stages, and only PNGs
+    # can be saved a strip at a time
+    streamed = not (
+        proxy or profile or len(program) > 1 or encoding.format != 'png'
+    ) and shouldStream(path, task['streamPixels']) and streamFilter(
+        path, dest, program[0], engine, budget, optimize, encoding.level
+    )
+
+    if streamed:
+        with Image.open(dest) as img:
+            width, height = img.size
+        return {
+            'width': width, 'height': height, 'profile': None,
+            'preview': False
+        }
+
+    # The decoded source image is shared, and fromImage copies it
+    imgFilter = ImgFilter.fromImage(
+        proxy or SOURCES.image(path), engine, workers=task['workers'],
+        budget=budget, profile=profile, optimize=optimize
+    )
+    if reporter:
+        reporter.imgFilter = imgFilter
+    imgFilter.runPipeline(program)
+
+    data = encoding.encode(imgFilter.img)
+    with open(dest, 'wb') as file:
+        file.write(data)
+
+    width, height = imgFilter.img.size
+    return {
+        'width': width, 'height': height,
+        'profile': imgFilter.profiler.toDict() if profile else None,
+        'preview': bool(proxy)
+    }
+
+
+def runTask(task: dict, flagName: str) -> dict:
+    """Runs renderImage in a worker process. It's cancelled once the
+    byte in the shared memory named flagName is set, and its progress
+    is reported along with flagName, so the web app knows which filter
+    it's for."""
+
+    flag = shared_memory.SharedMemory(name=flagName)
+    try:
+        return renderImage(
+            task, lambda : flag.buf[0] != 0,
+            lambda progress, snapshot : REPORTS.put(
+                (flagName, progress, snapshot)
+            )
+        )
+    finally:
+        flag.close()
+
+
+class WorkerPool:
+    """The WorkerPool runs filters in worker processes that are started
+    once and kept, so each one already has imgfilter imported, its
+    caches warm, and its memory limited, see startWorker. The web app
+    only has to hand filters to them, and how many filters can run at
+    once doesn't depend on how many requests can be served.
+
+    A filter that stops its process, like by going over the memory
+    limit, doesn't take down the web app. The pool is started again,
+    and the filters that were running in it are tried once more.
+
+    With no processes, filters are ran by the thread that asks for
+    them, which is easier to debug, but isn't kept apart at all.
+
+    The workers put the progress of their filters on a queue, which a
+    thread of the pool reads, passing each report to whoever is waiting
+    for that filter, see run."""
+
+    def __init__(self, processes: int, engine: str, sourcesBytes: int,
+                 memoryBytes: int = None, maxTasks: int = None):
+        self.processes = processes
+        self.options = (engine, sourcesBytes, memoryBytes)
+        self.maxTasks = maxTasks
+        self.executor = None
+        self.reports = None
+        self.lock = threading.Lock()
+
+        # Where the progress of each running filter goes, by the name
+        # of its flag
+        self.listeners = {}
+
+
+    def start(self) -> ProcessPoolExecutor:
+        "Starts the worker processes if they aren't running, returns them."
+
+        with self.lock:
+            if self.executor is not None:
+                return self.executor
+
+            # Forking a process with threads running isn't safe
+            context = get_context('spawn')
+
+            self.reports = context.Queue()
+            threading.Thread(
+                target=self.listen, args=(self.reports,), daemon=True
+            ).start()
+
+            options = {
+                'mp_context': context,
+                'initializer': startWorker,
+                'initargs': self.options + (self.reports,),
+            }
+            # Processes are replaced after maxTasks filters, in case
+            # they hold on to memory
+            if self.maxTasks:
+                options['max_tasks_per_child'] = self.maxTasks
+
+            self.executor = ProcessPoolExecutor(self.processes, **options)
+
+            # Processes are only started when there's something to run,
+            # so every one is given something, instead of the first
+            # filters having to wait for them
+            for _ in range(self.processes):
+                self.executor.submit(os.getpid)
+
+            return self.executor
+
+
+    def tileWorkers(self, workers: int) -> int:
+        """Returns how many processes each worker process can split a
+        filter into tiles with, see ImgFilter.runTiles, when workers is
+        how many the web app can use in all. They're shared between the
+        worker processes, so there are never more than workers of them.
+        Tiles are ran by processes of their own, which the memory limit
+        would only cover one at a time, so with a limit, filters aren't
+        split at all."""
+
+        memoryBytes = self.options[2]
+        if memoryBytes:
+            return 1
+        return max(1, workers // self.processes)
+    
+
+    def listen(self, reports):
+        "Passes on the reports of the workers, until it's given None."
+
+        while True:
+            message = reports.get()
+            if message is None:
+                return
+            
+            flagName, progress, snapshot = message
+            listener = self.listeners.get(flagName)
+            if listener is not None:
+                listener(progress, snapshot)
+    
+
+    def restart(self, executor: ProcessPoolExecutor):
+        "Throws away the broken processes, unless another thread already has."
+
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+                self.reports.put(None)
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def run(self, task: dict, cancelled: threading.Event,
+            report = None) -> dict:
+        """Runs renderImage in a worker process, and returns what it
+        does, or raises its error. It's cancelled once cancelled is
+        set, and its progress is given to report."""
+
+        if not self.processes:
+            with self.lock:
+                if SOURCES is None:
+                    startWorker(self.options[0], self.options[1], warm=False)
+            return renderImage(task, cancelled.is_set, report)
+
+        task = dict(task, workers=self.tileWorkers(task['workers']))
+
+        flag = shared_memory.SharedMemory(create=True, size=1)
+        flag.buf[0] = 0
+
+        if report is not None:
+            self.listeners[flag.name] = report
+
+        try:
+            for _ in range(2):
+                executor = self.start()
+                try:
+                    future = executor.submit(runTask, task, flag.name)
+
+                    # The process is told once the job is cancelled
+                    while not wait([future], timeout=0.1).done:
+                        if cancelled.is_set():
+                            flag.buf[0] = 1
+
+                    return future.result()
+                except BrokenProcessPool:
+                    self.restart(executor)
+
+                    if cancelled.is_set():
+                        break
+
+            raise WorkerCrashedError(
+                'The filter stopped the process running it, likely by '
+                'using too much memory'
+            )
+        finally:
+            self.listeners.pop(flag.name, None)
+            flag.close()
+            # A process that couldn't open the flag, like when it's out
+            # of memory, already removed it
+            try:
+                flag.unlink()
+            except FileNotFoundError:
+                pass
+
+
+    def shutdown(self):
+        "Stops the worker processes."
+
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+                self.reports.put(None)